@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""Compare the throughput of recording finished stages in the finished stages log
+
+  * 'per-stage': a write and flush for each stage, as the server used to do, and
+  * 'journal':   the buffered FinishedStagesJournal (group commit),
+
+and time the compaction done on restart.  Run with --dir on the (network) filesystem
+your pipelines use, since per-write latency is what matters."""
+
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+
+from pydpiper.execution.journal import FinishedStagesJournal, format_record
+
+
+def stage_hashes(n):
+    return [hashlib.md5(str(i).encode()).hexdigest() for i in range(n)]
+
+
+def per_stage(path, hashes):
+    with open(path, 'a') as fh:
+        for i, h in enumerate(hashes):
+            fh.write(format_record(i, h))
+            fh.flush()
+
+
+def journal(path, hashes):
+    j = FinishedStagesJournal(path)
+    for i, h in enumerate(hashes):
+        j.append(i, h)
+    j.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default=None, help="directory in which to write the logs [default: a temporary directory]")
+    parser.add_argument("--stages", type=int, default=50000, help="number of finished stages to record")
+    options = parser.parse_args()
+
+    hashes = stage_hashes(options.stages)
+    d = tempfile.mkdtemp(dir=options.dir)
+    for name, f in [("per-stage", per_stage), ("journal", journal)]:
+        path = os.path.join(d, name + "_finished_stages")
+        t0 = time.time()
+        f(path, hashes)
+        elapsed = time.time() - t0
+        print("%-10s %10.0f stages/s" % (name, options.stages / elapsed))
+    j = FinishedStagesJournal(path)
+    t0 = time.time()
+    j.compact(j.records())
+    print("compaction of %d records: %.3f s" % (options.stages, time.time() - t0))
+    for name in os.listdir(d):
+        os.remove(os.path.join(d, name))
+    os.rmdir(d)
+
+
+if __name__ == "__main__":
+    main()
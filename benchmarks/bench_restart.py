@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+"""Time needed to restart a large, mostly finished pipeline: the server consults the finished
+stages log to skip the previously completed stages and then enqueues the remaining runnable ones
+(waiting for their when-runnable hooks).
+
+The pipeline is registration-like (per subject and iteration, a blur, a registration and a
+resampling, plus an average over all subjects per iteration), and the log records the first
+`--finished` fraction of its stages in topological order.  Every stage has a hook which (like
+the memory hooks of the registration stages) examines one of its files; the number of hook calls
+is reported as well, as is the time needed to restart from a scheduler snapshot instead of
+constructing the pipeline."""
+
+import argparse
+import os
+from functools import partial
+import tempfile
+import time
+
+from pydpiper.core.arguments import CompoundParser, application_parser, execution_parser, parse
+from pydpiper.execution.journal import format_record
+from pydpiper.execution.pipeline import Pipeline, CmdStage, InputFile, OutputFile
+
+
+def hook(calls, s):
+    calls.append(1)
+    os.path.exists(s.inputFiles[0])
+
+
+def options(output_dir, restart_check):
+    return parse(CompoundParser([application_parser, execution_parser]),
+                 ["--pipeline-name=bench", "--output-dir=" + output_dir, "--restart-check=" + restart_check, "--local"])
+
+
+def registration_stages(d, subjects, iterations, hook):
+    avg = os.path.join(d, "nlin", "avg_0.mnc")
+    for it in range(iterations):
+        outputs = []
+        for s in range(subjects):
+            img = ("%s/subject_%04d/resampled/subject_%04d_nlin_%d.mnc" % (d, s, s, it - 1) if it else
+                   "%s/subject_%04d/subject_%04d_lsq12.mnc" % (d, s, s))
+            blur = "%s/subject_%04d/tmp/subject_%04d_nlin_%d_fwhm0.1_blur.mnc" % (d, s, s, it)
+            xfm = "%s/subject_%04d/transforms/subject_%04d_nlin_%d.xfm" % (d, s, s, it)
+            out = "%s/subject_%04d/resampled/subject_%04d_nlin_%d.mnc" % (d, s, s, it)
+            stages = [CmdStage(["mincblur", "-clobber", "-fwhm", "0.1", InputFile(img), OutputFile(blur)]),
+                      CmdStage(["mincANTS", "3", "-m", "CC[%s,%s,1,3]" % (blur, avg),
+                                InputFile(blur), InputFile(avg), "-o", OutputFile(xfm)]),
+                      CmdStage(["mincresample", "-clobber", "-like", InputFile(avg),
+                                "-transform", InputFile(xfm), InputFile(img), OutputFile(out)])]
+            for st in stages:
+                st._runnable_hooks.append(hook)
+                yield st
+            outputs.append(out)
+        new_avg = os.path.join(d, "nlin", "avg_%d.mnc" % (it + 1))
+        avg_stage = CmdStage(["mincaverage", "-clobber"] + [InputFile(o) for o in outputs] + [OutputFile(new_avg)])
+        avg_stage._runnable_hooks.append(hook)
+        yield avg_stage
+        avg = new_avg
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subjects", type=int, default=5000)
+    parser.add_argument("--iterations", type=int, default=7)
+    parser.add_argument("--finished", type=float, default=0.95)
+    parser.add_argument("--restart-check", default="command")
+    args = parser.parse_args()
+
+    hook_calls = []
+    d = tempfile.mkdtemp()
+    os.chdir(d)  # `Pipeline` writes its log and finished stages log to the current directory
+    t0 = time.time()
+    p = Pipeline(list(registration_stages(d, args.subjects, args.iterations, partial(hook, hook_calls))),
+                 options(d, args.restart_check))
+    t1 = time.time()
+    order = p.G.topological_sort()
+    with open(p.backupFileLocation, 'w') as f:
+        f.writelines(format_record(i, p.stages[i].getHash()) for i in order[:int(args.finished * len(order))])
+
+    t2 = time.time()
+    p.skip_completed_stages()
+    p.enqueue_runnable_stages()
+    p.wait_for_hooks()
+    t3 = time.time()
+    print("%d stages, %d previously finished" % (len(p.stages), p.num_finished_stages))
+    print("constructing Pipeline: %6.2f s" % (t1 - t0))
+    print("restart:               %6.2f s" % (t3 - t2))
+    print("runnable after restart: %d, hook calls: %d" % (len(p.runnable), len(hook_calls)))
+
+    p.snapshot_path, p.definition_key = os.path.join(d, "bench_scheduler_snapshot"), "bench"
+    t4 = time.time()
+    p.write_snapshot()
+    t5 = time.time()
+    q = Pipeline.from_snapshot(p.snapshot_path, p.definition_key, p.options)
+    q.skip_completed_stages()
+    q.enqueue_runnable_stages()
+    q.wait_for_hooks()
+    t6 = time.time()
+    print("writing snapshot:      %6.2f s (%.1f MB)" % (t5 - t4, os.path.getsize(p.snapshot_path) / 2**20))
+    print("snapshot + restart:    %6.2f s" % (t6 - t5))
+
+
+if __name__ == "__main__":
+    main()
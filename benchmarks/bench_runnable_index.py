@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""Simulate executors pulling stages from a synthetic DAG and compare executor utilisation
+when stages are chosen by popping an arbitrary runnable stage (re-queueing it and making
+the executor wait if it doesn't fit, as `Pipeline.getCommand` used to do) versus asking the
+`RunnableIndex` for the largest stage which fits.
+
+Like `pipelineExecutor.mainFn`, each executor asks for one stage per poll and polls again
+when one of its stages finishes or after the main loop interval.  The simulation is run both with
+each kind of stage requesting the same memory and with every stage's request distinct (as when
+they're estimated from the stages' inputs), which would give each stage its own bucket if the
+index didn't round requests to a few significant bits."""
+
+import argparse
+import heapq
+import random
+import time
+
+from pydpiper.execution.scheduling import RunnableIndex
+
+EXECUTOR_MAIN_LOOP_INTERVAL = 30.0
+
+# (name, mem (G), procs, runtime (s))
+STAGE_TYPES = [("mincblur",     0.5, 1,   20),
+               ("mincresample", 1.0, 1,   30),
+               ("minctracc",    2.0, 1,  300),
+               ("pmincaverage", 6.0, 4,  600),
+               ("ANTS",        24.0, 1, 3600)]
+WEIGHTS = [40, 30, 15, 5, 10]
+
+
+def synthetic_dag(n_stages, width, seed):
+    rng = random.Random(seed)
+    kinds = rng.choices(range(len(STAGE_TYPES)), weights=WEIGHTS, k=n_stages)
+    preds = [[] for _ in range(n_stages)]
+    for i in range(width, n_stages):
+        layer_start = (i // width - 1) * width
+        preds[i] = rng.sample(range(layer_start, layer_start + width), rng.randint(1, 2))
+    succs = [[] for _ in range(n_stages)]
+    for i, ps in enumerate(preds):
+        for p in ps:
+            succs[p].append(i)
+    return kinds, preds, succs
+
+
+class PopAndRequeue(object):
+    def __init__(self):
+        self.s = set()
+        # only used to count the 'wait's handed out although some runnable stage would have fit
+        self.shadow = RunnableIndex()
+        self.missed = 0
+    def __len__(self):
+        return len(self.s)
+    def add(self, i, mem, procs):
+        self.s.add(i)
+        self.shadow.add(i, mem=mem, procs=procs)
+    def get(self, mem_free, procs_free, mem, procs):
+        i = self.s.pop()
+        if mem[i] <= mem_free and procs[i] <= procs_free:
+            self.shadow.discard(i)
+            return i
+        self.s.add(i)
+        j = self.shadow.pop_fitting(mem_free=mem_free, procs_free=procs_free)
+        if j is not None:
+            self.missed += 1
+            self.shadow.add(j, mem=mem[j], procs=procs[j])
+        return None
+
+
+class Indexed(object):
+    def __init__(self):
+        self.r = RunnableIndex()
+        self.missed = 0
+    def __len__(self):
+        return len(self.r)
+    def add(self, i, mem, procs):
+        self.r.add(i, mem=mem, procs=procs)
+    def get(self, mem_free, procs_free, mem, procs):
+        return self.r.pop_fitting(mem_free=mem_free, procs_free=procs_free)
+
+
+def simulate(runnable, kinds, preds, succs, n_executors, exec_mem, exec_procs, mem_jitter=0.0, seed=0):
+    rng = random.Random(seed)
+    mem   = [STAGE_TYPES[k][1] * (1 + rng.uniform(-mem_jitter, mem_jitter)) for k in kinds]
+    procs = [STAGE_TYPES[k][2] for k in kinds]
+    dur   = [STAGE_TYPES[k][3] for k in kinds]
+    unfinished_preds = [len(p) for p in preds]
+    for i, c in enumerate(unfinished_preds):
+        if c == 0:
+            runnable.add(i, mem[i], procs[i])
+    mem_free   = [exec_mem] * n_executors
+    procs_free = [exec_procs] * n_executors
+    # events: (time, kind, executor, stage); kind 0 = stage finished, 1 = poll
+    events = [(0.0, 1, e, -1) for e in range(n_executors)]
+    heapq.heapify(events)
+    next_poll = [0.0] * n_executors
+    finished, busy_mem_seconds, now = 0, 0.0, 0.0
+    while finished < len(kinds):
+        now, kind, e, i = heapq.heappop(events)
+        if kind == 0:
+            finished += 1
+            mem_free[e] += mem[i]
+            procs_free[e] += procs[i]
+            busy_mem_seconds += mem[i] * dur[i]
+            for j in succs[i]:
+                unfinished_preds[j] -= 1
+                if unfinished_preds[j] == 0:
+                    runnable.add(j, mem[j], procs[j])
+        elif now < next_poll[e]:
+            continue  # superseded by an earlier wakeup
+        if len(runnable) > 0 and procs_free[e] > 0:
+            j = runnable.get(mem_free[e], procs_free[e], mem, procs)
+            if j is not None:
+                mem_free[e] -= mem[j]
+                procs_free[e] -= procs[j]
+                heapq.heappush(events, (now + dur[j], 0, e, j))
+        next_poll[e] = now + EXECUTOR_MAIN_LOOP_INTERVAL
+        heapq.heappush(events, (next_poll[e], 1, e, -1))
+    utilisation = busy_mem_seconds / (n_executors * exec_mem * now)
+    return now, utilisation, runnable.missed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--stages", type=int, default=50000)
+    parser.add_argument("--width", type=int, default=5000, help="stages per DAG layer")
+    parser.add_argument("--executors", type=int, default=50)
+    parser.add_argument("--mem", type=float, default=32.0, help="memory per executor (G)")
+    parser.add_argument("--proc", type=int, default=8, help="processors per executor")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mem-jitter", dest="mem_jitter", type=float, default=0.2,
+                        help="in the second case, vary each stage's memory request by up to this fraction")
+    options = parser.parse_args()
+
+    kinds, preds, succs = synthetic_dag(options.stages, options.width, options.seed)
+    print("%d stages, %d executors with %.1fG and %d processors each"
+          % (options.stages, options.executors, options.mem, options.proc))
+    for case, jitter in [("same memory per kind of stage", 0.0), ("distinct memory per stage", options.mem_jitter)]:
+        print(case + ":")
+        for name, runnable in [("pop and requeue", PopAndRequeue()), ("runnable index", Indexed())]:
+            t0 = time.time()
+            makespan, utilisation, missed = simulate(runnable, kinds, preds, succs, options.executors,
+                                                     options.mem, options.proc, jitter, options.seed)
+            print("  %-16s makespan %7.1f h   memory utilisation %5.1f%%   "
+                  "'wait's although a runnable stage fit %7d   (simulated in %.1f s)"
+                  % (name, makespan / 3600, 100 * utilisation, missed, time.time() - t0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+"""Time and memory needed to construct the server's `Pipeline` for a large registration-like
+graph: per subject, a chain of registration/resampling stages, with an averaging stage across
+all subjects after each iteration (as in a model building pipeline), so the graph has both
+long chains and very wide fan-in/fan-out.
+
+Memory is the growth in traced allocations (tracemalloc) while building the pipeline,
+including the stage objects themselves."""
+
+import argparse
+import gc
+import os
+import tempfile
+import time
+import tracemalloc
+
+from pydpiper.core.arguments import CompoundParser, application_parser, execution_parser, parse
+from pydpiper.execution.pipeline import Pipeline, CmdStage, InputFile, OutputFile
+
+
+def options():
+    return parse(CompoundParser([application_parser, execution_parser]),
+                 ["--pipeline-name=bench", "--output-dir=" + tempfile.mkdtemp(), "--local"])
+
+
+def registration_stages(subjects, iterations):
+    d = "/hpf/largeprojects/some_lab/some_user/pipelines/2000_subject_study/pipeline_processed"
+    avg = "%s/nlin/avg_0.mnc" % d
+    for it in range(iterations):
+        outputs = []
+        for s in range(subjects):
+            img = "%s/subject_%04d/resampled/subject_%04d_nlin_%d.mnc" % (d, s, s, it - 1) if it else \
+                  "%s/subject_%04d/subject_%04d_lsq12.mnc" % (d, s, s)
+            blur = "%s/subject_%04d/tmp/subject_%04d_nlin_%d_fwhm0.1_blur.mnc" % (d, s, s, it)
+            xfm = "%s/subject_%04d/transforms/subject_%04d_nlin_%d.xfm" % (d, s, s, it)
+            out = "%s/subject_%04d/resampled/subject_%04d_nlin_%d.mnc" % (d, s, s, it)
+            yield CmdStage(["mincblur", "-clobber", "-no_apodize", "-fwhm", "0.1",
+                            InputFile(img), OutputFile(blur)])
+            yield CmdStage(["mincANTS", "3", "-m", "CC[%s,%s,1,3]" % (blur, avg),
+                            "-i", "100x100x100x0", "-t", "SyN[0.1]", "-r", "Gauss[2,1]",
+                            InputFile(blur), InputFile(avg), "-o", OutputFile(xfm)])
+            yield CmdStage(["mincresample", "-clobber", "-2", "-like", InputFile(avg),
+                            "-transform", InputFile(xfm), InputFile(img), OutputFile(out)])
+            outputs.append(out)
+        new_avg = "%s/nlin/avg_%d.mnc" % (d, it + 1)
+        yield CmdStage(["mincaverage", "-clobber", "-normalize", "-max_buffer_size_in_kb", "409620"]
+                       + [InputFile(o) for o in outputs] + [OutputFile(new_avg)])
+        avg = new_avg
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subjects", type=int, default=2000)
+    parser.add_argument("--iterations", type=int, default=6)
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())  # `Pipeline` writes its log to the current directory
+    try:
+        # time without tracing (tracemalloc slows allocation-heavy code down a lot) ...
+        t0 = time.time()
+        stages = list(registration_stages(args.subjects, args.iterations))
+        t1 = time.time()
+        p = Pipeline(stages, options())
+        t2 = time.time()
+        del stages, p
+        # ... then measure memory in a second run
+        gc.collect()
+        tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+        p = Pipeline(list(registration_stages(args.subjects, args.iterations)), options())
+        gc.collect()
+        after, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        os.chdir(cwd)
+    print("%d stages, %d edges" % (len(p.stages), sum(len(p.G.successors(i)) for i in range(len(p.stages)))))
+    print("creating stages:       %6.2f s" % (t1 - t0))
+    print("constructing Pipeline: %6.2f s" % (t2 - t1))
+    print("memory retained:       %6.0f MB (peak %.0f MB)" % ((after - before) / 2**20, (peak - before) / 2**20))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+"""Time and peak memory of `application.execute` with --no-execute, i.e., everything an application
+does between building its (new-style) stages and starting the server: converting the stages,
+constructing the `Pipeline`, writing out the stage list and checking the stages.
+
+The stages mimic a large MBM-style nonlinear model build: per subject and iteration,
+a blur, a registration and a resampling, plus an average over all subjects per iteration.
+Since the checks require the commands to exist, common executables stand in for the MINC tools."""
+
+import argparse
+import os
+import resource
+import tempfile
+import time
+
+from pydpiper.core.arguments import CompoundParser, application_parser, execution_parser, parse
+from pydpiper.core.files import FileAtom
+from pydpiper.core.stages import CmdStage
+from pydpiper.execution.application import execute
+
+
+def options(output_dir):
+    return parse(CompoundParser([application_parser, execution_parser]),
+                 ["--pipeline-name=bench", "--output-dir=" + output_dir, "--local", "--no-persist-minc-headers",
+                  "--no-scheduler-snapshot", "--no-execute"])
+
+
+def mbm_stages(d, subjects, iterations):
+    def atom(*parts):
+        return FileAtom(os.path.join(d, *parts), pipeline_sub_dir=d)
+    stages = []
+    avg = atom("nlin", "avg_0.mnc")
+    imgs = [atom("subject_%04d" % s, "subject_%04d_lsq12.mnc" % s) for s in range(subjects)]
+    for it in range(iterations):
+        resampled = []
+        for s, img in enumerate(imgs):
+            blur = atom("subject_%04d" % s, "tmp", "subject_%04d_nlin_%d_fwhm0.1_blur.mnc" % (s, it))
+            xfm = atom("subject_%04d" % s, "transforms", "subject_%04d_nlin_%d.xfm" % (s, it))
+            out = atom("subject_%04d" % s, "resampled", "subject_%04d_nlin_%d.mnc" % (s, it))
+            stages.append(CmdStage(inputs=(img,), outputs=(blur,),
+                                   cmd=["cat", "-clobber", "-no_apodize", "-fwhm", "0.1", img.path, blur.path]))
+            stages.append(CmdStage(inputs=(blur, avg), outputs=(xfm,),
+                                   cmd=["cp", "3", "-m", "CC[%s,%s,1,3]" % (blur.path, avg.path),
+                                        "-i", "100x100x100x0", "-t", "SyN[0.1]", "-r", "Gauss[2,1]",
+                                        "-o", xfm.path]))
+            stages.append(CmdStage(inputs=(img, xfm, avg), outputs=(out,),
+                                   cmd=["ls", "-clobber", "-2", "-like", avg.path, "-transform", xfm.path,
+                                        img.path, out.path]))
+            resampled.append(out)
+        new_avg = atom("nlin", "avg_%d.mnc" % (it + 1))
+        stages.append(CmdStage(inputs=tuple(resampled), outputs=(new_avg,),
+                               cmd=["sort", "-clobber", "-normalize"] + [r.path for r in resampled] + [new_avg.path]))
+        avg, imgs = new_avg, resampled
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subjects", type=int, default=2000)
+    parser.add_argument("--iterations", type=int, default=6)
+    args = parser.parse_args()
+
+    d = tempfile.mkdtemp()
+    os.chdir(d)  # the stage list, command file, etc., are written to the current directory
+    stages = mbm_stages(d, args.subjects, args.iterations)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.time()
+    execute(stages, options(d))
+    elapsed = time.time() - t0
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("%d stages" % len(stages))
+    print("execute (--no-execute): %6.2f s" % elapsed)
+    print("peak RSS growth:        %6.0f MB" % ((rss_after - rss_before) / 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""Stress a local stand-in for the pipeline server with many simulated executors and report
+server-side requests and new connections per second, comparing
+
+  * 'per-call':   a new proxy (connection + handshake) for every call and one
+                  getCommand/get_stage_info/setStageStarted/setStageFinished sequence per stage,
+                  as executors used to do, and
+  * 'persistent': one long-lived proxy per executor thread, batched `getCommands` and the
+                  stage results piggybacked on the `reportStageResults` heartbeat.
+
+The stand-in runs in its own process with the same (multiplex) Pyro server type as the real
+server; its stages do nothing, so the numbers measure the communication overhead only."""
+
+import argparse
+import itertools
+import threading
+import time
+from multiprocessing import Process, Queue
+
+import Pyro4  # type: ignore
+
+from pydpiper.execution import pipeline_executor  # sets Pyro4.config.SERVERTYPE etc.
+
+
+class StandInServer(object):
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.stages_finished = 0
+        self.counter = itertools.count()
+    def _request(self):
+        self.requests += 1
+    def registerClient(self, clientURI, maxmemory):
+        self._request()
+    def updateClientTimestamp(self, clientURI, tick):
+        self._request()
+    def getCommand(self, clientURIstr, clientMemFree, clientProcsFree):
+        self._request()
+        return ("run_stage", next(self.counter))
+    def get_stage_info(self, i):
+        self._request()
+        return pipeline_executor.StageInfo(mem=1.0, procs=1, ix=i, cmd=["true"], log_file="/dev/null")
+    def setStageStarted(self, index, clientURI):
+        self._request()
+    def setStageFinished(self, index, clientURI):
+        self._request()
+        self.stages_finished += 1
+    def getCommands(self, clientURIstr, clientMemFree, clientProcsFree):
+        self._request()
+        return ("run_stages", [pipeline_executor.StageInfo(mem=1.0, procs=1, ix=next(self.counter),
+                                                           cmd=["true"], log_file="/dev/null")
+                               for _ in range(int(clientProcsFree))])
+    def reportStageResults(self, clientURI, results, tick=None):
+        self._request()
+        self.stages_finished += len(results)
+    def stats(self):
+        return self.requests, self.connections, self.stages_finished
+
+
+class CountingDaemon(Pyro4.core.Daemon):
+    def __init__(self, server, **kwargs):
+        super().__init__(**kwargs)
+        self.server = server
+    def validateHandshake(self, conn, data):
+        self.server.connections += 1
+        return super().validateHandshake(conn, data)
+
+
+def serve(uri_queue):
+    server = StandInServer()
+    daemon = CountingDaemon(server, host="127.0.0.1")
+    uri_queue.put(daemon.register(server, "pipeline").asString())
+    daemon.requestLoop()
+
+
+def per_call_executor(uri, name, procs, stop):
+    def call(f, *args, **kwargs):
+        with Pyro4.Proxy(uri) as p:
+            return getattr(p, f)(*args, **kwargs)
+    tick = 0
+    while not stop.is_set():
+        call("updateClientTimestamp", name, tick)
+        tick += 1
+        for _ in range(procs):
+            _flag, i = call("getCommand", clientURIstr=name, clientMemFree=procs, clientProcsFree=procs)
+            call("get_stage_info", i)
+            call("setStageStarted", i, name)
+            call("setStageFinished", i, name)
+
+
+def persistent_executor(uri, name, procs, stop):
+    with Pyro4.Proxy(uri) as p:
+        tick, results = 0, []
+        while not stop.is_set():
+            p.reportStageResults(name, results, tick=tick)
+            tick += 1
+            _flag, stages = p.getCommands(clientURIstr=name, clientMemFree=procs, clientProcsFree=procs)
+            results = [(s.ix, 0, None) for s in stages]
+
+
+def run(mode, uri, executors, procs, duration):
+    with Pyro4.Proxy(uri) as p:
+        before = p.stats()
+    stop = threading.Event()
+    target = per_call_executor if mode == "per-call" else persistent_executor
+    threads = [threading.Thread(target=target, args=(uri, "executor-%d" % e, procs, stop))
+               for e in range(executors)]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - t0
+    with Pyro4.Proxy(uri) as p:
+        after = p.stats()
+    requests, connections, stages = [(a - b) / elapsed for a, b in zip(after, before)]
+    print("%-10s %8.0f requests/s %8.0f new connections/s %8.0f stages reported/s"
+          % (mode, requests, connections, stages))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--executors", type=int, default=100, help="simulated executors (threads)")
+    parser.add_argument("--proc", type=int, default=8, help="processors per simulated executor")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per mode")
+    options = parser.parse_args()
+
+    Pyro4.config.THREADPOOL_SIZE = max(Pyro4.config.THREADPOOL_SIZE, options.executors + 10)
+    uri_queue = Queue()
+    server = Process(target=serve, args=(uri_queue,))
+    server.daemon = True
+    server.start()
+    uri = uri_queue.get()
+    print("%d simulated executors with %d processors each, %.0f s per mode"
+          % (options.executors, options.proc, options.duration))
+    try:
+        for mode in ["per-call", "persistent"]:
+            run(mode, uri, options.executors, options.proc, options.duration)
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,8 @@ import time
 from configargparse import ArgParser, Namespace  # type: ignore
 from typing import Any, Callable, List, Optional
 from pydpiper.core.util import AutoEnum, NamedTuple
+from pydpiper.execution.restart import RESTART_CHECKS
+from pydpiper.execution.retries import parse_retry_policy
 
 
 # TODO: should the pipeline-specific argument handling be located here
@@ -192,6 +194,11 @@ def _mk_application_parser(p: ArgParser) -> ArgParser:
     --pipeline-name
     --restart
     --no-restart
+    --restart-check
+    --persist-minc-headers
+    --no-persist-minc-headers
+    --scheduler-snapshot
+    --no-scheduler-snapshot
     --output-dir
     --create-graph
     --execute
@@ -213,6 +220,28 @@ def _mk_application_parser(p: ArgParser) -> ArgParser:
 
     g.add_argument("--no-restart", dest="restart",
                    action="store_false", help="Opposite of --restart")
+    g.add_argument("--restart-check", dest="restart_check",
+                   choices=RESTART_CHECKS, default="command",
+                   help="When restarting, how to decide whether a previously finished stage can be skipped: "
+                        "'command' if its command has been run before; 'stat' if, in addition, the sizes and "
+                        "modification times of its input and output files are unchanged since; 'content' if "
+                        "their sizes and a hash of their contents are unchanged. Stages which are re-run cause "
+                        "all stages depending on them to be re-run. [default = %(default)s]")
+    g.add_argument("--persist-minc-headers", dest="persist_minc_headers",
+                   action="store_true", default=False,
+                   help="Save the MINC header information (dimensions, etc.) read by the pipeline to a file "
+                        "in the output directory, so a restarted pipeline needn't read the headers "
+                        "again. [default = %(default)s]")
+    g.add_argument("--no-persist-minc-headers", dest="persist_minc_headers",
+                   action="store_false", help="Opposite of --persist-minc-headers")
+    g.add_argument("--scheduler-snapshot", dest="scheduler_snapshot",
+                   action="store_true", default=False,
+                   help="Periodically save the server's scheduler state (stages, dependencies, memory estimates) "
+                        "to <pipeline-name>_scheduler_snapshot, from which a restarted server (e.g., the next "
+                        "one submitted with --submit-server) resumes instead of rebuilding the pipeline, "
+                        "provided the command and its input files are unchanged. [default = %(default)s]")
+    g.add_argument("--no-scheduler-snapshot", dest="scheduler_snapshot",
+                   action="store_false", help="Opposite of --scheduler-snapshot")
     # TODO instead of prefixing all subdirectories (logs, backups, processed, ...)
     # with the pipeline name/date, we could create one identifying directory
     # and put these other directories inside
@@ -264,6 +293,17 @@ def _mk_execution_parser(p: ArgParser) -> ArgParser:
     group.add_argument("--latency-tolerance", dest="latency_tolerance",
                        type=float, default=600.0,
                        help="Allowed grace period by which an executor may miss a heartbeat tick before being considered failed [Default = %(default)s.")
+    group.add_argument("--handoff", dest="handoff",
+                       action="store_true", default=False,
+                       help="If the server shuts down before the pipeline is complete (e.g., at the end of its walltime), "
+                            "have executors keep running their stages and hand them over to the next server (e.g., the "
+                            "next one submitted with --submit-server) rather than killing them. [Default = %(default)s]")
+    group.add_argument("--no-handoff", dest="handoff",
+                       action="store_false", help="Opposite of --handoff")
+    group.add_argument("--handoff-timeout", dest="handoff_timeout",
+                       type=float, default=3600.0,
+                       help="With --handoff, how long (in seconds) executors wait for the next server "
+                            "before killing their stages. [Default = %(default)s]")
     group.add_argument("--num-executors", dest="num_exec",
                        type=int, default=-1,
                        help="Number of independent executors to launch. [Default = %(default)s. Code will not run without an explicit number specified.]")
@@ -292,6 +332,56 @@ def _mk_execution_parser(p: ArgParser) -> ArgParser:
     group.add_argument("--greedy", dest="greedy",
                        action="store_true",
                        help="Request the full amount of RAM specified by --mem rather than the (lesser) amount needed by runnable jobs.  Always use this if your executor is assigned a full node.")
+    group.add_argument("--executor-size-classes", dest="executor_size_classes",
+                       type=int, default=1,
+                       help="When launching executors, divide the runnable stages into up to this many classes by memory "
+                            "and size each executor for one class (e.g., small executors for many resampling stages and "
+                            "large ones for a few registrations) rather than all for the largest stages; executors "
+                            "take the stages which only they can run first. [Default = %(default)s]")
+    group.add_argument("--autoscale", dest="autoscale",
+                       action="store_true", default=False,
+                       help="Launch executors (up to --num-executors) for the stages expected to be running or runnable "
+                            "by the time they leave the queue, forecast from the stage graph and the stages' expected "
+                            "runtimes, rather than for those runnable now, and tell idle executors which won't be needed "
+                            "before a replacement could arrive to exit at once rather than after --time-to-seppuku. "
+                            "[Default=%(default)s]")
+    group.add_argument("--no-autoscale", dest="autoscale",
+                       action="store_false", help="Opposite of --autoscale")
+    group.add_argument("--queue-wait", dest="queue_wait",
+                       type=float, default=300,
+                       help="Initial estimate of the time (in seconds) an executor waits in the queue before starting, "
+                            "refined as executors register (see --autoscale). [Default = %(default)s]")
+    group.add_argument("--backup-stragglers", dest="backup_stragglers",
+                       action="store_true", default=False,
+                       help="Run a copy of a stage on an idle executor once it has run for longer than most "
+                            "of its peers (the stages running the same tool at the same depth in the pipeline), "
+                            "keeping the outputs of whichever finishes first. "
+                            "Not used with --local-scratch. [Default=%(default)s]")
+    group.add_argument("--no-backup-stragglers", dest="backup_stragglers",
+                       action="store_false", help="Opposite of --backup-stragglers")
+    group.add_argument("--straggler-percentile", dest="straggler_percentile",
+                       type=float, default=90,
+                       help="Percentile of the runtimes of its finished peers beyond which a running stage is "
+                            "copied (see --backup-stragglers). [Default = %(default)s]")
+    group.add_argument("--max-retries", dest="max_retries",
+                       type=int, default=2,
+                       help="Number of times to retry a failed stage (unless its command couldn't be run at all). "
+                            "[Default = %(default)s]")
+    group.add_argument("--retry-delay", dest="retry_delay",
+                       type=float, default=10,
+                       help="Time (in seconds) to wait before retrying a failed stage, doubling with each further "
+                            "attempt. [Default = %(default)s]")
+    group.add_argument("--oom-mem-factor", dest="oom_mem_factor",
+                       type=float, default=1.5,
+                       help="Factor by which to increase the memory requested for a stage which (probably) ran out "
+                            "of memory -- was killed by SIGKILL or used nearly all it requested -- when retrying it "
+                            "(up to --mem). [Default = %(default)s]")
+    group.add_argument("--retry-policy", dest="retry_policy",
+                       type=parse_retry_policy, action="append", default=[],
+                       metavar="TOOL:FIELD=VALUE[,FIELD=VALUE...]",
+                       help="Override the retry policy for stages running the given tool; the fields are "
+                            "max_retries, delay, backoff (the factor by which the delay grows), max_delay and "
+                            "mem_factor, e.g., mincANTS:max_retries=4,mem_factor=2. May be repeated.")
     group.add_argument("--ppn", dest="ppn",
                        type=int, default=8,
                        help="Number of processes per node. Used when --queue-type=pbs. [Default = %(default)s].")
@@ -332,6 +422,39 @@ def _mk_execution_parser(p: ArgParser) -> ArgParser:
                        help="Overall factor by which to scale all memory estimates/requests (including default job memory, "
                             "but not executor totals (--mem)), say due to system differences or overcommitted nodes. "
                             "[Default=%(default)s]")
+    group.add_argument("--stage-history", dest="stage_history",
+                       type=str, default=None,
+                       help="SQLite file in which to record the runtime and peak memory of finished stages, "
+                            "and from which to estimate those of new stages (replacing the built-in memory estimates "
+                            "once a tool has run a few times); may be shared between pipelines. [Default=%(default)s]")
+    group.add_argument("--gc-intermediates", dest="gc_intermediates",
+                       action="store_true", default=False,
+                       help="Delete intermediate files (those written by one stage and read by others which are in 'tmp' "
+                            "subdirectories or were marked temporary) once all the stages reading them have finished. "
+                            "On restart, stages are re-run as needed to re-create deleted files. [Default=%(default)s]")
+    group.add_argument("--no-gc-intermediates", dest="gc_intermediates",
+                       action="store_false", help="Opposite of --gc-intermediates")
+    group.add_argument("--local-scratch", dest="local_scratch",
+                       type=str, default=None,
+                       help="Node-local directory in which executors keep intermediate files (as for --gc-intermediates) "
+                            "rather than writing them to the output directory; stages are preferably run by the executor "
+                            "holding their inputs, which otherwise copies them to the output directory. [Default=%(default)s]")
+    group.add_argument("--artifact-cache", dest="artifact_cache",
+                       type=str, default=None,
+                       help="Directory of a store of stages' outputs, shared between pipelines (see artifact_cache.py): "
+                            "a stage which has been run before with the same command and identical inputs isn't run "
+                            "again, its outputs being restored from the store instead. [Default=%(default)s]")
+    group.add_argument("--artifact-cache-size", dest="artifact_cache_size",
+                       type=float, default=None,
+                       help="At the end of the pipeline, evict the least recently used entries from the artifact cache "
+                            "until it takes up at most this many GB. [Default = no limit]")
+    group.add_argument("--fuse-stages", dest="fuse_stages",
+                       action="store_true", default=False,
+                       help="Send chains of stages, each the only one reading the outputs of the one before (e.g., "
+                            "blurring an image and then registering it), to an executor together, to be run one after "
+                            "another in a single job, rather than in a round trip to the server each. [Default=%(default)s]")
+    group.add_argument("--no-fuse-stages", dest="fuse_stages",
+                       action="store_false", help="Opposite of --fuse-stages")
     group.add_argument("--cmd-wrapper", dest="cmd_wrapper",
                        type=str, default="",
                        help="Wrapper inside of which to run the command, e.g., '/usr/bin/time -v'. [Default='%(default)s']")
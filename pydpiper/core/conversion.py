@@ -1,14 +1,17 @@
 from pydpiper.execution.pipeline import CmdStage, InputFile, OutputFile
 
 def convertCmdStage(cmd_stage):
+    # the new-style stages stay alive while the pipeline runs, so share their strings
+    # (and command array) rather than copying them
     c = CmdStage([])
     c.inputFiles  = [x.path for x in cmd_stage.inputs]
     c.outputFiles = [x.path for x in cmd_stage.outputs]
+    c.temporary_outputs = tuple(x.path for x in cmd_stage.outputs if x.temporary)
     c.cmd  = cmd_stage.to_array()
     c.mem  = cmd_stage.memory
     c.procs = cmd_stage.procs
+    c.priority = cmd_stage.priority
     c.name = c.cmd[0]
-    c.checkLogFile()
     c._runnable_hooks = cmd_stage.when_runnable_hooks
     c.finished_hooks = cmd_stage.when_finished_hooks
     c.logFile = cmd_stage.log_file
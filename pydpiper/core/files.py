@@ -43,9 +43,15 @@ class FileAtom(object):
                             unchanged by the new file.  If `output_sub_dir` is not provided when constructing
                             a FileAtom, its filename_wo_ext is used; for instance,
                             if the filename is "relative/img_1.mnc", the output_sub_dir becomes "img_1/".
+    Files written by the pipeline can also be marked as temporary (e.g., `f._replace(temporary=True)`),
+    in which case they're treated like the files in 'tmp' subdirectories: with --gc-intermediates,
+    they're deleted once all the stages reading them have finished.  Files derived from a temporary
+    file aren't temporary.
     """
     # TODO this documentation should still be more clear and explain why you'd want to use these features/fields
-    
+
+    temporary = False
+
     def __init__(self,
                  name             : str,
                  orig_name        : Union[str, None, NotProvided] = NotProvided(),
@@ -130,6 +136,7 @@ class FileAtom(object):
         fa.dir = new_dir
         fa.ext = ext or self.ext
         fa.filename_wo_ext = filename_wo_ext
+        fa.temporary = False
         return fa
 
     def newname_with_suffix(self,
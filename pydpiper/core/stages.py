@@ -7,6 +7,10 @@ from typing import Any, Callable, Generic, Iterable, List, Set, Tuple, TypeVar,
 from pydpiper.core.files import FileAtom
 from pydpiper.execution.pipeline import PipelineFile, InputFile, OutputFile
 
+# computed priorities are positive, so a stage with this priority only runs when nothing else fits;
+# useful for leaves of the pipeline (e.g., QC images) which no other stages are waiting for
+LOWEST_PRIORITY = 0.0
+
 class CmdStage(object):
     """A simplified command stage - one could write a simple conversion
     function or simply adopt the old one.  I prefer separating static
@@ -21,7 +25,10 @@ class CmdStage(object):
                  outputs : Tuple[FileAtom, ...],
                  cmd     : List[str],
                  memory  : float = None,
-                 procs   : int = 1) -> None:
+                 procs   : int = 1,
+                 # overrides the scheduling priority the server computes from the stage's position
+                 # in the pipeline (higher runs sooner); see LOWEST_PRIORITY
+                 priority : float = None) -> None:
         # TODO: rather than having separate cmd_stage fn, might want to make inputs/outputs optional here
         self.inputs  = inputs          # type: Tuple[FileAtom, ...]
         # TODO: might be better to dereference inputs -> inputs.path here to save mem
@@ -34,6 +41,7 @@ class CmdStage(object):
         self.when_finished_hooks = []  # type: List[Callable[[], Any]]
         self.memory = memory
         self.procs = procs
+        self.priority = priority
         # some cosmetics: we would like the log files to reside in the "log" subdirectory. For most mincAtoms, we can
         # access this directory by using its "dir" and adding "../log". This is not true for files that live in the
         # _nlin or _lsq12 directories though. They live in their own top level directory, so we should just create
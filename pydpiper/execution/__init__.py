@@ -1,2 +1,2 @@
-__all__ = ["pipeline", "pipeline_executor", "queueing", "file_handling", "application"]
-
+__all__ = ["pipeline", "pipeline_executor", "queueing", "file_handling", "application", "scheduling", "history", "restart", "journal", "graph",
+           "hooks", "snapshot", "handoff", "intermediates", "scratch", "artifact_cache", "autoscaling", "stragglers", "retries"]
@@ -8,16 +8,18 @@ import sys
 import shutil
 import time
 
-from typing import NamedTuple, List, Callable, Any
+from typing import NamedTuple, Dict, List, Callable, Any
 
-from pydpiper.core.stages import Result
+from pydpiper.core.stages import Result, Stages
 from pydpiper.core.arguments import (CompoundParser, AnnotatedParser, application_parser,
                                      registration_parser, execution_parser, parse)
 from pydpiper.execution.pipeline import Pipeline, pipelineDaemon
+from pydpiper.execution.snapshot import definition_key
 from pydpiper.execution.queueing import runOnQueueingSystem
 from pydpiper.execution.pipeline_executor import ensure_exec_specified
 from pydpiper.core.util import output_directories
 from pydpiper.core.conversion import convertCmdStage
+from pydpiper.minc.headers import header_cache
 
 PYDPIPER_VERSION = pkg_resources.get_distribution("pydpiper").version  # pylint: disable=E1101
 
@@ -32,15 +34,34 @@ ExecutionConf = NamedTuple('ExecutionConf', [('use_backup_files', bool),
 def output_dir(options):
     return options.application.output_directory if options.application.output_directory else os.getcwd()
 
-def write_stages(stages, name):
-    """
-    writes all pipeline stages to a file
-    """
-    with open(os.path.join(os.curdir, "%s_pipeline_stages.txt" % name), 'w') as pf:
-        for i, stage in enumerate(stages):
-            # TODO indices of this enumeration only correspond to stage numbers by "coincidence"
-            # (a similar iteration is performed elsewhere with the same results) but this is sort of silly/dangerous
-            pf.write(str(i) + "\t" + str(stage.render()) + "\n")
+
+def persist_minc_headers(options):
+    """If requested, load the MINC headers cached by a previous run of this pipeline and save new ones."""
+    if options.application.persist_minc_headers:
+        header_cache.persist(os.path.join(output_dir(options),
+                                          "%s_minc_headers.jsonl" % options.application.pipeline_name))
+
+def scheduler_snapshot(options):
+    """The location of the pipeline's scheduler snapshot and the key of its definition (see snapshot.py),
+    or None if snapshots weren't requested."""
+    if not options.application.scheduler_snapshot:
+        return None
+    return (os.path.join(os.getcwd(), "%s_scheduler_snapshot" % options.application.pipeline_name),
+            definition_key(sys.argv, PYDPIPER_VERSION))
+
+
+def resume_pipeline(options):
+    """The pipeline as saved in its scheduler snapshot by a previous server, if it can be resumed from there
+    (i.e., if snapshots were requested and this is a restart of the same pipeline); otherwise None."""
+    snapshot = scheduler_snapshot(options)
+    if snapshot is None or not options.application.restart or not options.application.execute:
+        return None
+    path, key = snapshot
+    pipeline = Pipeline.from_snapshot(path, key, options)
+    if pipeline is not None:
+        print("Resuming pipeline from scheduler snapshot %s" % path)
+    return pipeline
+
 
 def file_graph(stages, pipeline_dir):
     # TODO remove pipeline_dir from node pathnames
@@ -59,62 +80,76 @@ def file_graph(stages, pipeline_dir):
     # need to use something like nx.to_pydot to convert
 
 
-def ensure_short_output_paths(stages, max_len=255):  # magic no. for EXT3, EXT4, NFS (?), Linux NAME_MAX, etc.
-    # N.B. - at some point we had 245 instead of 255 -- a typo, a program-specific buffer size,
-    # or something to do with one of the file systems (NFS, SciNet's IBM GPFS, etc. ...)?
-    # TODO check the other parts of the path aren't too long either (much less likely)?
-    for s in stages:
-        for o in [o.filename_wo_ext for o in s.outputs] + [os.path.basename(s.log_file)]:
-            if len(o) > max_len:
-                raise ValueError("output filename '%s' too long (more than %s chars)" % (o, max_len))
-
-
-def ensure_output_paths_in_dir(stages, d):
-    # TODO also check the logfiles ... should these be counted as stage outputs (tedious to add by hand ...)?
-    for s in stages:
-        for o in s.outputs:
-            if os.path.relpath(o.path, d).startswith('..'):
-                raise ValueError("output %s of stage %s not contained inside "
-                                 "pipeline directory %s" % (o.path, s, d))
+# magic no. for EXT3, EXT4, NFS (?), Linux NAME_MAX, etc.
+# N.B. - at some point we had 245 instead of 255 -- a typo, a program-specific buffer size,
+# or something to do with one of the file systems (NFS, SciNet's IBM GPFS, etc. ...)?
+MAX_FILENAME_LENGTH = 255
 
 
-# TODO: where should this live - util?
-# TODO: write some tests to check that this might be working
-# TODO: could generalize to '(non)distinctOn' but nobody would ever use ...
-def nondistinct_outputs(stages):
+def convert_and_check_stages(stages, pipeline_name, pipeline_dir, max_len=MAX_FILENAME_LENGTH):
     """
-    TODO: move this doctest to a proper test in test/
-    >>> c1 = CmdStage(argArray=["touch", OutputFile("/tmp/foo.txt")])
-    >>> c2 = CmdStage(argArray=[">",     OutputFile("/tmp/foo.txt")])
-    >>> nondistinct_outputs([c1, c2]) == { '/tmp/foo.txt' : set([c1,c2]) }
-    True
+    In a single pass over the stages, convert them to the server's representation, write them
+    to <pipeline_name>_pipeline_stages.txt, and check that
+      - output filenames (and log filenames) aren't too long,
+      - outputs are inside the pipeline directory,
+      - no file is an output of more than one (distinct) stage, and
+      - the commands exist.
+    Returns the converted stages and a list of the problems found (as ValueErrors) rather
+    than raising immediately, since for debugging it's best to write out the stages,
+    draw the graph, etc., first; see `ensure_no_problems`.
     """
-    m = ((o, s) for s in stages for o in s.outputFiles)
-    d = defaultdict(set)
-    for o, s in m:
-        d[o].add(s)
-    bad_outputs = { o : ss for o, ss in d.items() if len(ss) > 1 }
-    return bad_outputs
-
-
-def ensure_distinct_outputs(stages):
-    # TODO logfiles as well? (see comment in `ensure_output_paths_in_dir`)
-    bad_outputs = nondistinct_outputs(stages)
-    if len(bad_outputs) >= 1:
+    converted = []
+    too_long, outside_dir = [], []
+    producers = {}  # output -> first stage producing it
+    conflicts = defaultdict(list)  # type: Dict[str, list]
+    cmds = set()
+    with open(os.path.join(os.curdir, "%s_pipeline_stages.txt" % pipeline_name), 'w') as pf:
+        for i, s in enumerate(stages):
+            # TODO indices of this enumeration only correspond to stage numbers by "coincidence"
+            # (a similar iteration is performed elsewhere with the same results) but this is sort of silly/dangerous
+            pf.write(str(i) + "\t" + str(s.render()) + "\n")
+            c = convertCmdStage(s)
+            converted.append(c)
+            cmds.add(c.cmd[0])
+            # TODO check the other parts of the path aren't too long either (much less likely)?
+            # TODO also check the logfiles are in the pipeline directory ... should these be counted as
+            # stage outputs (tedious to add by hand ...)?
+            too_long.extend(f for f in [o.filename_wo_ext for o in s.outputs] + [os.path.basename(s.log_file)]
+                            if len(f) > max_len)
+            for o in s.outputs:
+                if os.path.relpath(o.path, pipeline_dir).startswith('..'):
+                    outside_dir.append((o.path, s))
+                producer = producers.setdefault(o.path, c)
+                if producer != c:
+                    if not conflicts[o.path]:
+                        conflicts[o.path].append(producer)
+                    if c not in conflicts[o.path]:
+                        conflicts[o.path].append(c)
+
+    problems = []  # type: List[ValueError]
+    problems.extend(ValueError("output filename '%s' too long (more than %s chars)" % (f, max_len))
+                    for f in too_long)
+    problems.extend(ValueError("output %s of stage %s not contained inside pipeline directory %s"
+                               % (o, s, pipeline_dir)) for o, s in outside_dir)
+    if conflicts:
         print("Uh-oh - some files appear as outputs of multiple stages, to wit:", file=sys.stderr)
-        for o, ss in bad_outputs.items():
+        for o, ss in conflicts.items():
             print("output: %s\nstages:\n" % o, file=sys.stderr)
-            for s in ss:
-                print("%s\n" % s, file=sys.stderr)
+            for c in ss:
+                print("%s\n" % c, file=sys.stderr)
             print("\n", file=sys.stderr)
-        raise ValueError("Conflicting outputs:", bad_outputs)
-
-
-def ensure_commands_exist(stages):
-    cmds = set((s.to_array()[0] for s in stages))
+        problems.append(ValueError("Conflicting outputs:", { o : set(ss) for o, ss in conflicts.items() }))
     bad_cmds = [cmd for cmd in cmds if shutil.which(cmd) is None]
     if len(bad_cmds) > 0:
-        raise ValueError("Missing executables: %s" % bad_cmds)
+        problems.append(ValueError("Missing executables: %s" % bad_cmds))
+    return converted, problems
+
+
+def ensure_no_problems(problems):
+    for p in problems[1:]:
+        print("Error: %s" % p, file=sys.stderr)
+    if problems:
+        raise problems[0]
 
 
 #TODO: change this to ...(static_pipeline, options)?
@@ -122,33 +157,42 @@ def execute(stages, options):
     """Basically just looks at the arguments and exits if `--no-execute` is specified,
     otherwise dispatches on backend type."""
 
+    converted_stages, problems = convert_and_check_stages(stages,
+                                                          pipeline_name=options.application.pipeline_name,
+                                                          pipeline_dir=options.application.output_directory)
+
     # TODO: logger.info('Constructing pipeline...')
-    pipeline = Pipeline(stages=[convertCmdStage(s) for s in stages],
-                        options=options)
+    pipeline = Pipeline(stages=converted_stages, options=options)
+    del converted_stages  # the pipeline may drop duplicates
 
     # TODO: print/log version
     reconstruct_command(options)
 
-    write_stages(stages, options.application.pipeline_name)
-
     if options.application.create_graph:
         # TODO: these could have more descriptive names ...
         logger.debug("Writing dot file...")
-        nx.drawing.nx_agraph.write_dot(pipeline.G, str(options.application.pipeline_name) + "_labeled-tree.dot")
+        nx.drawing.nx_agraph.write_dot(pipeline.networkx_graph(), str(options.application.pipeline_name) + "_labeled-tree.dot")
         nx.drawing.nx_agraph.write_dot(file_graph(stages, options.application.output_directory),
                                        str(options.application.pipeline_name) + "_labeled-tree-alternate.dot")
         logger.debug("Done.")
 
     # for debugging reasons, it's best if these come after writing stages, drawing graph, ...
-    ensure_short_output_paths(stages)  # TODO convert to new `CmdStage`s
-    ensure_output_paths_in_dir(stages, options.application.output_directory)
-    ensure_distinct_outputs([convertCmdStage(s) for s in stages])
-    ensure_commands_exist(stages)
+    ensure_no_problems(problems)
 
     if not options.application.execute:
         print("Not executing the command (--no-execute is specified).\nDone.")
         return
 
+    snapshot = scheduler_snapshot(options)
+    # (a server submitted to the grid is run with a different command, so must make its own snapshot)
+    if snapshot is not None and backend(options) is normal_execute:
+        pipeline.snapshot_path, pipeline.definition_key = snapshot
+        pipeline.write_snapshot()
+
+    run_pipeline(pipeline, options)
+
+
+def run_pipeline(pipeline, options):
     # TODO: why is this needed now that --version is also handled automatically?
     # --num-executors=0 (<=> --no-execute) could be the default, and you could
     # also refuse to submit scripts for 0 executors ...
@@ -161,6 +205,18 @@ def execute(stages, options):
     execution_proc(pipeline, options)
 
 
+def resume_or_execute(options, stages: Callable[[], Stages]) -> None:
+    """Resume the pipeline from its scheduler snapshot if possible (see `resume_pipeline`), so as not to
+    construct its stages again, or else construct them (by calling `stages`) and execute them."""
+    # before the pipeline checks its input files (and its memory hooks read MINC headers)
+    persist_minc_headers(options)
+    resumed = resume_pipeline(options)
+    if resumed is not None:
+        run_pipeline(resumed, options)
+    else:
+        execute(stages(), options)
+
+
 def mk_application(parsers: List[AnnotatedParser], pipeline: Callable[[Any], Result[Any]]) -> Callable[[], Any]:
     """Wire up a pure-python pipeline application into a command-line application."""
     # TODO the type isn't very precise ...
@@ -170,7 +226,7 @@ def mk_application(parsers: List[AnnotatedParser], pipeline: Callable[[Any], Res
                         ] + parsers)
     def f():
         options = parse(p, sys.argv[1:])
-        execute(pipeline(options).stages, options)
+        resume_or_execute(options, lambda: pipeline(options).stages)
     return f
 
 
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+"""A content-addressed store of stages' outputs (see --artifact-cache), shared between pipelines, so
+that stages run before -- registering the same scans to the same atlases, blurring the same initial
+model, etc. -- needn't be run again.
+
+Outputs are stored by the SHA-256 of their contents under `objects/`, and a stage's entry, under
+`entries/`, lists the objects making up its outputs.  Entries are keyed by the stage's command template
+(its command with the paths of its inputs and outputs replaced by placeholders, so that it doesn't
+depend on where a pipeline keeps its files) and the contents of its inputs.  A transform (.xfm) may refer
+to grid files beside it, which registration stages don't declare; these count as part of the transform,
+both in the key of a stage reading it and in the entry of a stage writing it.  The store consists only of
+files written atomically, so may be shared (e.g., over NFS) by several pipelines at once; an entry's
+modification time records when it was last used, and the least recently used entries are evicted
+when the store grows beyond a given size (see `prune`, also run from the command line)."""
+
+import argparse
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import stat
+import sys
+import time
+
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# (from linux/fs.h) clone a file's contents copy-on-write, on filesystems which support it
+FICLONE = 0x40049409
+# objects not referred to by any entry are only removed once they're this old (in seconds),
+# since a stage may still be publishing them
+ORPHAN_GRACE_PERIOD = 3600
+CHUNK_BYTES = 1 << 20
+# (how an .xfm refers to the grid file of a nonlinear transform)
+XFM_GRID = re.compile(r'Displacement_Volume\s*=\s*([^;]+);')
+
+
+def command_template(cmd: List[str], inputs: List[str], outputs: List[str]) -> List[str]:
+    """The command with the paths of its inputs and outputs replaced by placeholders.
+    >>> command_template(["mincblur", "-fwhm", "0.5", "/a/in.mnc", "/a/tmp/out"], ["/a/in.mnc"], ["/a/tmp/out"])
+    ['mincblur', '-fwhm', '0.5', '{in0}', '{out0}']
+    """
+    names = dict([(f, "{in%d}" % k) for k, f in enumerate(inputs)] + [(f, "{out%d}" % k) for k, f in enumerate(outputs)])
+    if not names:
+        return list(cmd)
+    # (in one pass, longest first, so a path isn't replaced within another)
+    pattern = re.compile('|'.join(re.escape(f) for f in sorted(names, key=len, reverse=True)))
+    return [pattern.sub(lambda m: names[m.group(0)], a) for a in cmd]
+
+
+def referenced_files(path: str) -> List[str]:
+    """The files (as written, so usually relative to its directory) to which a transform refers, if `path`
+    is an .xfm, e.g., the grids of a nonlinear transform (raises if it can't be read)."""
+    if not path.endswith(".xfm"):
+        return []
+    with open(path) as f:
+        return [m.group(1).strip().strip('"') for m in XFM_GRID.finditer(f.read())]
+
+
+def entry_objects(entry: dict) -> List[Tuple[str, int]]:
+    """The (digest, size) pairs of all the objects making up an entry's outputs."""
+    return ([(d, size) for d, size in entry['outputs']]
+            + [(d, size) for _k, _name, d, size in entry.get('referenced', [])])
+
+
+def clone_file(src: str, dst: str) -> None:
+    """Copy `src` to `dst`, sharing the data copy-on-write (a 'reflink') where the filesystem allows."""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            shutil.copyfileobj(fsrc, fdst, CHUNK_BYTES)
+    shutil.copystat(src, dst)
+
+
+class ArtifactCache(object):
+    def __init__(self, root: str) -> None:
+        self.root = root
+        # digests of files already hashed, by (path, size, mtime, inode)
+        self._digests = {}  # type: Dict[Tuple[str, int, int, int], str]
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.root, "entries", key[:2], key + ".json")
+
+    def file_digest(self, path: str) -> str:
+        st = os.stat(path)
+        memo = (path, st.st_size, st.st_mtime_ns, st.st_ino)
+        if memo not in self._digests:
+            h = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_BYTES), b''):
+                    h.update(chunk)
+            self._digests[memo] = h.hexdigest()
+        return self._digests[memo]
+
+    def stage_key(self, cmd: List[str], inputs: List[str], outputs: List[str]) -> str:
+        """The key of a stage's entry (raises if an input doesn't exist)."""
+        key = dict(command=command_template(cmd, inputs, outputs), inputs=[self.file_digest(f) for f in inputs])
+        referenced = [self.file_digest(os.path.join(os.path.dirname(f), name))
+                      for f in inputs for name in referenced_files(f)]
+        if referenced:
+            key['referenced'] = referenced
+        h = hashlib.sha256(json.dumps(key).encode())
+        return h.hexdigest()
+
+    def lookup(self, key: str) -> Optional[dict]:
+        """The entry of the stage with the given key, if the store has all its outputs."""
+        try:
+            with open(self.entry_path(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not all(os.path.exists(self.object_path(d)) for d, _size in entry_objects(entry)):
+            return None
+        try:
+            os.utime(self.entry_path(key))  # (it's been used)
+        except OSError:
+            pass
+        return entry
+
+    def restore(self, key: str, outputs: List[str]) -> bool:
+        """Put the stored outputs of the stage with the given key in place (as hard links to the store's
+        read-only objects, or else copies) and return True, or return False if they aren't stored."""
+        entry = self.lookup(key)
+        if entry is None or len(entry['outputs']) != len(outputs):
+            self.detach(outputs)
+            return False
+        # (the files a transform refers to first, so it's never in place without them)
+        for k, name, digest, _size in entry.get('referenced', []):
+            self.place(digest, os.path.join(os.path.dirname(outputs[k]), name))
+        for (digest, _size), out in zip(entry['outputs'], outputs):
+            self.place(digest, out)
+        return True
+
+    def place(self, digest: str, out: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+        tmp = out + ".restoring" + str(os.getpid())
+        try:
+            os.link(self.object_path(digest), tmp)
+        except OSError:
+            clone_file(self.object_path(digest), tmp)
+            os.chmod(tmp, stat.S_IMODE(os.stat(tmp).st_mode) | stat.S_IWUSR)
+        os.replace(tmp, out)
+
+    @staticmethod
+    def detach(outputs: List[str]) -> None:
+        """Remove any of the given (stage's) outputs which are links into a store, so that
+        running the stage doesn't write to the store's objects (which are read-only in any case),
+        along with the files any such transforms refer to."""
+        referenced = []
+        for out in outputs:
+            try:
+                referenced.extend(os.path.join(os.path.dirname(out), name) for name in referenced_files(out))
+            except OSError:
+                continue
+        for out in referenced + list(outputs):
+            try:
+                st = os.stat(out)
+            except OSError:
+                continue
+            if st.st_nlink > 1 and not st.st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+                os.remove(out)
+
+    def publish(self, key: str, cmd: List[str], outputs: List[str]) -> None:
+        """Add the outputs of a stage which has just run (with the given key) to the store."""
+        if os.path.exists(self.entry_path(key)):
+            os.utime(self.entry_path(key))
+            return
+        referenced = []
+        for k, out in enumerate(outputs):
+            if not os.path.isfile(out):
+                logger.debug("Not storing the outputs of a stage with a missing or non-file output %s", out)
+                return
+            for name in referenced_files(out):
+                # (a transform referring to a file elsewhere wouldn't refer to its restored copy)
+                if os.path.isabs(name) or os.path.dirname(os.path.normpath(name)) != "":
+                    logger.debug("Not storing the outputs of a stage whose transform %s refers to %s", out, name)
+                    return
+                path = os.path.join(os.path.dirname(out), name)
+                if not os.path.isfile(path):
+                    logger.debug("Not storing the outputs of a stage with a missing grid file %s", path)
+                    return
+                referenced.append((k, name, path))
+        entry = dict(tool=os.path.basename(cmd[0]), outputs=[self.store(out) for out in outputs], created=time.time())
+        if referenced:
+            entry['referenced'] = [(k, name) + self.store(path) for k, name, path in referenced]
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp" + str(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, path)
+
+    def store(self, path: str) -> Tuple[str, int]:
+        """Add the file to the store's objects, returning its digest and size."""
+        digest = self.file_digest(path)
+        obj = self.object_path(digest)
+        if not os.path.exists(obj):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            tmp = obj + ".tmp" + str(os.getpid())
+            clone_file(path, tmp)
+            os.chmod(tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(tmp, obj)
+        return digest, os.path.getsize(obj)
+
+    def entries(self) -> List[Tuple[str, float, dict]]:
+        """The (key, time last used, entry) triples of the stored entries, most recently used first."""
+        result = []
+        for d, _, files in os.walk(os.path.join(self.root, "entries")):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(d, name)
+                try:
+                    last_used = os.stat(path).st_mtime
+                    with open(path) as f:
+                        result.append((name[:-len(".json")], last_used, json.load(f)))
+                except (OSError, ValueError):
+                    continue
+        return sorted(result, key=lambda e: -e[1])
+
+    def objects(self) -> Dict[str, Tuple[str, os.stat_result]]:
+        """The (path, stat) pairs of the stored objects (and any being written), by file name."""
+        result = {}
+        for d, _, files in os.walk(os.path.join(self.root, "objects")):
+            for name in files:
+                path = os.path.join(d, name)
+                try:
+                    result[name] = (path, os.stat(path))
+                except OSError:
+                    continue
+        return result
+
+    def prune(self, max_bytes: Optional[float] = None, max_age: Optional[float] = None) -> Tuple[int, int]:
+        """Evict the least recently used entries until the objects the remaining ones use take up at most
+        `max_bytes`, as well as any not used in the last `max_age` seconds, and remove the objects no
+        longer used.  Returns the numbers of entries evicted and bytes freed."""
+        now = time.time()
+        objects = self.objects()
+        kept, evicted_objects, used, evicted = set(), set(), 0, 0
+        for key, last_used, entry in self.entries():
+            digests = {d for d, _size in entry_objects(entry)}
+            size = sum(objects[d][1].st_size for d in digests - kept if d in objects)
+            if ((max_bytes is not None and used + size > max_bytes)
+                    or (max_age is not None and now - last_used > max_age)):
+                try:
+                    os.remove(self.entry_path(key))
+                except FileNotFoundError:
+                    pass
+                evicted += 1
+                evicted_objects.update(digests)
+            else:
+                kept.update(digests)
+                used += size
+        freed = 0
+        for name, (path, st) in objects.items():
+            if name not in kept and (name in evicted_objects or now - st.st_mtime > ORPHAN_GRACE_PERIOD):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                freed += st.st_size
+        logger.info("Evicted %d entries from the artifact cache, freeing %.2fG", evicted, freed / 2**30)
+        return evicted, freed
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Inspect and prune a pydpiper artifact cache (see --artifact-cache).")
+    parser.add_argument("cache", type=str, help="the cache directory")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("stats", help="show the number and total size of entries and objects")
+    ls = commands.add_parser("list", help="list entries, most recently used first")
+    ls.add_argument("--limit", type=int, default=None, help="list at most this many entries")
+    prune = commands.add_parser("prune", help="evict least recently used entries")
+    prune.add_argument("--max-size", dest="max_size", type=float, default=None,
+                       help="evict entries until the cache takes up at most this many GB")
+    prune.add_argument("--older-than", dest="older_than", type=float, default=None,
+                       help="evict entries not used for this many days")
+    commands.add_parser("clear", help="evict all entries")
+    options = parser.parse_args(args)
+
+    cache = ArtifactCache(options.cache)
+    if options.command == "list":
+        for key, last_used, entry in cache.entries()[:options.limit]:
+            print("%s  %s  %-20s %d outputs, %.1fM" % (key[:16], time.strftime("%Y-%m-%d %H:%M", time.localtime(last_used)),
+                                                      entry.get('tool', '?'), len(entry['outputs']),
+                                                      sum(size for _d, size in entry_objects(entry)) / 2**20))
+    elif options.command == "prune":
+        if options.max_size is None and options.older_than is None:
+            parser.error("prune needs --max-size and/or --older-than")
+        evicted, freed = cache.prune(max_bytes=None if options.max_size is None else options.max_size * 2**30,
+                                     max_age=None if options.older_than is None else options.older_than * 86400)
+        print("Evicted %d entries, freeing %.2fG" % (evicted, freed / 2**30))
+    elif options.command == "clear":
+        evicted, freed = cache.prune(max_bytes=0)
+        print("Evicted %d entries, freeing %.2fG" % (evicted, freed / 2**30))
+    else:
+        entries, objects = cache.entries(), cache.objects()
+        print("Entries: %d" % len(entries))
+        print("Objects: %d (%.2fG)" % (len(objects), sum(st.st_size for _path, st in objects.values()) / 2**30))
+        if entries:
+            print("Least recently used: %s" % time.ctime(entries[-1][1]))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+"""Sizing the set of executors the server launches to the work expected in the near future (see --autoscale),
+rather than to the number of stages runnable right now.
+
+Executors launched now only start working once the queueing system has run them, so the server forecasts
+(see `scheduling.forecast_demand`) how many stages will be running or waiting to run by then, given the
+stage graph and the stages' expected runtimes, and launches executors for that many.  Conversely, an idle
+executor is only kept if the forecast says it'll be needed before a replacement could arrive; otherwise
+the server tells it to exit at once rather than letting it sit idle for --time-to-seppuku minutes.
+The time executors spend in the queue is learned from how long those launched take to register."""
+
+import logging
+import time
+
+from collections import deque
+from typing import List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# weight of the most recently observed queue wait in the running estimate
+QUEUE_WAIT_SMOOTHING = 0.3
+
+
+class Autoscaler(object):
+    """The server's state for autoscaling: its estimate of the queue wait, when the executors it's still
+    waiting for were launched, and how many executors to launch or keep as of the last forecast."""
+    def __init__(self, queue_wait: float) -> None:
+        # expected time (in seconds) from launching an executor until it registers
+        self.queue_wait = queue_wait
+        self.launch_times = deque()  # type: deque
+        # executors told to exit which haven't yet unregistered
+        self.retiring = set()  # type: Set[str]
+        # executors to launch and idle executors to tell to exit, as of the last forecast
+        self.to_launch = 0
+        self.surplus = 0
+        # the stages forecast to become runnable before executors launched now could be done with them
+        self.forecast_stages = []  # type: List[int]
+
+    @property
+    def horizon(self) -> float:
+        """How far ahead to look: executors launched now arrive after the queue wait, and should then
+        have work for about as long again (or an idle executor would be better replaced later)."""
+        return 2 * self.queue_wait
+
+    def launched(self, number: int, t: Optional[float] = None) -> None:
+        t = time.time() if t is None else t
+        self.launch_times.extend([t] * number)
+
+    def registered(self, t: Optional[float] = None) -> None:
+        """Learn from the registration of an executor (assumed to be the one launched longest ago, if any
+        is outstanding; executors started by hand tell us nothing about the queue)."""
+        if not self.launch_times:
+            return
+        t = time.time() if t is None else t
+        wait = t - self.launch_times.popleft()
+        self.queue_wait += QUEUE_WAIT_SMOOTHING * (wait - self.queue_wait)
+        logger.debug("Executor registered after %.1f s in the queue; expected queue wait now %.1f s",
+                     wait, self.queue_wait)
+
+    def plan(self, demand_on_arrival: int, demand_until_replaced: int, active: int, max_executors: int) -> None:
+        """Decide, given the forecast demand once executors launched now have arrived and until then
+        (as numbers of stages, each of which is assumed to occupy an executor), how many executors to
+        launch and how many idle ones to let go, with `active` executors registered or queued."""
+        self.to_launch = max(min(demand_on_arrival, max_executors) - active, 0)
+        self.surplus = max(active - max(demand_on_arrival, demand_until_replaced), 0)
+        if self.to_launch or self.surplus:
+            logger.debug("Autoscaling: %d active executors, forecast demand %d/%d; launching %d, releasing %d",
+                         active, demand_until_replaced, demand_on_arrival, self.to_launch, self.surplus)
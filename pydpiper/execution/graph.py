@@ -0,0 +1,111 @@
+"""A compact, immutable representation of the pipeline's stage dependency graph."""
+
+from array import array
+
+from typing import Dict, Iterable, List
+
+
+class StageGraph(object):
+    """A DAG on the nodes 0 .. n-1, stored as CSR-style (compressed sparse row) int arrays:
+    the predecessors of node i are `_preds[_pred_offsets[i]:_pred_offsets[i+1]]`, and
+    similarly for successors.  This takes a few bytes per edge, where a networkx DiGraph
+    takes a few hundred (a dict entry and attribute dict per edge, in each direction).
+
+    Supports the subset of the networkx DiGraph interface used by the pipeline.
+    >>> G = StageGraph([[], [0], [0, 1], [2]])
+    >>> G.successors(0), G.predecessors(2)
+    ([1, 2], [0, 1])
+    >>> G.topological_sort()
+    [0, 1, 2, 3]
+    >>> G.dfs_successors(1)
+    {1: [2], 2: [3]}
+    """
+    __slots__ = ['_pred_offsets', '_preds', '_succ_offsets', '_succs']
+
+    def __init__(self, predecessors: Iterable[Iterable[int]]) -> None:
+        """`predecessors` lists, for each node in order, its (distinct) predecessors."""
+        self._pred_offsets = array('i', [0])
+        self._preds = array('i')
+        for ps in predecessors:
+            self._preds.extend(ps)
+            self._pred_offsets.append(len(self._preds))
+        n = len(self._pred_offsets) - 1
+        # the successor arrays are the transpose, built by counting sort
+        counts = array('i', [0]) * (n + 1)
+        for p in self._preds:
+            counts[p + 1] += 1
+        for i in range(n):
+            counts[i + 1] += counts[i]
+        self._succ_offsets = array('i', counts)
+        self._succs = array('i', [0]) * len(self._preds)
+        for v in range(n):
+            for k in range(self._pred_offsets[v], self._pred_offsets[v + 1]):
+                u = self._preds[k]
+                self._succs[counts[u]] = v
+                counts[u] += 1
+
+    def order(self) -> int:
+        return len(self._pred_offsets) - 1
+
+    __len__ = order
+
+    def nodes_iter(self):
+        return iter(range(self.order()))
+
+    def nodes(self) -> List[int]:
+        return list(range(self.order()))
+
+    def number_of_edges(self) -> int:
+        return len(self._preds)
+
+    def successors(self, n: int) -> List[int]:
+        return self._succs[self._succ_offsets[n]:self._succ_offsets[n + 1]].tolist()
+
+    def predecessors(self, n: int) -> List[int]:
+        return self._preds[self._pred_offsets[n]:self._pred_offsets[n + 1]].tolist()
+
+    def in_degree(self, n: int) -> int:
+        return self._pred_offsets[n + 1] - self._pred_offsets[n]
+
+    def topological_sort(self) -> List[int]:
+        """The nodes in an order in which each node comes after all its predecessors;
+        raises ValueError if the graph has a cycle."""
+        remaining = array('i', (self.in_degree(n) for n in self.nodes_iter()))
+        order = [n for n in self.nodes_iter() if remaining[n] == 0]
+        for n in order:  # `order` grows as we go
+            for s in self._succs[self._succ_offsets[n]:self._succ_offsets[n + 1]]:
+                remaining[s] -= 1
+                if remaining[s] == 0:
+                    order.append(s)
+        if len(order) != self.order():
+            raise ValueError("stage graph contains a cycle")
+        return order
+
+    def dfs_successors(self, source: int) -> Dict[int, List[int]]:
+        """As networkx.dfs_successors: the children of each node in the depth-first search
+        tree rooted at `source` (nodes without children are omitted)."""
+        succs = {}  # type: Dict[int, List[int]]
+        visited = {source}
+        stack = [(source, iter(self.successors(source)))]
+        while stack:
+            parent, children = stack[-1]
+            for child in children:
+                if child not in visited:
+                    visited.add(child)
+                    succs.setdefault(parent, []).append(child)
+                    stack.append((child, iter(self.successors(child))))
+                    break
+            else:
+                stack.pop()
+        return succs
+
+    def to_networkx(self, node_attributes=lambda n: {}):
+        """An equivalent networkx DiGraph, e.g., for drawing."""
+        import networkx as nx  # type: ignore
+        G = nx.DiGraph()
+        for n in self.nodes_iter():
+            G.add_node(n, **node_attributes(n))
+        for n in self.nodes_iter():
+            for s in self.successors(n):
+                G.add_edge(n, s)
+        return G
@@ -0,0 +1,28 @@
+"""Handing over the stages still running on executors from a server which shuts down before the
+pipeline is complete (e.g., at the end of its walltime) to the next server (see --handoff).
+
+The outgoing server records its running stages (by index and hash, so that the successor can check
+that it has the same stages); the executors running them wait for a successor to appear (i.e., for
+a new URI in the URI file) and ask it to adopt their stages, which it holds back in the meantime."""
+
+import json
+import os
+
+from typing import Dict
+
+
+def write_running_stages(path: str, running: Dict[int, str]) -> None:
+    """Atomically record the running stages, given as a map from stage index to stage hash."""
+    tmp = "%s.tmp.%d" % (path, os.getpid())
+    with open(tmp, 'w') as fh:
+        json.dump({str(i): h for i, h in running.items()}, fh)
+    os.replace(tmp, path)
+
+
+def read_running_stages(path: str) -> Dict[int, str]:
+    """The stages recorded by `write_running_stages` (none if there's no record)."""
+    try:
+        with open(path) as fh:
+            return {int(i): h for i, h in json.load(fh).items()}
+    except FileNotFoundError:
+        return {}
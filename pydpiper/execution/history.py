@@ -0,0 +1,143 @@
+"""A persistent record of the resources used by past stages, from which the server
+estimates the memory and runtime of new stages running the same tools."""
+
+import os
+import sqlite3
+import time
+
+from typing import Dict, List, Optional, Tuple
+
+# number of samples needed before a tool's history is trusted over the hooks' estimates
+MIN_SAMPLES = 3
+# only the most recent samples per tool are used for fitting
+MAX_SAMPLES_PER_TOOL = 1000
+# extra headroom on top of the largest memory usage explained by the fitted model
+MEMORY_MARGIN = 1.1
+# buffered records are written out once there are this many of them or they are this old (in seconds)
+FLUSH_RECORDS = 100
+FLUSH_INTERVAL = 30.0
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS stage_runs (tool        TEXT NOT NULL,
+                                                    voxels      INTEGER,
+                                                    wall_time   REAL NOT NULL,
+                                                    cpu_time    REAL NOT NULL,
+                                                    peak_mem    REAL NOT NULL,
+                                                    recorded_at REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS stage_runs_tool ON stage_runs (tool);"""
+
+# (voxels, wall time (s), cpu time (s), peak memory (G))
+Sample = Tuple[Optional[int], float, float, float]
+
+
+def fit_linear(xs, ys):
+    """Least-squares fit of y = a + b * x; returns (a, b).
+    With fewer than two distinct x values, the slope is taken to be zero.
+    >>> fit_linear([1, 2, 3], [3, 5, 7])
+    (1.0, 2.0)
+    >>> fit_linear([4, 4], [1, 3])
+    (2.0, 0.0)
+    """
+    n = len(xs)
+    mean_x, mean_y = sum(xs) / n, sum(ys) / n
+    sxx = sum((x - mean_x) ** 2 for x in xs)
+    if sxx == 0:
+        return mean_y, 0.0
+    b = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / sxx
+    return mean_y - b * mean_x, b
+
+
+class StageHistory(object):
+    """Resource usage of finished stages, kept in an SQLite file which may be shared
+    between pipelines (but, as with any SQLite database, preferably not over NFS).
+
+    Samples are keyed by tool (the stage's program name) and the number of voxels of
+    its input, if known.  Memory is estimated from a linear fit in the number of voxels,
+    raised by the largest residual seen (so that the estimate would have sufficed for
+    every past run) and a further `MEMORY_MARGIN`; runtime is estimated by the fit itself.
+    Without voxel counts, the largest (respectively mean) past value is used instead.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._conn = None  # type: Optional[sqlite3.Connection]
+        self._pid = None   # type: Optional[int]
+        self._pending = []  # type: List[Tuple[str, Optional[int], float, float, float, float]]
+        self._last_flush = time.time()
+        self._samples = {}  # type: Dict[str, List[Sample]]
+        self._estimates = {}  # type: Dict[Tuple[str, str, Optional[int]], Optional[float]]
+
+    def _connection(self):
+        # sqlite connections can't be used across a fork (the pipeline is created in one
+        # process and run in another), so connect lazily in whichever process we find ourselves
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.executescript(SCHEMA)
+            self._pid = os.getpid()
+        return self._conn
+
+    def samples(self, tool):
+        if tool not in self._samples:
+            self.flush()  # so the query sees buffered records, too
+            rows = self._connection().execute(
+                "SELECT voxels, wall_time, cpu_time, peak_mem FROM stage_runs WHERE tool = ?"
+                " ORDER BY recorded_at DESC LIMIT ?", (tool, MAX_SAMPLES_PER_TOOL)).fetchall()
+            self._samples[tool] = list(reversed(rows))
+        return self._samples[tool]
+
+    def record(self, tool, voxels, wall_time, cpu_time, peak_mem):
+        """Add a sample; it is only buffered, to be written to disk in batches (see `flush_if_due`),
+        since it's recorded as the server handles an executor's request."""
+        now = time.time()
+        self._pending.append((tool, voxels, wall_time, cpu_time, peak_mem, now))
+        if tool in self._samples:
+            samples = self._samples[tool]
+            samples.append((voxels, wall_time, cpu_time, peak_mem))
+            del samples[:-MAX_SAMPLES_PER_TOOL]
+        for key in [k for k in self._estimates if k[0] == tool]:
+            del self._estimates[key]
+
+    def flush_if_due(self):
+        """Write out the buffered samples if there are many of them or they've waited a while
+        (called from the server's main loop)."""
+        if len(self._pending) >= FLUSH_RECORDS or (self._pending
+                                                   and time.time() - self._last_flush >= FLUSH_INTERVAL):
+            self.flush()
+
+    def flush(self):
+        # (samples recorded meanwhile are left for the next flush)
+        pending, self._pending = self._pending, []
+        if pending:
+            with self._connection() as conn:
+                conn.executemany("INSERT INTO stage_runs VALUES (?, ?, ?, ?, ?, ?)", pending)
+        self._last_flush = time.time()
+
+    def _estimate(self, what, tool, voxels):
+        key = (what, tool, voxels)
+        if key not in self._estimates:
+            self._estimates[key] = self._compute_estimate(what, tool, voxels)
+        return self._estimates[key]
+
+    def _compute_estimate(self, what, tool, voxels):
+        column = 3 if what == "mem" else 1
+        samples = self.samples(tool)
+        with_voxels = [(s[0], s[column]) for s in samples if s[0] is not None]
+        if voxels is not None and len(with_voxels) >= MIN_SAMPLES:
+            xs, ys = zip(*with_voxels)
+            a, b = fit_linear(xs, ys)
+            predicted = a + b * voxels
+            if what == "mem":
+                predicted += max(y - (a + b * x) for x, y in with_voxels)
+                predicted *= MEMORY_MARGIN
+            return max(predicted, 0.0)
+        if len(samples) < MIN_SAMPLES:
+            return None
+        values = [s[column] for s in samples]
+        return max(values) * MEMORY_MARGIN if what == "mem" else sum(values) / len(values)
+
+    def estimate_memory(self, tool, voxels=None):
+        """Memory (in G) a stage running `tool` on an input of `voxels` voxels is expected to need,
+        or None if there's too little history to say."""
+        return self._estimate("mem", tool, voxels)
+
+    def estimate_runtime(self, tool, voxels=None):
+        """Expected wall time (in s) of a stage running `tool`, or None if there's too little history."""
+        return self._estimate("runtime", tool, voxels)
@@ -0,0 +1,77 @@
+"""Running stages' when-runnable hooks (e.g., memory estimates which read image headers)
+in background threads, so that the server never waits on the filesystem while handling
+an executor's request."""
+
+import itertools
+import logging
+import os
+import queue
+import threading
+
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# the hooks mostly wait on the (network) filesystem
+HOOK_THREADS = 8
+
+
+class HookRunner(object):
+    """Calls `run(i, speculative)` for each submitted stage index `i` in a pool of background threads,
+    serving non-speculative requests first.  `run` should return whether it succeeded; the outcomes
+    are collected (by the server's thread) with `completed`.  If given, `on_ready` is called (from
+    the pool) after each successful non-speculative request, e.g., to wake an executor which will
+    then collect the result.
+
+    The threads are started lazily since threads don't survive the fork into the process running
+    the Pyro daemon; requests still outstanding at a fork are lost, so wait for them beforehand."""
+    def __init__(self, run: Callable[[int, bool], bool],
+                 on_ready: Optional[Callable[[], None]] = None,
+                 threads: int = HOOK_THREADS) -> None:
+        self.run = run
+        self.on_ready = on_ready
+        self.threads = threads
+        self._pid = None  # type: Optional[int]
+        self._requests = None  # type: queue.PriorityQueue
+        self._results = None  # type: queue.Queue
+        self._seq = itertools.count()  # keeps requests of equal priority in order
+
+    def _start(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._requests = queue.PriorityQueue()
+            self._results = queue.Queue()
+            for _ in range(self.threads):
+                t = threading.Thread(target=self._work, args=(self._requests, self._results))
+                t.daemon = True
+                t.start()
+
+    def submit(self, i: int, speculative: bool = False) -> None:
+        self._start()
+        self._requests.put((speculative, next(self._seq), i))
+
+    def _work(self, requests, results):
+        while True:
+            speculative, _, i = requests.get()
+            try:
+                ok = self.run(i, speculative)
+            except Exception:
+                logger.exception("Error preparing stage %d", i)
+                ok = False
+            results.put((i, speculative, ok))
+            if ok and not speculative and self.on_ready is not None:
+                try:
+                    self.on_ready()
+                except Exception:
+                    logger.debug("on_ready callback failed", exc_info=True)
+
+    def completed(self, block: bool = False) -> List[Tuple[int, bool, bool]]:
+        """The (stage index, speculative, succeeded) outcomes of requests finished since the last call
+        (waiting for at least one if `block`)."""
+        self._start()
+        done = [self._results.get()] if block else []
+        while True:
+            try:
+                done.append(self._results.get_nowait())
+            except queue.Empty:
+                return done
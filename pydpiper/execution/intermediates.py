@@ -0,0 +1,90 @@
+"""Deleting intermediate files -- stages' outputs which are only needed as inputs of other stages --
+once all the stages reading them have finished (see --gc-intermediates), so that a large pipeline
+doesn't fill up the disk with blurred images, gradients, resampled images, etc.
+
+An intermediate file is one which is written by one stage and read by others and is either in a
+'tmp' subdirectory (where the applications put such files) or was marked temporary by the
+application (see `FileAtom.temporary`).  Files no stage reads are outputs of the pipeline and are
+never deleted."""
+
+import logging
+import os
+import queue
+import threading
+
+from collections import Counter
+from typing import Iterable, Set
+
+logger = logging.getLogger(__name__)
+
+TMP_SUBDIR = "tmp"
+
+
+def is_temporary(path: str) -> bool:
+    return os.path.basename(os.path.dirname(path)) == TMP_SUBDIR
+
+
+def find_intermediates(stages: Iterable) -> Set[str]:
+    stages = list(stages)
+    produced = {f for s in stages for f in s.outputFiles}
+    marked = {f for s in stages for f in s.temporary_outputs}
+    return {f for s in stages for f in s.inputFiles
+            if f in produced and (f in marked or is_temporary(f))}
+
+
+class IntermediateFiles(object):
+    """Tracks the number of unfinished stages reading each of the given intermediate files, deleting
+    (in a background thread) those which are no longer needed.  The thread is started lazily since
+    threads don't survive the fork into the process running the Pyro daemon."""
+    def __init__(self, files: Set[str]) -> None:
+        self.files = files
+        self.consumers = Counter()  # type: Counter
+        self.deleted = 0
+        self.freed_bytes = 0
+        self._queue = None  # type: queue.Queue
+        self._pid = None  # type: int
+
+    def count_consumers(self, stages) -> None:
+        """Count the unfinished readers of each file (once any previously completed stages have been
+        skipped), deleting those which aren't needed any more, e.g., since a previous run finished
+        with them but was stopped before they were deleted."""
+        self.consumers.clear()
+        for s in stages:
+            if not s.isFinished():
+                self.consumers.update(self.files.intersection(s.inputFiles))
+        unneeded = self.files.difference(self.consumers)
+        logger.info("Tracking %d intermediate files (%d no longer needed)", len(self.files), len(unneeded))
+        for f in unneeded:
+            self.delete(f)
+
+    def consumed(self, stage) -> None:
+        """Note that `stage` has finished reading its inputs."""
+        for f in self.files.intersection(stage.inputFiles):
+            self.consumers[f] -= 1
+            if self.consumers[f] <= 0:
+                del self.consumers[f]
+                self.delete(f)
+
+    def delete(self, path: str) -> None:
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._queue = queue.Queue()
+            t = threading.Thread(target=self._work, args=(self._queue,))
+            t.daemon = True
+            t.start()
+        self._queue.put(path)
+
+    def _work(self, q):
+        while True:
+            path = q.get()
+            try:
+                size = os.stat(path).st_size
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                logger.warning("Could not delete intermediate file %s", path, exc_info=True)
+                continue
+            logger.debug("Deleted intermediate file %s", path)
+            self.deleted += 1
+            self.freed_bytes += size
@@ -0,0 +1,99 @@
+"""The log of finished stages from which a pipeline is restarted."""
+
+import os
+import time
+
+from typing import List, Optional, Tuple
+
+# buffered records are written out once there are this many of them or they are this old (in seconds)
+FLUSH_RECORDS = 100
+FLUSH_INTERVAL = 0.5
+
+# (stage index, stage hash, fingerprint of the stage's files or None)
+Record = Tuple[int, str, Optional[str]]
+
+
+def format_record(index, stage_hash, fingerprint=None):
+    return "%d,%s%s\n" % (index, stage_hash, "," + fingerprint if fingerprint else "")
+
+
+class FinishedStagesJournal(object):
+    """An append-only log with one line per finished stage.
+
+    Appends are buffered and written out in groups (every `flush_records` records or
+    `flush_interval` seconds, checked on each append and by `flush_if_due`, and by `flush`,
+    which must be called at shutdown), so finishing a stage doesn't cost a write to the
+    (often networked) filesystem.  A crash can lose the last few records, which only means
+    those stages are run again.  `compact` atomically replaces the log's contents.
+    """
+    def __init__(self, path, flush_records=FLUSH_RECORDS, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self._fh = None
+        self._pid = None  # type: Optional[int]
+        self._unflushed = 0
+        self._last_flush = time.time()
+
+    def _file(self):
+        # opened lazily since the pipeline is created in one process but runs (and finishes stages) in another
+        if self._pid != os.getpid():
+            self._fh = open(self.path, 'a')
+            self._pid = os.getpid()
+        return self._fh
+
+    def records(self) -> List[Record]:
+        """The records in the log, oldest first (a missing log has none).  Malformed lines,
+        such as one cut short by a crash, are skipped."""
+        try:
+            with open(self.path, 'r') as fh:
+                lines = fh.read().split()
+        except FileNotFoundError:
+            return []
+        records = []
+        for l in lines:
+            fields = l.split(',')
+            if len(fields) >= 2 and fields[0].isdigit() and fields[1]:
+                records.append((int(fields[0]), fields[1], fields[2] if len(fields) > 2 else None))
+        return records
+
+    def append(self, index, stage_hash, fingerprint=None):
+        self._file().write(format_record(index, stage_hash, fingerprint))
+        self._unflushed += 1
+        if self._unflushed >= self.flush_records:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        if self._unflushed and time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._unflushed:
+            self._file().flush()
+            self._unflushed = 0
+        self._last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        if self._fh is not None and self._pid == os.getpid():
+            self._fh.close()
+        self._fh, self._pid = None, None
+
+    def compact(self, records: List[Record]):
+        """Replace the log by `records`, atomically: the new contents are written to a temporary
+        file in the same directory which is then renamed over the log, so an interruption leaves
+        either the old or the new log intact."""
+        self.close()
+        tmp = "%s.tmp.%d" % (self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as fh:
+                fh.writelines(format_record(*r) for r in records)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp, self.path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
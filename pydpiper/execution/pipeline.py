@@ -3,15 +3,14 @@
 import hashlib
 import threading
 
-import networkx as nx  # type: ignore
 import os
 import sys
 import signal
 import socket
 import time
-import re
 import resource
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import subprocess
 from shlex import split
@@ -19,7 +18,11 @@ from multiprocessing import Process, Event  # type: ignore
 from configargparse import Namespace
 import logging
 import functools
+import itertools
 import math
+import pickle
+import queue
+from array import array
 from typing import Any
 
 try:
@@ -41,11 +44,36 @@ logger.basicConfig(filename="pipeline.log", level=os.getenv("PYDPIPER_LOGLEVEL",
                 
 import Pyro4  # type: ignore
 from . import pipeline_executor as pe
+from .scheduling import (RunnableIndex, critical_path_priorities, executor_fleet, forecast_demand, fusible_links,
+                         DEFAULT_STAGE_RUNTIME, MEM_EPS)
+from .history import StageHistory
+from .restart import VERIFY_THREADS, file_signature, file_signatures, stage_fingerprint
+from .journal import FinishedStagesJournal
+from .graph import StageGraph
+from .hooks import HookRunner
+from .snapshot import SNAPSHOT_INTERVAL, read_snapshot, write_snapshot
+from .handoff import read_running_stages, write_running_stages
+from .intermediates import IntermediateFiles, find_intermediates
+from .scratch import ScratchFiles, mentions
+from .artifact_cache import ArtifactCache
+from .autoscaling import Autoscaler
+from .queueing import remaining_walltime
+from .stragglers import Backup, Stragglers, redirect
+from .retries import MEMORY, RETRY_BACKOFF, MAX_RETRY_DELAY, Retries, RetryPolicy, classify
 
 Pyro4.config.SERVERTYPE = pe.Pyro4.config.SERVERTYPE
 
 LOOP_INTERVAL = 5
-STAGE_RETRY_INTERVAL = 1
+# how long (in seconds) to try contacting an executor to wake it up before giving up
+WAKEUP_TIMEOUT = 5
+# the hooks of stages up to this many levels below a runnable stage are run ahead of time
+SPECULATION_DEPTH = 2
+# an executor whose walltime is running out is only given stages expected to finish within this
+# fraction of the time it has left ...
+WALLTIME_SAFETY_FRACTION = 0.8
+# ... though one with at least this fraction of its walltime left takes any stage (one expected to take
+# longer than an executor's whole walltime can't be placed any better)
+FRESH_EXECUTOR_FRACTION = 0.9
 
 sys.excepthook = Pyro4.util.excepthook # type: ignore
 
@@ -79,11 +107,62 @@ class LogFile(PipelineFile):
     it's still alive (based on a periodic heartbeat)
     """
 class ExecClient(object):
-    def __init__(self, client, maxmemory):
+    def __init__(self, client, maxmemory, time_left=None):
         self.clientURI = client
         self.maxmemory = maxmemory
         self.running_stages = set([])
         self.timestamp = time.time()
+        # when the executor's walltime runs out (by the server's clock), if it's known, and how long it was
+        self.walltime = time_left
+        self.deadline = None if time_left is None else self.timestamp + time_left
+
+    def time_budget(self):
+        """How long a stage given to this executor now may be expected to take (None if there's no limit)."""
+        if self.deadline is None:
+            return None
+        time_left = self.deadline - time.time()
+        if time_left >= FRESH_EXECUTOR_FRACTION * self.walltime:
+            return None
+        return WALLTIME_SAFETY_FRACTION * time_left
+
+class ExecutorNotifier(object):
+    """Wakes up executors (via their oneway `wakeup` method) when new stages become runnable,
+    so that they needn't wait for their next main loop tick to ask for work.
+    The calls are made from a background thread so that the (single-threaded) server
+    never blocks on an executor's network connection.  The thread is started lazily since
+    threads don't survive the fork into the process running the Pyro daemon."""
+    def __init__(self):
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()  # (`notify` is also called from the hook threads)
+
+    def notify(self, clientURI):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                t = threading.Thread(target=self._send_wakeups, args=(self._queue,))
+                t.daemon = True
+                t.start()
+        self._queue.put(clientURI)
+
+    def _send_wakeups(self, q):
+        proxies = {}
+        while True:
+            clientURI = q.get()
+            try:
+                if clientURI not in proxies:
+                    p = Pyro4.Proxy(clientURI)
+                    p._pyroTimeout = WAKEUP_TIMEOUT
+                    p._pyroOneway.add("wakeup")
+                    proxies[clientURI] = p
+                proxies[clientURI].wakeup()
+            except Exception:
+                # not fatal, since the executor will still ask for work on its next tick
+                logger.debug("Could not wake up executor %s", clientURI, exc_info=True)
+                p = proxies.pop(clientURI, None)
+                if p is not None:
+                    p._pyroRelease()
 
 def memoize_hook(hook):  # TODO replace with functools.lru_cache (?!) in python3
     data = Namespace(called=False, result=None)  # because of Python's bizarre assignment rules
@@ -97,6 +176,10 @@ def memoize_hook(hook):  # TODO replace with functools.lru_cache (?!) in python3
     return g
 
 class PipelineStage(object):
+    # a pipeline may have hundreds of thousands of stages, so avoid a __dict__ per stage
+    __slots__ = ['mem', 'procs', 'inputFiles', 'outputFiles', 'temporary_outputs', 'logFile', 'status', 'name',
+                 'colour', 'number_retries', 'estimated_runtime', 'input_voxels', 'priority',
+                 '_runnable_hooks', 'finished_hooks']
     def __init__(self):
         self.mem = None # if not set, use pipeline default
         self.procs = 1 # default number of processors per stage
@@ -104,11 +187,20 @@ class PipelineStage(object):
         self.inputFiles  = [] # type: List[str]
         # the output files for this stage
         self.outputFiles = [] # type: List[str]
+        # those outputs which the application marked as temporary (see intermediates.py)
+        self.temporary_outputs = () # type: Tuple[str, ...]
         self.logFile = None
         self.status = None
         self.name = ""
         self.colour = "black" # used when a graph is created of all stages to colour the nodes
         self.number_retries = 0
+        # expected runtime (in seconds), if known
+        self.estimated_runtime = None
+        # number of voxels in the (main) input image, if known; set by the memory estimation hooks
+        # and used to look up the resource usage of similar stages in the stage history
+        self.input_voxels = None
+        # if not None, overrides the priority computed from the pipeline's critical path
+        self.priority = None
         # functions to be called when the stage becomes runnable
         # (these might be called multiple times, so should be benign
         # in some sense)
@@ -149,6 +241,7 @@ class PipelineStage(object):
         self.number_retries += 1
 
 class CmdStage(PipelineStage):
+    __slots__ = ['cmd']
     pipeline_start_time = datetime.isoformat(datetime.now())
     logfile_id = 0
     def __init__(self, argArray):
@@ -197,21 +290,6 @@ class CmdStage(PipelineStage):
     def __hash__(self):
         return tuple(self.cmd).__hash__()
 
-"""A graph with no edge information; see networkx/classes/digraph.py"""
-class ThinGraph(nx.DiGraph):
-    all_edge_dict = {'weight': 1}
-    def single_edge_dict(self):
-        return self.all_edge_dict
-    edge_attr_dict_factory = single_edge_dict
-
-
-"""A graph with no edge information; see networkx/classes/digraph.py"""
-class ThinGraph(nx.DiGraph):
-    all_edge_dict = {'weight': 1}
-    def single_edge_dict(self):
-        return self.all_edge_dict
-    edge_attr_dict_factory = single_edge_dict
-    
 class Pipeline(object):
     # TODO the way we initialize a pipeline is currently a bit gross, e.g.,
     # setting a bunch of instance variables after __init__ - the presence of a method
@@ -226,17 +304,23 @@ class Pipeline(object):
         self.pipeline_name = options.application.pipeline_name
         self.options = options
         self.exec_options = options.execution
-        self.G = ThinGraph()
+        # the stage dependency graph (a StageGraph on the stage indices), built by `createEdges`
+        self.G = None
         # a map from indices to the number of unfulfilled prerequisites
         # of the corresponding graph node (will be populated later -- __init__ is a misnomer)
-        self.unfinished_pred_counts = []
+        self.unfinished_pred_counts = array('i')
         # an array of the actual stages (PipelineStage objects)
         self.stages = []
-        self.nameArray = []
-        # indices of the stages ready to be run
-        self.runnable = set()
-        # an array to keep track of stage memory requirements
-        self.mem_req_for_runnable = []
+        # indices of the stages ready to be run, indexed by their resource requirements
+        self.runnable = RunnableIndex()
+        # stages' when-runnable hooks are run in background threads (see `run_hooks`); a stage
+        # whose dependencies have finished waits in `awaiting_hooks` until its hooks have run
+        # (and `prepare_to_run` has set `prepared`), and only then joins `runnable`
+        self.hook_runner = HookRunner(self.run_hooks, on_ready=self.wake_waiting_client)
+        self.prepared = bytearray()
+        self.speculated = bytearray()
+        self.hooks_in_flight = set()
+        self.awaiting_hooks = {}  # (a dict rather than a set to keep the order in which stages became runnable)
         # a hideous hack; the idea is that after constructing the underlying graph,
         # a pipeline running executors locally will measure its own maxRSS (once)
         # and subtract this from the amount of memory claimed available for use on the node.
@@ -244,16 +328,23 @@ class Pipeline(object):
         self.currently_running_stages = set()
         # the current stage counter
         self.counter = 0
-        # hash to keep the output to stage association
+        # hash to keep the output to stage association (only needed while building the graph)
         self.outputhash = {}
         # a hash per stage - computed from inputs and outputs or whole command
+        # (only needed while adding stages)
         self.stage_dict = {}
         self.num_finished_stages = 0
         self.failedStages = []
         # location of backup files for restart if needed
         self.backupFileLocation = self._backup_file_location()
+        # how to decide whether a previously finished stage can be skipped (see restart.py)
+        self.restart_check = options.application.restart_check
         # table of registered clients (using ExecClient class instances) indexed by URI
         self.clients = {}
+        # URIs of registered clients which were told to wait for work, in the order they asked
+        # (a dict rather than a set to keep this order); these are woken up as stages become runnable
+        self.waiting_clients = OrderedDict()
+        self.notifier = ExecutorNotifier()
         # number of clients (executors) that have been launched by the server
         # we need to keep track of this because even though no (or few) clients
         # are actually registered, a whole bunch of them could be waiting in the
@@ -261,6 +352,28 @@ class Pipeline(object):
         self.number_launched_and_waiting_clients = 0
         # clients we've lost contact with due to crash, etc.
         self.failed_executors = 0
+        # the (largest stage, executor memory) pairs of the size classes of the executors last launched
+        # (see --executor-size-classes); an executor prefers the stages too large for the smaller classes
+        self.executor_classes = []
+        # the longest expected runtime of any stage made runnable so far, so that executors whose walltime
+        # is running out needn't search the runnable stages for short enough ones until some might be too long
+        self.longest_runtime = 0.0
+        # with --autoscale, sizes the set of executors to the demand forecast from the stage graph (see autoscaling.py)
+        self.autoscaler = Autoscaler(self.exec_options.queue_wait) if self.exec_options.autoscale else None
+        # when each running stage was started (by the server's clock)
+        self.start_times = {}
+        # with --backup-stragglers, the runtimes of the stages finished so far and the backup copies of straggling
+        # stages (see stragglers.py); a stage's peers are those running the same tool in the same `generations`
+        self.stragglers = None
+        self.generations = None
+        # stages to cancel, by executor (with --backup-stragglers, the slower of a stage and its copy)
+        self.cancellations = {}
+        # the retry policies and the failed stages waiting to be retried (see retries.py)
+        self.retries = Retries(RetryPolicy(max_retries=self.exec_options.max_retries,
+                                           delay=self.exec_options.retry_delay,
+                                           backoff=RETRY_BACKOFF, max_delay=MAX_RETRY_DELAY,
+                                           mem_factor=self.exec_options.oom_mem_factor),
+                               self.exec_options.retry_policy)
         # time to shut down, due to walltime or having completed all stages?
         # (use an event rather than a simple flag for shutdown notification
         # so that we can shut down even if a process is currently sleeping)
@@ -271,8 +384,50 @@ class Pipeline(object):
         # report back to the user which percentage of the pipeline stages has finished
         # keep track of the last percentage that was printed
         self.percent_finished_reported = 0
-        # Handle to write out processed stages to
-        self.finished_stages_fh = None
+        # log of processed stages, used on restart
+        self.finished_stages_journal = FinishedStagesJournal(self.backupFileLocation)
+        # with --restart-check=stat/content, the finished stages' fingerprints, which examine the stages' files,
+        # are computed in background threads and journalled once they're ready (see `record_fingerprints`)
+        self.fingerprint_pool = None  # type: Tuple[int, ThreadPoolExecutor]
+        self.fingerprints = {}  # type: Dict[int, Future]
+        # where to save the scheduler state (see snapshot.py), if at all, and the key of the
+        # pipeline definition it's saved under; set by the application if requested
+        self.snapshot_path = None
+        self.definition_key = None
+        self.snapshot_time = time.time()
+        # with --handoff, the stages running when the server shuts down are recorded here,
+        # for the executors running them to hand over to the next server (see handoff.py)
+        self.running_stages_location = os.path.join(os.getcwd(), self.pipeline_name + '_running_stages')
+        self.handed_off = False
+        # stages which were running when the previous server shut down, held back (rather than
+        # made runnable) until `reserved_until` in case their executors hand them over to us
+        self.reserved = {}
+        self.reserved_until = None
+        # the intermediate files (with --gc-intermediates or --local-scratch); with --gc-intermediates,
+        # these are deleted once they're no longer needed
+        self.intermediate_files = frozenset()
+        self.intermediates = None
+        # with --local-scratch, tracks which executor holds which intermediate files in its scratch space;
+        # runnable stages whose inputs must first be copied out of some executor's scratch space wait in
+        # `awaiting_copy_out` (with the files they're waiting for) rather than in `runnable`
+        self.scratch = None
+        self.awaiting_copy_out = {}
+        # with --artifact-cache, the store of outputs of stages run before (possibly by other pipelines);
+        # a stage which has become runnable is first looked up there (in background threads, like the hooks),
+        # waiting in `awaiting_cache` meanwhile; `artifact_keys` holds the keys of the stages looked up
+        # (None if a stage can't be stored), under which the executors store their outputs
+        self.artifacts = (ArtifactCache(self.exec_options.artifact_cache)
+                          if self.exec_options.artifact_cache else None)
+        self.artifact_keys = {}
+        self.awaiting_cache = set()
+        self.cache_runner = HookRunner(self.consult_artifact_cache)
+        self.restored_stages = 0
+        # with --fuse-stages, for each stage, the stage to run right after it in the same executor job
+        # (see `fusible_links`), or -1; the chains are handed out by `getCommands`
+        self.fused_next = None
+        # resource usage of previously run stages, used to refine memory and runtime estimates
+        self.history = (StageHistory(self.exec_options.stage_history)
+                        if self.exec_options.stage_history else None)
         
         self.outputDir = self.options.application.output_directory or os.getcwd()
 
@@ -286,18 +441,25 @@ class Pipeline(object):
             self._add_stage(s)
 
         self.createEdges()
-        # could also set this on G itself ...
-        self.unfinished_pred_counts = [ len([i for i in self.G.predecessors(n)
-                                             if not self.stages[i].isFinished()])
-                                        for n in range(self.G.order()) ]
-        graph_heads = [n for n in self.G.nodes_iter()
-                       if self.unfinished_pred_counts[n] == 0]
-        logger.info("Graph heads: " + str(graph_heads))
-        for n in graph_heads:
-            self.enqueue(n)
-       
+        self.track_intermediates()
+        self.find_fusible_links()
+        self.track_stragglers()
+        self.prepared = bytearray(len(self.stages))
+        self.speculated = bytearray(len(self.stages))
+        self.stage_dict.clear()
+        self.outputhash.clear()
+        if self.history:
+            for s in self.stages:
+                if s.estimated_runtime is None:
+                    s.estimated_runtime = self.history.estimate_runtime(self.tool_name(s))
+        self.compute_priorities()
+        self.count_unfinished_predecessors()
+        # (the runnable stages are enqueued by `enqueue_runnable_stages` once any previously
+        # completed stages have been skipped, so their hooks aren't run needlessly)
+
     # expose methods to get/set shutdown_ev via Pyro (setter not needed):
     def set_shutdown_ev(self):
+        self.flush_journal()
         self.shutdown_ev.set()
 
     def get_shutdown_ev(self):
@@ -331,7 +493,7 @@ class Pipeline(object):
         return len(self.runnable)
 
     def getMemoryRequirementsRunnable(self):
-        return self.mem_req_for_runnable
+        return self.runnable.memory_requirements()
 
     def getMemoryAvailableInClients(self):
         return [c.maxmemory for _, c in self.clients.items()]
@@ -357,12 +519,9 @@ class Pipeline(object):
             self.stage_dict[h] = self.counter
             #self.statusArray[self.counter] = 'notstarted'
             self.stages.append(stage)
-            self.nameArray.append(stage.name)
             # add all outputs to the output dictionary
             for o in stage.outputFiles:
                 self.outputhash[o] = self.counter
-            # add the stage's index to the graph
-            self.G.add_node(self.counter, label=stage.name, color=stage.colour)
             self.counter += 1
         # huge hack since default isn't available in CmdStage() constructor
         # (may get overridden later by a hook, hence may really be wrong ... ugh):
@@ -383,19 +542,121 @@ class Pipeline(object):
     def createEdges(self):
         """computes stage dependencies by examining their inputs/outputs"""
         starttime = time.time()
-        # iterate over all nodes
-        for i in self.G.nodes_iter():
-            for ip in self.stages[i].inputFiles:
-                # if the input to the current stage was the output of another
-                # stage, add a directional dependence to the DiGraph
-                if ip in self.outputhash:
-                    self.G.add_edge(self.outputhash[ip], i)
+        # if an input of a stage is the output of another stage, the latter is a predecessor
+        # (the graph is built in one go, from the predecessors of each stage in turn)
+        outputhash = self.outputhash
+        self.G = StageGraph(sorted({outputhash[ip] for ip in s.inputFiles if ip in outputhash})
+                            for s in self.stages)
         endtime = time.time()
         logger.info("Create Edges time: " + str(endtime-starttime))
 
-    def get_stage_info(self, i):
+    def count_unfinished_predecessors(self):
+        # could also set this on G itself ...
+        self.unfinished_pred_counts = array('i', (len([i for i in self.G.predecessors(n)
+                                                       if not self.stages[i].isFinished()])
+                                                  for n in range(self.G.order())))
+
+    def enqueue_runnable_stages(self):
+        """Enqueue all the stages which can be run now, i.e., those which haven't finished
+        but whose predecessors all have (initially, the graph heads).  Call this once, after
+        skipping any previously completed stages; later, stages are enqueued as their
+        predecessors finish."""
+        runnable = [n for n in self.G.nodes_iter() if self.checkIfRunnable(n) and n not in self.reserved]
+        logger.info("Initially runnable stages: %d", len(runnable))
+        logger.debug("Initially runnable stages: %s", runnable)
+        for n in runnable:
+            self.enqueue(n)
+
+    def networkx_graph(self):
+        """The stage graph as a networkx DiGraph labelled with the stages' names, e.g., for drawing."""
+        return self.G.to_networkx(lambda i: dict(label=self.stages[i].name, color=self.stages[i].colour))
+
+    def compute_priorities(self):
+        """Prioritize each stage by the estimated runtime along the longest path from it to the
+        end of the pipeline, so that stages gating a lot of downstream work are dispatched first."""
+        starttime = time.time()
+        self.priorities = critical_path_priorities(
+            self.G.topological_sort(),
+            successors=self.G.successors,
+            runtime=self.expected_runtime)
+        logger.info("Compute priorities time: " + str(time.time() - starttime))
+
+    @staticmethod
+    def tool_name(s):
+        """The key under which a stage's resource usage is recorded in the stage history."""
+        return os.path.basename(s.name)
+
+    def track_intermediates(self):
+        if self.exec_options.gc_intermediates or self.exec_options.local_scratch:
+            self.intermediate_files = find_intermediates(self.stages)
+        if self.exec_options.gc_intermediates:
+            self.intermediates = IntermediateFiles(self.intermediate_files)
+        if self.exec_options.local_scratch:
+            self.scratch = ScratchFiles(self.intermediate_files,
+                                        producers={ f : i for i, s in enumerate(self.stages)
+                                                    for f in s.outputFiles if f in self.intermediate_files })
+
+    def find_fusible_links(self):
+        if not self.exec_options.fuse_stages:
+            return
+        if self.artifacts:
+            # (each stage must be looked up in the cache once its inputs exist, so can't be sent along with its predecessor)
+            logger.warning("Not fusing stages, since they're looked up in the artifact cache")
+            return
+        self.fused_next = fusible_links(self.G.order(), self.G.successors, self.G.predecessors,
+                                        fits=lambda i: (self.stages[i].mem <= self.exec_options.mem
+                                                        and self.stages[i].procs <= self.exec_options.proc))
+        logger.info("Stages which can be fused onto their predecessors: %d",
+                    sum(1 for j in self.fused_next if j >= 0))
+
+    def track_stragglers(self):
+        if not self.exec_options.backup_stragglers:
+            return
+        if self.scratch:
+            # (a copy of a stage would need the files in the original's executor's scratch space)
+            logger.warning("Not running backup copies of straggling stages, since intermediate files are kept "
+                           "in scratch space")
+            return
+        self.stragglers = Stragglers(self.exec_options.straggler_percentile)
+        self.generations = array('i', [0]) * self.G.order()
+        for n in self.G.topological_sort():
+            self.generations[n] = max((self.generations[p] + 1 for p in self.G.predecessors(n)), default=0)
+
+    def stage_files(self, i):
+        """The files examined when deciding whether a stage can be skipped on restart (excluding
+        any intermediate files, which may be deleted or kept in scratch space, and are re-created when needed again)."""
         s = self.stages[i]
-        return pe.StageInfo(mem=s.mem, procs=s.procs, ix=i, cmd=s.cmd, log_file=s.logFile)
+        if self.intermediate_files:
+            return [f for f in s.inputFiles + s.outputFiles if f not in self.intermediate_files]
+        return s.inputFiles + s.outputFiles
+
+    def stage_fingerprint(self, i, signature=None):
+        """A fingerprint of the stage's input and output files as they are now, for use on restart
+        (None unless such checks were requested)."""
+        if self.restart_check == "command":
+            return None
+        return stage_fingerprint(self.stage_files(i), self.restart_check,
+                                 signature or (lambda f: file_signature(f, self.restart_check)))
+
+    def stage_priority(self, i):
+        p = self.stages[i].priority
+        return self.priorities[i] if p is None else p
+
+    def expected_runtime(self, i):
+        """The stage's expected runtime (in seconds), from the stage history or its hooks, if known."""
+        return self.stages[i].estimated_runtime or DEFAULT_STAGE_RUNTIME
+
+    def get_stage_info(self, i, clientURI=None, after=None):
+        s = self.stages[i]
+        # (the files the executor should keep in, or read from, its scratch space, including
+        # those written by the stage it's fused onto, if any)
+        local = set(self.scratch.scratch_outputs(self.stages[after])) if self.scratch and after is not None else set()
+        scratch = (self.scratch.scratch_outputs(s) + [f for f in s.inputFiles
+                                                      if self.scratch.holders.get(f) == clientURI or f in local]
+                   if self.scratch and clientURI else [])
+        artifact_key = self.artifact_keys.get(i)
+        return pe.StageInfo(mem=s.mem, procs=s.procs, ix=i, cmd=s.cmd, log_file=s.logFile, scratch=scratch,
+                            artifact_key=artifact_key, outputs=s.outputFiles if artifact_key else [])
 
     def getStage(self, i):
         """given an index, return the actual pipelineStage object"""
@@ -419,15 +680,19 @@ class Pipeline(object):
     """Given client information, issue commands to the client (along similar
     lines to getRunnableStageIndex) and update server's internal view of client.
     This is highly stateful, being a resource-tracking wrapper around
-    getRunnableStageIndex and hence a glorified Set.pop."""
+    the runnable index: the stage handed out is the one of highest critical-path priority
+    (see `compute_priorities`) which fits into the executor's free memory and processors."""
     def getCommand(self, clientURIstr, clientMemFree, clientProcsFree):
         if self.is_time_to_drain():
+            # (with --handoff, the executor should keep running its stages for the next server)
+            if self.exec_options.handoff and not self.allStagesCompleted():
+                return ("handoff", None)
             return ("shutdown_abnormally", None)
 
-        # TODO now that getRunnableStageIndex pops from a set,
-        # intelligently look for something this client can run
-        # (e.g., by passing available resources
-        # into getRunnableStageIndex)?
+        if self.allStagesCompleted():
+            return ("shutdown_normally", None)
+        self.collect_prepared_stages()
+        # (no point waking executors which are full, so don't count these as waiting)
         if clientMemFree == 0:
             logger.debug("Executor has no free memory")
             return ("wait", None)
@@ -435,22 +700,118 @@ class Pipeline(object):
             logger.debug("Executor has no free processors")
             return ("wait", None)
 
-        flag, i = self.getRunnableStageIndex()
-        if flag == "run_stage":
-            eps = 0.000001
-            memOK   = self.getStageMem(i) <= clientMemFree + eps
-            procsOK = self.getStageProcs(i) <= clientProcsFree
-            if memOK and procsOK:
-                return (flag, i)
-            else:
-                if not memOK:
-                    logger.debug("The executor does not have enough free memory (free: %.2fG, required: %.2fG) to run stage %d. (Executor: %s)", clientMemFree, self.getStageMem(i), i, clientURIstr)
-                if not procsOK:
-                    logger.debug("The executor does not have enough free processors (free: %.1f, required: %.1f) to run stage %d. (Executor: %s)", clientProcsFree, self.getStageProcs(i), i, clientURIstr)
-                self.enqueue(i)
-                return ("wait", None)
-        else:
-            return (flag, i)
+        i = self.pop_runnable(clientURIstr, clientMemFree, clientProcsFree)
+        if i is None:
+            if len(self.runnable) > 0:
+                logger.debug("No runnable stage fits into the executor's free resources "
+                             "(free: %.2fG, %d processors). (Executor: %s)",
+                             clientMemFree, clientProcsFree, clientURIstr)
+            if self.release_idle_executor(clientURIstr):
+                return ("shutdown_normally", None)
+            if clientURIstr in self.clients:
+                self.waiting_clients[clientURIstr] = None
+            return ("wait", None)
+        self.waiting_clients.pop(clientURIstr, None)
+        return ("run_stage", i)
+
+    def pop_runnable(self, clientURI, mem_free, procs_free):
+        """Remove and return the best runnable stage for the executor (see `RunnableIndex.pop_fitting`),
+        or None.  An executor launched for large stages takes those which executors of smaller size classes
+        couldn't run first.  An executor whose walltime is running out only gets stages expected to finish
+        in time.  With --local-scratch, stages whose inputs the executor holds come first, while
+        a stage whose inputs are held by another executor is set aside until they've been copied out."""
+        min_mem = self.size_class_floor(clientURI)
+        max_runtime = self.time_budget(clientURI)
+        if max_runtime is not None and max_runtime >= self.longest_runtime:
+            max_runtime = None
+        while True:
+            i = None
+            if min_mem:
+                i = self.runnable.pop_fitting(mem_free=mem_free, procs_free=procs_free, client=clientURI,
+                                              min_mem=min_mem, max_runtime=max_runtime)
+            if i is None:
+                i = self.runnable.pop_fitting(mem_free=mem_free, procs_free=procs_free, client=clientURI,
+                                              max_runtime=max_runtime)
+            if i is None or not self.scratch:
+                return i
+            remote = self.scratch.not_local_to(self.stages[i], clientURI)
+            if not remote:
+                return i
+            self.await_copy_out(i, remote)
+
+    def time_budget(self, clientURI):
+        client = self.clients.get(clientURI)
+        return None if client is None else client.time_budget()
+
+    def size_class_floor(self, clientURI):
+        """The largest stage which the executors of size classes smaller than the given executor's were
+        launched for (0 if there are none)."""
+        client = self.clients.get(clientURI)
+        if client is None:
+            return 0
+        return max((largest for largest, mem in self.executor_classes if mem < client.maxmemory - MEM_EPS),
+                   default=0)
+
+    def getCommands(self, clientURIstr, clientMemFree, clientProcsFree):
+        """Batched version of getCommand: hand out as many runnable stages as fit into the
+        executor's free memory and processors (in critical-path priority order), mark them as started on the
+        given client and return their `StageInfo`s, so that an executor can fill up
+        in a single round trip instead of calling getCommand, get_stage_info and
+        setStageStarted once per stage.  Returns ("run_stages", [StageInfo]) or
+        the same (flag, None) pairs as getCommand.
+        With --fuse-stages, a stage is sent along with the chain of stages fused onto it (see `fused_chain`),
+        which the executor runs one after another in the same job.  With --backup-stragglers, an idle executor
+        may be given a copy of a straggling stage instead of waiting (see `back_up_straggler`)."""
+        self.release_due_retries()
+        flag, i = self.getCommand(clientURIstr, clientMemFree, clientProcsFree)
+        if flag == "wait" and self.stragglers:
+            self.collect_backup_work()
+            backup = self.back_up_straggler(clientURIstr, clientMemFree, clientProcsFree)
+            if backup is not None:
+                return ("run_stages", [backup])
+        if flag != "run_stage":
+            return (flag, None)
+        stages = []
+        while i is not None:
+            chain = self.fused_chain(i, clientMemFree, clientProcsFree, self.time_budget(clientURIstr))
+            for k in chain:
+                self.setStageStarted(k, clientURIstr)
+            info = self.get_stage_info(i, clientURIstr)
+            info.fused = [self.get_stage_info(k, clientURIstr, after=j) for j, k in zip(chain, chain[1:])]
+            stages.append(info)
+            clientMemFree   -= max(self.stages[k].mem for k in chain)
+            clientProcsFree -= max(self.stages[k].procs for k in chain)
+            i = (self.pop_runnable(clientURIstr, clientMemFree, clientProcsFree)
+                 if clientProcsFree > 0 else None)
+        return ("run_stages", stages)
+
+    def fused_chain(self, i, mem_free, procs_free, max_runtime=None):
+        """Stage `i` (about to be handed out) followed by the chain of stages fused onto it which can go
+        along with it: the chain ends before a stage which has already run or is running, whose hooks haven't
+        run yet (so its resource requirements aren't known), which doesn't fit into the free resources or
+        which would make the chain take longer than `max_runtime`, if given."""
+        chain = [i]
+        if self.fused_next is None:
+            return chain
+        mem, procs = self.stages[i].mem, self.stages[i].procs
+        runtime = self.expected_runtime(i)
+        j = self.fused_next[i]
+        while j >= 0:
+            s = self.stages[j]
+            if s.isFinished() or s.status == "running" or j in self.reserved:
+                break
+            if not self.prepared[j]:
+                if s._runnable_hooks:
+                    break
+                # (there's nothing to wait for, even if a speculative run of its (no) hooks is in flight)
+                self.prepare_to_run(j)
+            mem, procs = max(mem, s.mem), max(procs, s.procs)
+            runtime += self.expected_runtime(j)
+            if mem > mem_free + MEM_EPS or procs > procs_free or (max_runtime is not None and runtime > max_runtime):
+                break
+            chain.append(j)
+            j = self.fused_next[j]
+        return chain
 
     """Return a tuple of a command ("shutdown_normally" if all stages are finished,
     "wait" if no stages are currently runnable, or "run_stage" if a stage is
@@ -459,17 +820,15 @@ class Pipeline(object):
     def getRunnableStageIndex(self):
         if self.allStagesCompleted():
             return ("shutdown_normally", None)
+        elif self.awaiting_hooks:
+            # (the outcome of the stage's hooks is still collected, but it won't join `runnable`)
+            i = next(iter(self.awaiting_hooks))
+            del self.awaiting_hooks[i]
+            return ("run_stage", i)
         elif len(self.runnable) == 0:
             return ("wait", None)
         else:
-            index = self.runnable.pop()
-            # remove an instance of currently required memory
-            try:
-                self.mem_req_for_runnable.remove(self.stages[index].mem)
-            except:
-                logger.debug("mem_req_for_runnable: %s; mem: %s", self.mem_req_for_runnable, self.stages[index].mem)
-                logger.exception("It wasn't here!")
-            return ("run_stage", index)
+            return ("run_stage", self.runnable.pop())
 
     def allStagesCompleted(self): 
         return self.num_finished_stages == len(self.stages) 
@@ -508,10 +867,13 @@ class Pipeline(object):
         self.addRunningStageToClient(clientURI, index)
         self.currently_running_stages.add(index)
         self.stages[index].setRunning()
+        self.start_times[index] = time.time()
 
     def checkIfRunnable(self, index):
-        """stage added to runnable set if all predecessors finished"""
-        canRun = ((not self.stages[index].isFinished()) and (self.unfinished_pred_counts[index] == 0))
+        """stage added to runnable set if all predecessors finished
+        (and it isn't already running, having been fused onto its predecessor)"""
+        canRun = ((not self.stages[index].isFinished()) and (self.unfinished_pred_counts[index] == 0)
+                  and self.stages[index].status != "running")
         #logger.debug("Stage %s Runnable: %s", str(index), str(canRun))
         return canRun
 
@@ -539,8 +901,14 @@ class Pipeline(object):
         if checking_pipeline_status:
             s.status = "finished"
         else:
-            logger.info("Finished Stage %s: %s (on %s)", str(index), str(self.stages[index]), clientURI)
-            self.removeFromRunning(index, clientURI, new_status = "finished")
+            if clientURI is None:
+                # (it isn't running: its outputs were restored from the artifact cache, or moved into place
+                # from a backup copy after the original had stopped)
+                logger.info("Finished Stage %s: %s (outputs put in place)", str(index), str(self.stages[index]))
+                s.status = "finished"
+            else:
+                logger.info("Finished Stage %s: %s (on %s)", str(index), str(self.stages[index]), clientURI)
+                self.removeFromRunning(index, clientURI, new_status = "finished")
             # run any potential hooks now that the stage has finished:
             for f in s.finished_hooks:
                 f(s)
@@ -560,16 +928,47 @@ class Pipeline(object):
         # write out the (index, hash) pairs to disk.  We don't actually need the indices
         # for anything (in fact, the restart code in skip_completed_stages is resilient 
         # against an arbitrary renumbering of stages), but a human-readable log is somewhat useful.
+        # If restart checks are enabled, a fingerprint of the stage's files is appended.
+        # (the journal buffers these; we might not record a stage's completion if we crash,
+        # but this doesn't affect correctness)
         if not checking_pipeline_status:
-            self.finished_stages_fh.write("%d,%s\n" % (index, self.stages[index].getHash()))
-            self.finished_stages_fh.flush()
-        # FIXME flush could turned off as an optimization (more sensibly, a small buffer size could be set)
-        # ... though we might not record a stage's completion, this doesn't affect correctness.
+            if self.restart_check == "command":
+                self.finished_stages_journal.append(index, self.stages[index].getHash())
+            else:
+                self.fingerprints[index] = self.fingerprinter().submit(self.stage_fingerprint, index)
+            if self.intermediates:
+                self.intermediates.consumed(s)
+            if self.scratch:
+                self.scratch.consumed(s)
         for i in self.G.successors(index):
             self.unfinished_pred_counts[i] -= 1
             if self.checkIfRunnable(i):
                 self.enqueue(i)
 
+    def fingerprinter(self):
+        """The threads computing finished stages' fingerprints (started lazily, since threads
+        don't survive the fork into the process running the server)."""
+        if self.fingerprint_pool is None or self.fingerprint_pool[0] != os.getpid():
+            self.fingerprint_pool = (os.getpid(), ThreadPoolExecutor(max_workers=VERIFY_THREADS))
+        return self.fingerprint_pool[1]
+
+    def record_fingerprints(self, block=False):
+        """Journal the finished stages whose fingerprints have been computed (waiting for all of them if `block`)."""
+        for i, f in list(self.fingerprints.items()):
+            if block or f.done():
+                del self.fingerprints[i]
+                try:
+                    fingerprint = f.result()
+                except Exception:
+                    # (the stage is then recorded as with --restart-check=command)
+                    logger.exception("Could not compute the fingerprint of stage %d", i)
+                    fingerprint = None
+                self.finished_stages_journal.append(i, self.stages[i].getHash(), fingerprint)
+
+    def flush_journal(self):
+        self.record_fingerprints(block=True)
+        self.finished_stages_journal.flush()
+
     def removeFromRunning(self, index, clientURI, new_status):
         try:
             self.currently_running_stages.discard(index)
@@ -577,49 +976,97 @@ class Pipeline(object):
             logger.exception("Unable to remove stage %d from client %s's stages: %s", index, clientURI, self.clients[clientURI].running_stages)
         self.removeRunningStageFromClient(clientURI, index)
         self.stages[index].status = new_status
+        self.start_times.pop(index, None)
 
     def setStageLost(self, index, clientURI):
         """Clean up a stage lost due to unresponsive client"""
         logger.warning("Lost Stage %d: %s: ", index, self.stages[index])
+        backup = self.stragglers.backups.get(index) if self.stragglers else None
+        if backup is not None and backup.won:
+            # (the copy had already finished, so the stage needn't run again)
+            del self.stragglers.backups[index]
+            self.promote_backup(index, backup, clientURI)
+            return
+        if backup is not None:
+            self.cancel_backup(index, backup)
         self.removeFromRunning(index, clientURI, new_status = None)
-        self.enqueue(index)
-
-    def setStageFailed(self, index, clientURI):
-        # given an index, sets stage to failed, adds to failed stages array
-        # But... only if this stage has already been retried twice (<- for now static)
-        # Once in while retrying a stage makes sense, because of some odd I/O
-        # read write issue (NFS race condition?). At least that's what I think is 
-        # happening, so trying this to see whether it solves the issue.
-        num_retries = self.stages[index].getNumberOfRetries()
-        if num_retries < 2:
-            # without a sleep statement, the stage will be retried within
-            # a handful of milliseconds, that won't solve anything...
-            # this sleep command will block the server for a small amount
-            # of time, but should happen only sporadically
-            #time.sleep(STAGE_RETRY_INTERVAL)
-            self.removeFromRunning(index, clientURI, new_status = None)
-            self.stages[index].incrementNumberOfRetries()
-            logger.info("RETRYING: ERROR in Stage " + str(index) + ": " + str(self.stages[index]) + "\n"
-                        + "RETRYING: adding this stage back to the runnable set.\n"
-                        + "RETRYING: Logfile for Stage " + str(self.stages[index].logFile) + "\n")
+        # (a stage fused onto another waits for that one to finish again)
+        if self.checkIfRunnable(index):
             self.enqueue(index)
+
+    def setStageFailed(self, index, clientURI, returncode=None, usage=None):
+        """Record a stage's failure, and either schedule a retry (see retries.py) or give up on it and
+        its descendants.  Once in a while a stage fails for reasons which go away (an I/O error, say,
+        or an executor short of memory), so a retry is made after a delay rather than at once; a stage
+        which (probably) ran out of memory is retried with more."""
+        s = self.stages[index]
+        tool = self.tool_name(s)
+        failure = classify(returncode, (usage or {}).get("peak_mem"), s.mem)
+        delay = self.retries.decide(tool, failure, s.getNumberOfRetries())
+        if delay is not None:
+            self.removeFromRunning(index, clientURI, new_status = None)
+            s.incrementNumberOfRetries()
+            if failure == MEMORY:
+                mem = self.retries.escalated_mem(tool, s.mem, self.memAvail)
+                logger.info("Stage %d (probably) ran out of its %.2fG of memory; requesting %.2fG to retry it",
+                            index, s.mem, mem)
+                s.setMem(mem)
+            logger.info("RETRYING: ERROR (%s, return code %s) in Stage %d: %s\n"
+                        "RETRYING: adding this stage back to the runnable set in %.0f s.\n"
+                        "RETRYING: Logfile for Stage %s\n", failure, returncode, index, s, delay, s.logFile)
+            self.retries.schedule(index, delay)
         else:
             self.removeFromRunning(index, clientURI, new_status = "failed")
-            logger.info("ERROR in Stage " + str(index) + ": " + str(self.stages[index]))
+            logger.info("ERROR (%s, return code %s) in Stage %d: %s", failure, returncode, index, s)
             # This is something we should also directly report back to the user:
-            print("\nERROR in Stage %s: %s" % (str(index), str(self.stages[index])))
-            print("Logfile for (potentially) more information:\n%s\n" % self.stages[index].logFile)
+            print("\nERROR in Stage %s: %s" % (str(index), str(s)))
+            print("Logfile for (potentially) more information:\n%s\n" % s.logFile)
             sys.stdout.flush()
             self.failedStages.append(index)
-            for i in nx.dfs_successors(self.G, index).keys():
+            for i in self.G.dfs_successors(index).keys():
                 self.failedStages.append(i)
 
-    @functools.lru_cache(maxsize=None)  # must cache *all* results!
+    def release_due_retries(self):
+        for i in self.retries.due():
+            # (its executor may have been lost in the meantime, in which case it's already been re-enqueued)
+            if self.stages[i].status is None and self.checkIfRunnable(i):
+                self.enqueue(i)
+
+    def run_hooks(self, i, speculative=False):
+        """Run the stage's when-runnable hooks (called from the hook threads; these hooks
+        typically estimate memory from the headers of the stage's input files).
+        A speculative run, for a stage whose dependencies haven't all finished, is abandoned if
+        the hooks fail (e.g., since an input doesn't exist yet) or might see an input which will
+        be overwritten (an output of an unfinished dependency left over from a previous run);
+        the hooks are run again once the stage becomes runnable."""
+        s = self.stages[i]
+        if speculative and any(os.path.exists(f) for p in self.G.predecessors(i)
+                               if not self.stages[p].isFinished()
+                               for f in self.stages[p].outputFiles):
+            return False
+        try:
+            for f in s._runnable_hooks:
+                f(s)
+        except Exception:
+            if speculative:
+                return False
+            logger.exception("Hooks of stage %d failed; using its default resource requirements", i)
+        return True
+
     def prepare_to_run(self, i):
-        """Some pre-run tasks that must only run once
+        """Some pre-run tasks that must only run once, after the stage's hooks
         (in the current model, `enqueue` may run arbitrarily many times!)"""
-        for f in self.stages[i]._runnable_hooks:
-            f(self.stages[i])
+        self.prepared[i] = 1
+        # the hooks' estimates are generic; where we've seen enough similar stages, trust those instead
+        # (the history has been loaded for all tools already, when estimating runtimes)
+        if self.history:
+            s = self.stages[i]
+            mem = self.history.estimate_memory(self.tool_name(s), s.input_voxels)
+            if mem is not None:
+                s.setMem(mem)
+            runtime = self.history.estimate_runtime(self.tool_name(s), s.input_voxels)
+            if runtime is not None:
+                s.estimated_runtime = runtime
         # the easiest place to ensure that all stages request at least
         # the default job mem is here. The hooks above might estimate
         # memory for the jobs, here we'll override that if they requested
@@ -627,16 +1074,157 @@ class Pipeline(object):
         if self.stages[i].mem < self.exec_options.default_job_mem:
             self.stages[i].setMem(self.exec_options.default_job_mem)
         # scale everything by the memory_factor
-        # FIXME this may run several times ... weird !!
         self.stages[i].setMem(self.stages[i].mem * self.exec_options.memory_factor)
 
+    def submit_hooks(self, i, speculative=False):
+        self.hooks_in_flight.add(i)
+        self.hook_runner.submit(i, speculative=speculative)
+
+    def collect_prepared_stages(self, block=False):
+        """Make runnable those stages whose hooks have run since the last call (waiting for
+        at least one outstanding hook run if `block`)."""
+        for i, speculative, ok in self.hook_runner.completed(block=block and bool(self.hooks_in_flight)):
+            self.hooks_in_flight.discard(i)
+            if not ok:
+                # a speculative run was abandoned; if the stage has since become runnable, try again
+                if i in self.awaiting_hooks:
+                    self.submit_hooks(i)
+                continue
+            if not self.prepared[i]:  # (unless it's been prepared meanwhile, having been fused onto its predecessor)
+                self.prepare_to_run(i)
+            if i in self.awaiting_hooks:
+                del self.awaiting_hooks[i]
+                self.make_runnable(i)
+        if self.awaiting_cache:
+            self.collect_cache_lookups(block=block and not self.hooks_in_flight)
+
+    def wait_for_hooks(self):
+        """Wait for all outstanding hook runs (and artifact cache lookups and fingerprints), e.g., before forking the
+        server process (whose hook threads won't know about them)."""
+        self.collect_prepared_stages()
+        while self.hooks_in_flight or self.awaiting_cache:
+            self.collect_prepared_stages(block=True)
+        self.record_fingerprints(block=True)
+
+    def consult_artifact_cache(self, i, _speculative=False):
+        """Look up the stage in the artifact cache (from the cache lookup threads), restoring its outputs
+        and returning True if they're stored there."""
+        s = self.stages[i]
+        if not s.outputFiles:
+            return False
+        try:
+            self.artifact_keys[i] = self.artifacts.stage_key(s.cmd, s.inputFiles, s.outputFiles)
+        except OSError:
+            logger.warning("Could not read the inputs of stage %d to look it up in the artifact cache", i, exc_info=True)
+            return False
+        return self.artifacts.restore(self.artifact_keys[i], s.outputFiles)
+
+    def collect_cache_lookups(self, block=False):
+        for i, _speculative, restored in self.cache_runner.completed(block=block):
+            self.awaiting_cache.discard(i)
+            if restored:
+                self.restored_stages += 1
+                self.setStageFinished(i, clientURI=None)
+            else:
+                self.artifact_keys.setdefault(i, None)
+                self.make_runnable(i)
+
     def enqueue(self, i):
         """Update pipeline data structures and run relevant hooks when a stage becomes runnable."""
         #logger.debug("Queueing stage %d", i)
-        self.runnable.add(i)
-        self.prepare_to_run(i)
-        # keep track of the memory requirements of the runnable jobs
-        self.mem_req_for_runnable.append(self.stages[i].mem)
+        # the hooks may change the stage's memory estimate, so run them before indexing the stage
+        if self.prepared[i]:
+            self.make_runnable(i)
+        else:
+            self.awaiting_hooks[i] = None
+            if i not in self.hooks_in_flight:
+                self.submit_hooks(i)
+
+    def make_runnable(self, i):
+        if self.artifacts and i not in self.artifact_keys:
+            # (a stage is looked up once; if it fails and is retried, it's simply run again)
+            self.awaiting_cache.add(i)
+            self.cache_runner.submit(i)
+            return
+        preferred = None
+        if self.scratch:
+            preferred = self.scratch.preferred_executor(self.stages[i])
+            remote = self.scratch.not_local_to(self.stages[i], preferred)
+            if remote:
+                self.await_copy_out(i, remote)
+                return
+        runtime = self.expected_runtime(i)
+        self.longest_runtime = max(self.longest_runtime, runtime)
+        self.runnable.add(i, mem=self.stages[i].mem, procs=self.stages[i].procs,
+                          priority=self.stage_priority(i), preferred=preferred, runtime=runtime)
+        # wake up (at most) one executor per newly runnable stage
+        self.wake_waiting_client()
+        self.speculate(i)
+
+    def await_copy_out(self, i, paths):
+        """Hold back stage `i` until the given inputs have been copied out of scratch space."""
+        self.awaiting_copy_out[i] = set(paths)
+        for f in paths:
+            holder = self.scratch.copy_out(f)
+            if holder is not None:
+                logger.debug("Asking %s to copy %s out of scratch space", holder, f)
+                self.notifier.notify(holder)
+
+    def files_copied_out(self, paths):
+        for f in paths:
+            self.scratch.copied_out(f)
+        for i, waiting_for in list(self.awaiting_copy_out.items()):
+            waiting_for.difference_update(paths)
+            if not waiting_for:
+                del self.awaiting_copy_out[i]
+                self.make_runnable(i)
+
+    def recreate_lost_files(self, lost):
+        """Re-run the stages which wrote the given intermediate files, lost along with the executor
+        holding them in its scratch space (and, in turn, those which wrote any of their inputs which
+        have since been deleted).  Their unfinished successors wait for them to finish again."""
+        rerun = set()
+        to_check = {self.scratch.producers[f] for f in lost}
+        while to_check:
+            p = to_check.pop()
+            if p in rerun or not self.stages[p].isFinished():
+                continue
+            rerun.add(p)
+            to_check.update(self.scratch.producers[f] for f in self.stages[p].inputFiles
+                            if f in self.scratch.producers and f not in self.scratch.holders
+                            and not os.path.exists(f))
+        logger.warning("Re-running %d finished stages to re-create %d lost intermediate files", len(rerun), len(lost))
+        for p in rerun:
+            self.stages[p].setNone()
+            self.num_finished_stages -= 1
+            for j in self.G.successors(p):
+                self.unfinished_pred_counts[j] += 1
+                self.runnable.discard(j)
+                self.awaiting_hooks.pop(j, None)
+                self.awaiting_copy_out.pop(j, None)
+        for p in rerun:
+            if self.checkIfRunnable(p):
+                self.enqueue(p)
+
+    def wake_waiting_client(self):
+        # (also called from the hook threads, hence `popitem`, which is atomic)
+        try:
+            clientURI, _ = self.waiting_clients.popitem(last=False)
+        except KeyError:
+            return
+        self.notifier.notify(clientURI)
+
+    def speculate(self, i):
+        """Run the hooks of the stages up to `SPECULATION_DEPTH` levels below stage `i` ahead of time,
+        so they're likely to have run by the time those stages become runnable."""
+        level = [i]
+        for _ in range(SPECULATION_DEPTH):
+            level = [k for j in level for k in self.G.successors(j)]
+            for k in level:
+                if not (self.prepared[k] or self.speculated[k] or k in self.hooks_in_flight
+                        or self.stages[k].isFinished()):
+                    self.speculated[k] = 1
+                    self.submit_hooks(k, speculative=True)
 
     """
         Returns True unless all stages are finished, then False
@@ -650,6 +1238,17 @@ class Pipeline(object):
     def continueLoop(self):
         if self.verbose:
             print('.', end="", flush=True)
+        # write out finished stages even if none have finished for a while
+        self.record_fingerprints()
+        self.finished_stages_journal.flush_if_due()
+        if self.history:
+            self.history.flush_if_due()
+        self.write_snapshot_if_due()
+        self.release_reserved_stages()
+        self.release_due_retries()
+        self.collect_prepared_stages()
+        if self.stragglers:
+            self.collect_backup_work()
         # We may be have been called one last time just as the parent thread is exiting
         # (if it wakes us with a signal).  In this case, don't do anything:
         if self.shutdown_ev.is_set():
@@ -665,7 +1264,13 @@ class Pipeline(object):
         # (e.g., if some stages have repeatedly failed)
         # TODO this might indicate a bug, so better reporting would be useful
         elif (len(self.runnable) == 0
-            and len(self.currently_running_stages) == 0):
+            and len(self.currently_running_stages) == 0
+            and not self.awaiting_hooks
+            and not self.awaiting_copy_out
+            and not self.awaiting_cache
+            and not self.reserved
+            and not self.retries
+            and not (self.stragglers and self.stragglers.promoting)):
             logger.info("ERROR: no more runnable stages, however not all stages have finished. Going to shut down.")
             print("\nERROR: no more runnable stages, however not all stages have finished. Going to shut down.\n")
             sys.stdout.flush()
@@ -719,6 +1324,170 @@ class Pipeline(object):
             logger.exception("clientURI not found in server client list:")
             raise
 
+    def reportStageResults(self, clientURI, results, tick=None, held=(), copied_out=(), not_run=()):
+        """Record the outcomes of several stages run by an executor in one call.
+        `results` is a list of (stage index, return code, resource usage) triples (a return code
+        other than 0, including None, is a failure; the usage is a dict with the stage's wall_time,
+        cpu_time and peak_mem, or None); if `tick` is given, this also serves as the executor's heartbeat.
+        With --local-scratch, the executor also reports the files it now `held` in its scratch space
+        and those it has `copied_out`, and gets back the files it should copy out or delete (or None).
+        With --fuse-stages, the executor also returns the stages it was given but didn't run (`not_run`),
+        since a stage they were fused onto failed.  With --backup-stragglers, the requests may also list stages
+        the executor should `cancel`."""
+        if tick is not None:
+            self.updateClientTimestamp(clientURI, tick)
+        if (results or not_run) and self.handed_off:
+            # these stages are recorded as running; the executor should report them to the next server
+            raise Exception("server has handed off its running stages")
+        if self.scratch:
+            self.scratch.hold(clientURI, held)
+            self.files_copied_out(copied_out)
+        for index, returncode, usage in results:
+            if self.stragglers and self.backup_result(index, returncode, clientURI):
+                continue
+            if returncode == 0:
+                if usage and self.history:
+                    s = self.stages[index]
+                    self.history.record(self.tool_name(s), s.input_voxels, **usage)
+                if self.stragglers and index in self.start_times:
+                    self.stragglers.finished(self.peer_group(index), time.time() - self.start_times[index])
+                self.setStageFinished(index, clientURI)
+            else:
+                logger.debug("Stage %d failed on %s. Return code: %s", index, clientURI, returncode)
+                self.setStageFailed(index, clientURI, returncode, usage)
+        for index in not_run:
+            # (it's enqueued as usual once the stage it was fused onto has finished)
+            logger.debug("Stage %d wasn't run on %s", index, clientURI)
+            self.removeFromRunning(index, clientURI, new_status=None)
+        requests = self.scratch.take_requests(clientURI) if self.scratch else None
+        cancel = self.cancellations.pop(clientURI, None)
+        if cancel:
+            requests = dict(requests or {}, cancel=sorted(cancel))
+        return requests
+
+    def peer_group(self, i):
+        return (self.tool_name(self.stages[i]), self.generations[i])
+
+    def can_back_up(self, i, mem_free, procs_free):
+        s = self.stages[i]
+        if not isinstance(s, CmdStage) or not s.outputFiles or s.mem > mem_free + MEM_EPS or s.procs > procs_free:
+            return False
+        # (a stage fused onto another, or with another fused onto it, only runs as part of its chain)
+        if self.fused_next is not None and (self.fused_next[i] >= 0
+                                            or any(self.fused_next[p] == i for p in self.G.predecessors(i))):
+            return False
+        return all(mentions(s.cmd, f) for f in s.outputFiles)
+
+    def back_up_straggler(self, clientURI, mem_free, procs_free):
+        """With --backup-stragglers, the `StageInfo` of a copy of a straggling stage (see stragglers.py), writing
+        its outputs to a private location, for the given executor to run if it's idle (or None).  A copy of the
+        running stage furthest past the runtimes of its peers is first prepared, its output directories being
+        created in the background, and handed to an idle executor once it's ready."""
+        client = self.clients.get(clientURI)
+        if (client is None or client.running_stages
+                or any(b.client == clientURI for b in self.stragglers.backups.values())):
+            return None
+        for i, backup in self.stragglers.backups.items():
+            if backup.ready and backup.client is None and self.can_back_up(i, mem_free, procs_free):
+                backup.client = clientURI
+                self.stragglers.launched += 1
+                logger.info("Running a copy of stage %d on %s", i, clientURI)
+                s = self.stages[i]
+                return pe.StageInfo(mem=s.mem, procs=s.procs, ix=i, cmd=redirect(s.cmd, backup.outputs),
+                                    log_file=s.logFile + ".backup")
+        now = time.time()
+        straggler, overrun = None, 1.0
+        for i in self.currently_running_stages:
+            if i in self.stragglers.backups or i not in self.start_times:
+                continue
+            threshold = self.stragglers.threshold(self.peer_group(i))
+            if threshold is None:
+                continue
+            o = (now - self.start_times[i]) / max(threshold, 1.0)
+            if o > overrun and self.can_back_up(i, mem_free, procs_free):
+                straggler, overrun = i, o
+        if straggler is None:
+            return None
+        logger.info("Stage %d has run for %.0f s, %.1f times as long as most of its peers; preparing a copy",
+                    straggler, now - self.start_times[straggler], overrun)
+        backup = Backup(straggler, self.stages[straggler].outputFiles)
+        self.stragglers.backups[straggler] = backup
+        self.stragglers.submit(straggler, backup, "create_dirs")
+        return None
+
+    def backup_result(self, index, returncode, clientURI):
+        """Deal with the outcome of a stage which has a backup copy, or of the copy itself, returning whether
+        that's all there is to do (otherwise, it's the outcome of the original, to be recorded as usual)."""
+        backup = self.stragglers.backups.get(index)
+        if backup is None:
+            return False
+        client = self.clients.get(clientURI)
+        if clientURI == backup.client and not (client and index in client.running_stages):
+            if returncode == 0 and not backup.cancelled:
+                # the copy finished first, so stop the original; its outputs are replaced once it has stopped
+                backup.won = True
+                original = next((c for c, client in self.clients.items() if index in client.running_stages), None)
+                logger.info("The copy of stage %d on %s finished first; cancelling the original on %s",
+                            index, clientURI, original)
+                if original is not None:
+                    self.request_cancellation(original, index)
+            else:
+                if not backup.cancelled:
+                    logger.info("The copy of stage %d failed on %s", index, clientURI)
+                del self.stragglers.backups[index]
+                self.stragglers.submit(index, backup, "remove")
+            return True
+        if backup.won:
+            del self.stragglers.backups[index]
+            if returncode == 0:
+                # (the original finished before it could be cancelled)
+                self.stragglers.submit(index, backup, "remove")
+                self.setStageFinished(index, clientURI)
+            else:
+                self.promote_backup(index, backup, clientURI)
+            return True
+        self.cancel_backup(index, backup)
+        return False
+
+    def promote_backup(self, index, backup, clientURI):
+        """Once the original has stopped on the given executor, have the outputs of the copy which finished first
+        moved into place; the stage is finished once they're there (see `collect_backup_work`)."""
+        logger.info("Moving the outputs of the copy of stage %d into place", index)
+        self.removeFromRunning(index, clientURI, new_status=None)
+        self.stragglers.promoting.add(index)
+        self.stragglers.submit(index, backup, "promote")
+
+    def cancel_backup(self, index, backup):
+        if backup.client is None:
+            # (it hasn't been handed out yet)
+            del self.stragglers.backups[index]
+            self.stragglers.submit(index, backup, "remove")
+        elif not backup.cancelled:
+            backup.cancelled = True
+            self.request_cancellation(backup.client, index)
+
+    def collect_backup_work(self, block=False):
+        """Act on the copies' files having been dealt with (see `Stragglers.submit`), waiting for
+        all outstanding work if `block`."""
+        for index, backup, action, ok in self.stragglers.completed(block=block):
+            if action == "create_dirs" and ok and self.stragglers.backups.get(index) is backup:
+                # (a copy whose directories couldn't be created is never handed out)
+                backup.ready = True
+                self.wake_waiting_client()
+            elif action == "promote":
+                self.stragglers.promoting.discard(index)
+                if ok:
+                    self.stragglers.won += 1
+                    self.setStageFinished(index, clientURI=None)
+                elif self.checkIfRunnable(index):
+                    # (the stage has to be run again)
+                    self.enqueue(index)
+
+    def request_cancellation(self, clientURI, index):
+        """Have the executor stop running the stage (it's told when it next reports, so wake it up)."""
+        self.cancellations.setdefault(clientURI, set()).add(index)
+        self.notifier.notify(clientURI)
+
     # requires: stages != []
     # a better interface might be (self, [stage]) -> { MemAmount : (NumStages, [Stage]) }
     # or maybe the same using a heap (to facilitate getting N stages with most memory)
@@ -734,13 +1503,11 @@ class Pipeline(object):
         logger.debug("Checking if executors need to be launched ...")
         executors_to_launch = self.numberOfExecutorsToLaunch()
         if executors_to_launch > 0:
+            # (with --autoscale, executors are also launched for stages expected to become runnable soon)
+            stages = list(self.runnable) + (self.autoscaler.forecast_stages if self.autoscaler else [])
             # RAM needed to run a single job:
-            max_memory_stage = self.highest_memory_stage(self.runnable)
+            max_memory_stage = self.highest_memory_stage(stages)
             memNeeded = max_memory_stage.mem  # self.max_memory_required(self.runnable)
-            # RAM needed to run `proc` most expensive jobs (not the ideal choice):
-            memWanted = sum(sorted([self.stages[i].mem for i in self.runnable],
-                                   key = lambda x: -x)[0:self.exec_options.proc])
-            logger.debug("wanted: %s", memWanted)
             logger.debug("needed: %s", memNeeded)
 
             if memNeeded > self.memAvail:
@@ -749,15 +1516,18 @@ class Pipeline(object):
                 logger.error(msg)
                 print(msg)
             else:
-                if self.exec_options.greedy:
-                    mem = self.memAvail
-                elif memWanted <= self.memAvail:
-                    mem = memWanted
-                else:
-                    mem = self.memAvail  #memNeeded?
+                # executors of each size class get enough RAM to run `proc` of the most expensive jobs
+                # of their class (not the ideal choice)
+                fleet = executor_fleet([self.stages[i].mem for i in stages], number=executors_to_launch,
+                                       procs=self.exec_options.proc, max_mem=self.memAvail,
+                                       max_classes=self.exec_options.executor_size_classes,
+                                       greedy=self.exec_options.greedy)
+                self.executor_classes = [(largest, mem) for largest, mem, _number in fleet]
                 try:
-                    self.launchExecutorsFromServer(executors_to_launch, mem)
-                    print("\nSubmitted " + str(executors_to_launch) + " executors (clients) to the queue."
+                    for largest, mem, number in fleet:
+                        logger.debug("wanted: %s for each of %d executors (stages of up to %.2fG)", mem, number, largest)
+                        self.launchExecutorsFromServer(number, mem)
+                    print("\nSubmitted " + str(sum(number for _, _, number in fleet)) + " executors (clients) to the queue."
                           "\nWaiting for them to register with the server...")
                 except pe.SubmitError:
                     logger.exception("Failed to submit executors; will retry")
@@ -796,11 +1566,13 @@ class Pipeline(object):
         than the number of executors the server is able to launch
     """
     def numberOfExecutorsToLaunch(self):
+        if self.autoscaler:
+            self.autoscaler.to_launch = self.autoscaler.surplus = 0
         if self.failed_executors > self.exec_options.max_failed_executors:
             return 0
 
         if (len(self.runnable) > 0 and
-            self.max_memory_required(self.runnable) > self.memAvail):
+            self.runnable.max_mem() > self.memAvail):
             # we might still want to launch executors for the stages with smaller
             # requirements
             return 0
@@ -811,6 +1583,9 @@ class Pipeline(object):
             # can kill themselves, because the server is now responsible 
             # for the initial launches as well.
             active_executors = self.number_launched_and_waiting_clients + len(self.clients)
+            if self.autoscaler:
+                self.forecast_executors(active_executors)
+                return self.autoscaler.to_launch
             desired_num_executors = min(len(self.runnable), self.exec_options.num_exec)
             executor_launch_room = desired_num_executors - active_executors
             # there are runnable stages, and there is room to launch 
@@ -818,13 +1593,54 @@ class Pipeline(object):
             return max(executor_launch_room, 0)
         else:
             return 0
-        
+
+    def forecast_executors(self, active_executors):
+        """With --autoscale, forecast the number of stages running or waiting to run once executors launched
+        now could arrive, and until then, and plan how many executors to launch or let go accordingly
+        (like `numberOfExecutorsToLaunch`, counting one executor per stage)."""
+        a = self.autoscaler
+        now = time.time()
+        runtime = self.expected_runtime
+        waiting = sorted(itertools.chain(self.runnable, self.awaiting_hooks, self.awaiting_copy_out),
+                         key=lambda i: -self.priorities[i])
+        running = { i : max(runtime(i) - (now - self.start_times.get(i, now)), 0.0)
+                    for i in self.currently_running_stages }
+        # (only the executors which have registered run stages in the meantime)
+        slots = len(self.clients) - len(a.retiring)
+        a.forecast_stages = []
+        def demand(since, until, became_runnable=None):
+            return forecast_demand(waiting, running, self.G.successors, self.unfinished_pred_counts.__getitem__,
+                                   runtime, slots=slots, since=since, until=until, became_runnable=became_runnable)
+        a.plan(demand_on_arrival=demand(a.queue_wait, a.horizon, became_runnable=a.forecast_stages),
+               demand_until_replaced=demand(0, a.queue_wait),
+               active=active_executors - len(a.retiring), max_executors=self.exec_options.num_exec)
+        if not waiting and not a.forecast_stages:
+            # (new executors would have nothing to do, even if more stages are running than there are executors)
+            a.to_launch = 0
+
+    def release_idle_executor(self, clientURI):
+        """With --autoscale, whether to tell the given idle executor to exit, there being more executors than
+        the forecast demand (but not one holding intermediate files in its scratch space, which it would
+        first have to copy out)."""
+        a = self.autoscaler
+        client = self.clients.get(clientURI)
+        if (a is None or a.surplus == 0 or client is None or client.running_stages or clientURI in a.retiring
+                or (self.scratch and clientURI in self.scratch.holders.values())):
+            return False
+        a.surplus -= 1
+        a.retiring.add(clientURI)
+        self.waiting_clients.pop(clientURI, None)
+        logger.info("Telling idle executor %s to exit, since fewer executors are needed for now", clientURI)
+        return True
+
     def launchExecutorsFromServer(self, number_to_launch, memNeeded):
         logger.info("Launching %i executors", number_to_launch)
         try:
             launchPipelineExecutors(options=self.options, number=number_to_launch,
                                     mem_needed=memNeeded, uri_file=self.exec_options.urifile)
             self.number_launched_and_waiting_clients += number_to_launch
+            if self.autoscaler:
+                self.autoscaler.launched(number_to_launch)
         except:
             logger.exception("Failed launching executors from the server.")
             raise
@@ -832,16 +1648,20 @@ class Pipeline(object):
     def getProcessedStageCount(self):
         return self.num_finished_stages
 
-    def registerClient(self, clientURI, maxmemory):
+    def registerClient(self, clientURI, maxmemory, time_left=None):
         # Adds new client (represented by a URI string)
         # to array of registered clients. If the server launched
         # its own clients, we should remove 1 from the number of launched and waiting
         # clients (It's possible though that users launch clients themselves. In that 
         # case we should not decrease this variable)
         # FIXME this is a completely broken way to decide whether to decrement ...
-        self.clients[clientURI] = ExecClient(clientURI, maxmemory)
+        # An executor running as a batch job also tells us how much of its walltime is left (in seconds),
+        # so that it's not given stages it won't finish (see `pop_runnable`).
+        self.clients[clientURI] = ExecClient(clientURI, maxmemory, time_left)
         if self.number_launched_and_waiting_clients > 0:
             self.number_launched_and_waiting_clients -= 1
+            if self.autoscaler:
+                self.autoscaler.registered()
         logger.debug("Client registered (Eh!): %s", clientURI)
         if self.verbose:
             print("\nClient registered (Eh!): %s" % clientURI, end="")
@@ -853,9 +1673,23 @@ class Pipeline(object):
         # and the server may call it when a client is unresponsive
         logger.debug("unregisterClient: un-registering %s", clientURI)
         try:
+            self.waiting_clients.pop(clientURI, None)
+            if self.autoscaler:
+                self.autoscaler.retiring.discard(clientURI)
+            self.cancellations.pop(clientURI, None)
+            if self.stragglers:
+                # (the outputs of a copy which has already finished are still good)
+                for i, backup in list(self.stragglers.backups.items()):
+                    if backup.client == clientURI and not backup.won:
+                        del self.stragglers.backups[i]
+                        self.stragglers.submit(i, backup, "remove")
             for s in self.clients[clientURI].running_stages.copy():
                 self.setStageLost(s, clientURI)
             del self.clients[clientURI]
+            if self.scratch:
+                lost = self.scratch.lost(clientURI)
+                if lost:
+                    self.recreate_lost_files(lost)
         except:
             if self.verbose:
                 print("\nUnable to un-register client: " + clientURI)
@@ -870,62 +1704,219 @@ class Pipeline(object):
 
     def skip_completed_stages(self):
         logger.debug("Consulting logs to determine skippable stages...")
-        try:
-            with open(self.backupFileLocation, 'r') as fh:
-                # a stage's index is just an artifact of the graph construction,
-                # so load only the hashes of finished stages
-                previous_hashes = frozenset((e.split(',')[1] for e in fh.read().split()))
-        except:
-            logger.info("Finished stages log doesn't exist or is corrupt.")
+        # a stage's index is just an artifact of the graph construction,
+        # so load only the hashes of finished stages (and the fingerprints of
+        # their files, if recorded; the most recent record of a stage wins)
+        previous_fingerprints = { h : fingerprint
+                                  for _ix, h, fingerprint in self.finished_stages_journal.records() }
+        if not previous_fingerprints:
+            logger.info("Finished stages log doesn't exist or is empty.")
             return
 
-        runnable  = []
-        finished  = []
-        completed = 0
-        while True:
-            # self.runnable should be populated initially by the graph heads.
-            # Traverse the graph by removing stages from the runnable set and,
-            # if they don't need to be re-run, adding their dependencies to that set
-            # (via setStageFinished); if they do, accumulate them.  Once this set is emptied,
-            # we have computed a set of stages which must and can be run
-            # (either because the input/output filenames or command has changed
-            # or because an ancestor has re-run, i.e., the files themselves have changed)
-            # but whose ancestors have already been run
-            flag,i = self.getRunnableStageIndex()
-            if i == None:
-                break
-
-            s = self.getStage(i)
-
+        signatures = {}
+        if self.restart_check != "command":
+            # examine the files of all stages which might be skipped up front, in parallel,
+            # rather than one at a time during the traversal below
+            starttime = time.time()
+            signatures = file_signatures((f for i, s in enumerate(self.stages)
+                                          if isinstance(s, CmdStage) and s.getHash() in previous_fingerprints
+                                          for f in self.stage_files(i)),
+                                         check=self.restart_check)
+            logger.info("Checked %d files of previously finished stages in %.2f s",
+                        len(signatures), time.time() - starttime)
+        # A single pass over the stages in topological order (so that a stage is considered after all
+        # its predecessors): a stage is skipped if its command was run before (and, if checked,
+        # its files are unchanged since) and all its predecessors are skipped as well, i.e.,
+        # nothing it depends on will be re-run (if the input/output filenames or command have
+        # changed, or an ancestor is re-run, i.e., the files themselves will change, it must run again).
+        # This touches neither the runnable index nor the stages' hooks.
+        invalidated = 0
+        finished = []
+        for i in self.G.topological_sort():
+            s = self.stages[i]
             if not isinstance(s, CmdStage):
-                runnable.append(i)
                 continue
-
-            h = s.getHash()
-
             # we've never run this command before
-            if not h in previous_hashes:
-                runnable.append(i)
+            h = s.getHash()
+            if h not in previous_fingerprints:
+                continue
+            if not all(self.stages[p].isFinished() for p in self.G.predecessors(i)):
                 continue
 
-            self.setStageFinished(i, clientURI = "fake_client_URI", checking_pipeline_status = True)
-
-            finished.append((i, h))  # stupid ... duplicates logic in setStageFinished ...
-            completed += 1
+            fingerprint = self.stage_fingerprint(i, signature=signatures.get)
+            previous = previous_fingerprints[h]
+            # the stage's files have changed since it ran (or its outputs have gone missing), so re-run it
+            # (and, by not marking it finished, everything downstream).  Stages finished without
+            # a fingerprint being recorded (or recorded by a different check) are trusted as before.
+            if fingerprint and previous and previous.split(':')[0] == self.restart_check and previous != fingerprint:
+                invalidated += 1
+                continue
 
-        logger.debug("Runnable: %s", runnable)
-        for i in runnable:
-            self.enqueue(i)
-        with open(self.backupFileLocation, 'w') as fh:
-            # TODO For further optimization, it might (?) be even faster to write to memory and then
-            # make a single file write when finished.
-            # FIXME should write to tmp file in same dir, then overwrite (?) since a otherwise an interruption
-            # in writing this file will cause progress to be lost
-            for l in finished:
-                fh.write("%d,%s\n" % l)
-        logger.info('Previously completed stages (of %d total): %d', len(self.stages), completed)
+            s.status = "finished"
+            # (keep any fingerprint we didn't check, so it's still there for a later restart)
+            finished.append((i, h, fingerprint or previous))
+
+        if self.intermediate_files:
+            rerun = self.rerun_producers_of_deleted_intermediates()
+            finished = [f for f in finished if f[0] not in rerun]
+        self.num_finished_stages += len(finished)
+        self.percent_finished_reported = math.floor(self.num_finished_stages / len(self.stages) * 100)
+        self.count_unfinished_predecessors()
+        # drop the records of stages which no longer exist or must be re-run
+        self.finished_stages_journal.compact(finished)
+        logger.info('Previously completed stages (of %d total): %d', len(self.stages), len(finished))
+        if self.restart_check != "command":
+            logger.info('Previously completed stages re-run due to changed files: %d', invalidated)
+
+    def rerun_producers_of_deleted_intermediates(self):
+        """Having skipped the previously completed stages, un-skip those whose intermediate outputs
+        have been deleted (or were left in scratch space) but are needed by stages which will run
+        (and so on, for their own inputs)."""
+        files = self.intermediate_files
+        rerun = set()
+        to_run = [i for i, s in enumerate(self.stages) if not s.isFinished()]
+        while to_run:
+            needed = {(p, f) for i in to_run for p in self.G.predecessors(i) if self.stages[p].isFinished()
+                      for f in self.stages[i].inputFiles if f in files and f in self.stages[p].outputFiles}
+            signatures = file_signatures((f for _, f in needed), check="stat")
+            to_run = sorted({p for p, f in needed if signatures[f] == "missing"})
+            for p in to_run:
+                self.stages[p].setNone()
+            rerun.update(to_run)
+        logger.info("Previously completed stages re-run to re-create deleted intermediate files: %d", len(rerun))
+        return rerun
+
+    def snapshot_state(self):
+        """The part of the scheduler state which is costly to reconstruct: the stages themselves
+        (including their memory estimates, hooks and retry counts), the dependency graph and the
+        priorities, and which stages' hooks have already run."""
+        return dict(stages=self.stages, G=self.G, priorities=self.priorities,
+                    prepared=bytes(self.prepared))
+
+    def write_snapshot(self):
+        if self.snapshot_path is None:
+            return
+        starttime = time.time()
+        # (the journal must be at least as recent as the snapshot, since it's consulted on resuming)
+        self.flush_journal()
+        try:
+            write_snapshot(self.snapshot_path, self.definition_key, self.snapshot_state())
+        except (pickle.PicklingError, AttributeError, TypeError):
+            # e.g., a stage has a hook which is a closure
+            logger.warning("Could not pickle the pipeline's stages; not saving scheduler snapshots",
+                           exc_info=True)
+            self.snapshot_path = None
+        except OSError:
+            logger.exception("Could not write scheduler snapshot %s", self.snapshot_path)
+        else:
+            logger.info("Wrote scheduler snapshot in %.2f s", time.time() - starttime)
+        self.snapshot_time = time.time()
+
+    def write_snapshot_if_due(self):
+        if self.snapshot_path is not None and time.time() - self.snapshot_time > SNAPSHOT_INTERVAL:
+            self.write_snapshot()
+
+    @classmethod
+    def from_snapshot(cls, path, key, options):
+        """A pipeline restored from the snapshot at `path`, or None if there isn't a usable one
+        made from the same pipeline definition (see `snapshot.definition_key`).
+        As after constructing a pipeline, the previously completed stages are skipped
+        by consulting the finished stages log."""
+        starttime = time.time()
+        state = read_snapshot(path, key)
+        if state is None:
+            return None
+        p = cls([], options)
+        p.stages, p.G, p.priorities = state['stages'], state['G'], state['priorities']
+        p.prepared = bytearray(state['prepared'])
+        p.speculated = bytearray(len(p.stages))
+        for s in p.stages:
+            s.setNone()
+        p.count_unfinished_predecessors()
+        p.track_intermediates()
+        p.find_fusible_links()
+        p.track_stragglers()
+        p.snapshot_path, p.definition_key = path, key
+        logger.info("Restored %d stages from scheduler snapshot in %.2f s",
+                    len(p.stages), time.time() - starttime)
+        return p
+
+    def hand_off_running_stages(self):
+        """Record the running stages for the next server (see handoff.py) and stop accepting their
+        results, which their executors will report to that server instead."""
+        self.handed_off = True
+        write_running_stages(self.running_stages_location,
+                             { i : self.stages[i].getHash() for i in self.currently_running_stages })
+        logger.info("Handed off %d running stages", len(self.currently_running_stages))
+
+    def reserve_handed_off_stages(self):
+        """Hold back the stages which were running when the previous server handed them off
+        (unless they've since finished or changed), giving their executors until they'd be
+        considered dead to hand them over to us; see `adoptStages`."""
+        running = read_running_stages(self.running_stages_location)
+        if not running:
+            return
+        for i, h in running.items():
+            if i < len(self.stages) and self.stages[i].getHash() == h and not self.stages[i].isFinished():
+                self.reserved[i] = None
+        self.reserved_until = time.time() + pe.HEARTBEAT_INTERVAL + self.exec_options.latency_tolerance
+        os.remove(self.running_stages_location)
+        logger.info("Holding back %d stages handed off by the previous server", len(self.reserved))
+
+    def release_reserved_stages(self):
+        if self.reserved and time.time() > self.reserved_until:
+            logger.info("%d stages handed off by the previous server weren't handed over; re-running them",
+                        len(self.reserved))
+            reserved, self.reserved = self.reserved, {}
+            for i in reserved:
+                if self.checkIfRunnable(i):
+                    self.enqueue(i)
+
+    def adoptStages(self, clientURI, stages):
+        """Take over stages which a (registered) executor was running for the previous server.
+        `stages` is a list of (index, command) pairs; returns the indices of the stages adopted.
+        Stages which are unknown to us (the previous server's stage with this index had a different
+        command), have finished or are already running elsewhere are refused, and the executor
+        should forget about them."""
+        adopted = []
+        for i, cmd in stages:
+            s = self.stages[i] if 0 <= i < len(self.stages) else None
+            if (not isinstance(s, CmdStage) or s.cmd != list(cmd)
+                  or s.isFinished() or s.status == "running"):
+                logger.warning("Refusing to adopt stage %d from %s", i, clientURI)
+                continue
+            self.reserved.pop(i, None)
+            self.runnable.discard(i)
+            self.awaiting_hooks.pop(i, None)
+            self.setStageStarted(i, clientURI)
+            adopted.append(i)
+        logger.info("Adopted %d stages from %s", len(adopted), clientURI)
+        return adopted
 
     def printShutdownMessage(self):
+        if self.exec_options.handoff and not self.allStagesCompleted():
+            self.hand_off_running_stages()
+        self.flush_journal()
+        if self.intermediates:
+            logger.info("Deleted %d intermediate files (%.2fG)",
+                        self.intermediates.deleted, self.intermediates.freed_bytes / 2**30)
+        if self.retries.failures:
+            logger.info(self.retries.report())
+        if self.stragglers:
+            logger.info(self.stragglers.report())
+            print("\n" + self.stragglers.report())
+        if self.artifacts:
+            logger.info("Restored the outputs of %d stages from the artifact cache", self.restored_stages)
+            if self.exec_options.artifact_cache_size is not None:
+                self.artifacts.prune(max_bytes=self.exec_options.artifact_cache_size * 2**30)
+        if self.history:
+            self.history.flush()
+        if self.snapshot_path is not None:
+            if self.allStagesCompleted():
+                if os.path.exists(self.snapshot_path):
+                    os.remove(self.snapshot_path)
+            else:
+                self.write_snapshot()
         # it is possible that pipeline.continueLoop returns false, even though the
         # pipeline is not completed (for instance, when stages failed, and no more stages
         # can be run) so check that in order to provide the correct feedback to the user
@@ -934,6 +1925,10 @@ class Pipeline(object):
         if self.allStagesCompleted():
             print("All pipeline stages have been processed.")
             print("Pipeline finished successfully!")
+        elif self.handed_off:
+            print("Not all pipeline stages have been processed;")
+            print("%d running stages will be handed over to the next server."
+                  % len(self.currently_running_stages))
         else:
             print("Not all pipeline stages have been processed,")
             print("however there are no more stages that can be run.")
@@ -1063,14 +2058,11 @@ def launchServer(pipeline):
         h.start()
         #del pipeline   # `top` shows this has no effect on vmem
 
-        try:
-            jid    = os.environ["PBS_JOBID"]
-            output = subprocess.check_output(['qstat', '-f', jid], stderr=subprocess.STDOUT)
-
-            time_left = int(re.search('Walltime.Remaining = (\d*)', output).group(1))
+        time_left = remaining_walltime()
+        if time_left is not None:
             logger.debug("Time remaining: %d s" % time_left)
             time_to_live = time_left - shutdown_time
-        except:
+        else:
             logger.info("I couldn't determine your remaining walltime from qstat.")
             time_to_live = None
         flag = e.wait(time_to_live)
@@ -1128,8 +2120,21 @@ def pipelineDaemon(pipeline, options, programName=None):
 
     if options.application.restart:
         pipeline.skip_completed_stages()
-
-    if len(pipeline.runnable) == 0:
+        if options.execution.handoff:
+            pipeline.reserve_handed_off_stages()
+    if pipeline.intermediates:
+        pipeline.intermediates.count_consumers(pipeline.stages)
+    if pipeline.scratch:
+        pipeline.scratch.count_consumers(pipeline.stages)
+    pipeline.enqueue_runnable_stages()
+    # the stages now runnable can't be handed out until their hooks have run
+    pipeline.wait_for_hooks()
+
+    if pipeline.restored_stages and pipeline.allStagesCompleted():
+        # (the outputs of all the remaining stages were restored from the artifact cache)
+        pipeline.printShutdownMessage()
+        sys.exit()
+    if len(pipeline.runnable) == 0 and not pipeline.reserved:
         print("\nPipeline has no runnable stages. Exiting...")
         sys.exit()
    
@@ -1140,12 +2145,10 @@ def pipelineDaemon(pipeline, options, programName=None):
     
     pipeline.programName = programName
     try:
-        # we are now appending to the stages file since we've already written
-        # previously completed stages to it in skip_completed_stages
-        with open(pipeline.backupFileLocation, 'a') as fh:
-            pipeline.finished_stages_fh = fh
-            logger.debug("Starting server...")
-            launchServer(pipeline)
+        # the server appends to the finished stages log (which skip_completed_stages
+        # has compacted to the previously completed stages)
+        logger.debug("Starting server...")
+        launchServer(pipeline)
     except:
         logger.exception("Exception (=> quitting): ")
         raise
@@ -8,7 +8,11 @@ from datetime import datetime
 from multiprocessing import Process, Pool, Lock # type: ignore
 import subprocess
 import shlex
+import shutil
+import tempfile
 import pydpiper.execution.queueing as q
+from pydpiper.execution.scratch import LocalScratch
+from pydpiper.execution.artifact_cache import ArtifactCache
 import math as m
 import logging
 import socket
@@ -16,7 +20,7 @@ import signal
 import threading
 os.environ["PYRO_LOGLEVEL"] = os.getenv("PYRO_LOGLEVEL", "INFO")
 import Pyro4       # type: ignore
-from typing import Any
+from typing import Any, Dict, Set
 
 from pyminc.volumes.volumes import mincException
 
@@ -34,6 +38,14 @@ for boring_exception, name in [(mincException, "mincException"), (SubmitError, "
 #TODO add these to executorArgumentGroup as options, pass into pipelineExecutor
 EXECUTOR_MAIN_LOOP_INTERVAL = 30.0
 HEARTBEAT_INTERVAL = EXECUTOR_MAIN_LOOP_INTERVAL  # Logically necessary since the two threads have been merged
+# number of times to try (re)connecting to the server before giving up, and the pause between tries
+SERVER_CONNECT_ATTEMPTS = 5
+SERVER_CONNECT_RETRY_INTERVAL = 2.0
+# how often to look for the next server while waiting to hand over our stages (see --handoff)
+HANDOFF_POLL_INTERVAL = 10.0
+# environment variables set by the queueing systems (PBS/Torque, Slurm, SGE) in a batch job (which has a
+# walltime, unlike an executor run directly)
+BATCH_JOB_ENV_VARS = ["PBS_JOBID", "SLURM_JOB_ID", "JOB_ID"]
 #SHUTDOWN_TIME = EXECUTOR_MAIN_LOOP_INTERVAL + LATENCY_TOLERANCE
 
 logger = logging # type: Any
@@ -59,26 +71,14 @@ def launchExecutor(executor):
     daemon = Pyro4.core.Daemon(host=network_address)
     clientURI = daemon.register(executor)
 
-    # find the URI of the server:
-    if executor.ns:
-        ns = Pyro4.locateNS()
-        #ns.register("executor", executor, safe=True)
-        serverURI = ns.lookup("pipeline")
-    else:
-        try:
-            uf = open(executor.uri_file)
-            serverURI = Pyro4.URI(uf.readline())
-            uf.close()
-        except:
-            logger.exception("Problem opening the specified uri file:")
-            raise
+    serverURI = executor.locate_server()
 
     p = Pyro4.Proxy(serverURI)
     # Register the executor with the pipeline
     # the following command only works if the server is alive. Currently if that's
     # not the case, the executor will die which is okay, but this should be
     # more properly handled: a more elegant check to verify the server is running
-    p.registerClient(clientURI.asString(), executor.mem)
+    p.registerClient(clientURI.asString(), executor.mem, **executor.walltime_news())
 
     executor.registeredWithServer()
     executor.setClientURI(clientURI.asString())
@@ -94,6 +94,16 @@ def launchExecutor(executor):
     # you'd think this could be done in __init__, but sometimes that's in the wrong process,
     # which causes an error when calling `join` ...
     executor.initializePool()
+    executor.initializeScratch()
+    if executor.pid_dir and threading.current_thread() is threading.main_thread():
+        # (the stages then run in their own process groups, which don't get the batch system's signal to us)
+        executor_pid = os.getpid()
+        def on_sigterm(signum, _frame):
+            if os.getpid() == executor_pid:  # (rather than one of the pool's workers)
+                executor.kill_stages()
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+        signal.signal(signal.SIGTERM, on_sigterm)
 
     logger.debug("Executor daemon running at: %s", daemon.locationStr)
     try:
@@ -132,23 +142,32 @@ def launchExecutor(executor):
 
 # like a stage but lighter weight (no methods wasting memory...)
 class StageInfo(object):
-    def __init__(self, *, mem, procs, ix, cmd, log_file):
+    def __init__(self, *, mem, procs, ix, cmd, log_file, scratch=(), artifact_key=None, outputs=(), fused=()):
         self.mem = mem
         self.procs = procs
         self.ix = ix
         self.cmd = cmd
         self.log_file = log_file
+        # with --local-scratch, the stage's files to be kept in (or read from) the executor's scratch space
+        self.scratch = scratch
+        # with --artifact-cache, the key under which to store the stage's outputs, if any
+        self.artifact_key = artifact_key
+        self.outputs = outputs
+        # with --fuse-stages, the stages to run right after this one, in the same job
+        self.fused = fused
 
 
 def stageinfo_dict_to_class(classname, d):
-    return StageInfo(mem=d['mem'], procs=d['procs'], ix=d['ix'], cmd=d['cmd'], log_file=d['log_file'])
+    return StageInfo(mem=d['mem'], procs=d['procs'], ix=d['ix'], cmd=d['cmd'], log_file=d['log_file'],
+                     scratch=d.get('scratch', ()), artifact_key=d.get('artifact_key'), outputs=d.get('outputs', ()),
+                     fused=[stageinfo_dict_to_class(classname, f) for f in d.get('fused', ())])
 
 
 Pyro4.util.SerializerBase.register_dict_to_class("pydpiper.execution.pipeline_executor.StageInfo",
                                                  stageinfo_dict_to_class)
 
 
-def runStage(*, clientURI, stage, cmd_wrapper):
+def runStage(*, clientURI, stage, cmd_wrapper, artifact_cache=None, pid_dir=None):
         ix = stage.ix
 
         logger.info("Running stage %i (on %s). Memory requested: %.2f", ix, clientURI, stage.mem)
@@ -165,18 +184,51 @@ def runStage(*, clientURI, stage, cmd_wrapper):
             of.flush()
             
             args = shlex.split(command_to_run)
-            process = subprocess.Popen(args, stdout=of, stderr=of, shell=False)
+            start_time = time.time()
+            # (with --backup-stragglers, the server may cancel the stage, so it runs in its own process group,
+            # recorded in `pid_dir`, to stop any processes it has started along with it; see `cancel_stages`)
+            process = subprocess.Popen(args, stdout=of, stderr=of, shell=False, start_new_session=bool(pid_dir))
             #client.addPIDtoRunningList(process.pid)
-            process.communicate()
+            pid_file = os.path.join(pid_dir, str(ix)) if pid_dir else None
+            if pid_file:
+                with open(pid_file, 'w') as f:
+                    f.write(str(process.pid))
+            # reap the child ourselves (rather than via `communicate`) to get its own resource usage;
+            # RUSAGE_CHILDREN would lump together everything this pool worker has ever run
+            _pid, status, rusage = os.wait4(process.pid, 0)
             #client.removePIDfromRunningList(process.pid)
-            ret = process.returncode 
+            if pid_file:
+                os.remove(pid_file)
+            ret = process.returncode = (-os.WTERMSIG(status) if os.WIFSIGNALED(status)
+                                        else os.WEXITSTATUS(status))
+            usage = { "wall_time" : time.time() - start_time,
+                      "cpu_time"  : rusage.ru_utime + rusage.ru_stime,
+                      # ru_maxrss is in kB (on Linux)
+                      "peak_mem"  : rusage.ru_maxrss / 2**20 }
             of.close()
         except Exception as e:
             logger.exception("Exception whilst running stage: %i (on %s)", ix, clientURI)
-            return ix, e
+            return ix, e, None
         else:
             logger.info("Stage %i finished, return was: %i (on %s)", ix, ret, clientURI)
-            return ix, ret
+            if ret == 0 and artifact_cache and stage.artifact_key:
+                # (the stage has succeeded whether or not we manage to store its outputs)
+                try:
+                    ArtifactCache(artifact_cache).publish(stage.artifact_key, stage.cmd, stage.outputs)
+                except Exception:
+                    logger.exception("Could not store the outputs of stage %i in the artifact cache", ix)
+            return ix, ret, usage
+
+
+def runStages(*, stages, **kwargs):
+    """Run a stage and those fused onto it (see --fuse-stages) one after another, as long as they succeed;
+    returns the results (as for `runStage`) of those which were run."""
+    results = []
+    for stage in stages:
+        results.append(runStage(stage=stage, **kwargs))
+        if results[-1][1] != 0:
+            break
+    return results
 
 
 class ChildProcess(object):
@@ -218,6 +270,15 @@ class pipelineExecutor(object):
         self.uri_file = options.urifile
         if self.uri_file is None:
             self.uri_file = os.path.abspath(os.path.join(os.curdir, uri_file))
+        # whether to hand over our stages to the next server if we lose the current one, and for how long
+        # (in seconds) to wait for it to appear
+        self.handoff = options.handoff
+        self.handoff_timeout = options.handoff_timeout
+        # where to create our node-local scratch space (see scratch.py), if at all
+        self.local_scratch = options.local_scratch
+        self.scratch = None  # type: LocalScratch
+        # where to store the outputs of the stages we run for reuse (see artifact_cache.py), if at all
+        self.artifact_cache = options.artifact_cache
         # the next variable is used to keep track of how long the
         # executor has been continuously idle/sleeping for. Measured
         # in seconds
@@ -229,6 +290,9 @@ class pipelineExecutor(object):
         self.time_to_seppuku = options.time_to_seppuku
         # the time in minutes after which an executor will not accept new jobs
         self.time_to_accept_jobs = options.time_to_accept_jobs
+        # when our walltime runs out, if we're running as a batch job and know it
+        self.deadline = (self.walltime_deadline()
+                         if any(v in os.environ for v in BATCH_JOB_ENV_VARS) else None)
         # stores the time of connection with the server
         self.connection_time_with_server = None
         #initialize runningMem and Procs
@@ -247,25 +311,81 @@ class pipelineExecutor(object):
         # than one event (for reclaiming, server messages, ...)
         self.e = threading.Event()
         self.heartbeat_tick = 0
+        # (index, return code) pairs of finished stages not yet reported to the server;
+        # these are sent along with the next heartbeat
+        self.unreported_results = []
+        # (similarly) indices of stages given back to the server without being run, since the stage they
+        # were fused onto failed
+        self.unreported_not_run = []
+        # the stages the server has given us whose outcomes it hasn't yet received, by index
+        self.assigned_stages = {}  # type: Dict[int, StageInfo]
+        # with --backup-stragglers, where the pool's workers record the process IDs of the stages they're
+        # running, and the stages the server has cancelled which haven't yet been stopped (see `cancel_stages`)
+        self.backup_stragglers = options.backup_stragglers
+        self.pid_dir = None  # type: str
+        self.pending_cancellations = set()  # type: Set[int]
+        # one long-lived proxy for the server per thread (see `server_proxy`)
+        self.thread_local = threading.local()
+
+    def locate_server(self):
+        """The URI of the server (as currently registered with the name server or in the URI file)."""
+        if self.ns:
+            ns = Pyro4.locateNS()
+            #ns.register("executor", executor, safe=True)
+            return ns.lookup("pipeline")
+        else:
+            try:
+                with open(self.uri_file) as uf:
+                    return Pyro4.URI(uf.readline())
+            except:
+                logger.exception("Problem opening the specified uri file:")
+                raise
+
+    def server_proxy(self):
+        """This thread's connection to the server, (re)connecting if necessary.
+        We found that connecting to the server via the same proxy using several
+        Process-es can bring down either or both the server and the client
+        (the Pyro documentation also states that proxies can't be shared between
+        threads), so each thread gets its own proxy, which is kept open rather than
+        paying for a new connection and handshake on every call."""
+        proxy = getattr(self.thread_local, "proxy", None)
+        if proxy is None:
+            for attempt in range(1, SERVER_CONNECT_ATTEMPTS + 1):
+                proxy = Pyro4.Proxy(self.serverURI)
+                try:
+                    proxy._pyroBind()
+                except Pyro4.errors.CommunicationError:
+                    logger.warning("Could not connect to the server (attempt %d of %d)",
+                                   attempt, SERVER_CONNECT_ATTEMPTS, exc_info=True)
+                    proxy._pyroRelease()
+                    if attempt == SERVER_CONNECT_ATTEMPTS:
+                        raise
+                    time.sleep(SERVER_CONNECT_RETRY_INTERVAL)
+                else:
+                    break
+            self.thread_local.proxy = proxy
+        return proxy
+
+    def release_server_proxy(self):
+        proxy = getattr(self.thread_local, "proxy", None)
+        if proxy is not None:
+            self.thread_local.proxy = None
+            proxy._pyroRelease()
 
     def wrapPyroCall(self, func, *args, **kwargs):
         try:
-            # a bit expensive perhaps, but it is safer to create
-            # a new proxy for the server whenever it is contacted.
-            # We found that connecting to the server via the same proxy using several
-            # Process-es, can bring down either or both the server and the client
-            # (the documentation also states that proxies can only be shared between
-            # threads).
-            # also, note Ben and his bag of tricks! When a function on the server
+            # note Ben and his bag of tricks! When a function on the server
             # side needs to be called, and wrapPyroCall is invoked, we do this
             # using the lambda functionality. Below the lambda p: p.call_at_the_server
-            # will pass the new proxy to p. At the same time, pycharm is still able
+            # will pass the proxy to p. At the same time, pycharm is still able
             # to type check things.
             logger.debug("wrapPyroCall: %s", func)
-            with Pyro4.Proxy(self.serverURI) as one_time_proxy:
-                return func(one_time_proxy)(*args, **kwargs)
+            return func(self.server_proxy())(*args, **kwargs)
         except:
             logger.exception("Exception while placing a Pyro call at the server: %s", func)
+            # we can't tell whether the server processed the call, so don't simply retry it,
+            # but make sure that any further calls use a fresh connection
+            self.release_server_proxy()
             raise Exception("Pyro call with the server failed. Shutting down...")
 
     def registeredWithServer(self):
@@ -281,6 +401,65 @@ class pipelineExecutor(object):
 
     def initializePool(self):
         self.pool = Pool(processes = self.procs)
+        if self.backup_stragglers:
+            self.pid_dir = tempfile.mkdtemp(prefix="pydpiper-pids-")
+
+    def remove_pid_dir(self):
+        if self.pid_dir:
+            shutil.rmtree(self.pid_dir, ignore_errors=True)
+
+    def stage_pid(self, i):
+        """The process ID (and process group) of stage `i`, if it's running in its own group."""
+        try:
+            with open(os.path.join(self.pid_dir, str(i))) as f:
+                return int(f.read())
+        except (OSError, TypeError, ValueError):
+            return None
+
+    def kill_stages(self):
+        """Stop the stages running in their own process groups, which would otherwise outlive us
+        (unlike the others, they don't share our process group)."""
+        try:
+            running = os.listdir(self.pid_dir) if self.pid_dir else []
+        except OSError:
+            return
+        for i in running:
+            pid = self.stage_pid(i)
+            if pid is not None:
+                try:
+                    os.killpg(pid, signal.SIGTERM)
+                except (ProcessLookupError, PermissionError):
+                    pass
+
+    def cancel_stages(self, indices):
+        """Stop the given stages (run as backup copies of straggling stages, or the stragglers themselves,
+        whose copies have finished first; see --backup-stragglers), which then fail as usual.  A stage which
+        hasn't started yet is stopped on a later call."""
+        self.pending_cancellations.update(indices)
+        for i in list(self.pending_cancellations):
+            if i not in self.assigned_stages:
+                # (it has already finished)
+                self.pending_cancellations.discard(i)
+                continue
+            pid = self.stage_pid(i)
+            if pid is None:
+                continue
+            logger.info("Stopping stage %d (process %d) as the server has cancelled it", i, pid)
+            try:
+                os.killpg(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            self.pending_cancellations.discard(i)
+
+    def initializeScratch(self):
+        if self.local_scratch:
+            # (wake up to report copied files promptly, as for finished stages)
+            self.scratch = LocalScratch(self.local_scratch, on_copied=self.e.set)
+            logger.info("Keeping intermediate files in %s", self.scratch.dir)
+
+    def remove_scratch(self):
+        if self.scratch:
+            self.scratch.remove()
         
     def setClientURI(self, cURI):
         self.clientURI = cURI 
@@ -289,7 +468,10 @@ class pipelineExecutor(object):
         self.serverURI = sURI
             
     def setProxyForServer(self, proxy):
+        # the thread which registered the executor goes on to run the main loop,
+        # so keep using the registration connection there
         self.pyro_proxy_for_server = proxy
+        self.thread_local.proxy = proxy
     
     # TODO rename completeAndExitChildren,generalShutdownCall to something like
     # normalShutdown, dirtyShutdown
@@ -303,6 +485,7 @@ class pipelineExecutor(object):
         logger.info("Executor shutting down.  Killing running jobs...")
         #for subprocID in self.current_running_job_pids:
         #    os.kill(subprocID, signal.SIGTERM)
+        self.kill_stages()
         self.pool.terminate()
         self.pool.join()
         logger.debug("Finished joining process pool.")
@@ -310,7 +493,11 @@ class pipelineExecutor(object):
         # to notify the server of the job's destruction
         # so the job is no longer in the client's set of stages
         # when unregisterClient is called
-        self.unregister_with_server()
+        try:
+            self.unregister_with_server()
+        finally:
+            self.remove_scratch()
+            self.remove_pid_dir()
 
     def completeAndExitChildren(self):
         # This function is called under normal circumstances (i.e., not because
@@ -322,6 +509,8 @@ class pipelineExecutor(object):
         # wait for the worker processes (children) to exit (must be called after terminate() or close())
         self.pool.close()
         self.pool.join()
+        self.remove_scratch()
+        self.remove_pid_dir()
 
     def unregister_with_server(self):
         if self.registered_with_server:
@@ -335,8 +524,14 @@ class pipelineExecutor(object):
             # since the server runs single-threaded)
             logger.info("Unsetting the registered-with-the-server flag for executor: %s", self.clientURI)
             self.registered_with_server = False
+            # don't make the server rerun stages which have already finished here
+            # (nor those which wrote files still in our scratch space, which is about to be removed)
+            if self.scratch:
+                self.scratch.copy_out_all()
+            self.report_stage_results()
             self.wrapPyroCall(lambda p: p.unregisterClient, self.clientURI)
             logger.info("Done calling unregisterClient")
+            self.release_server_proxy()
 
     def submitToQueue(self, number):
         """Submits to queueing system using qbatch"""
@@ -423,6 +618,23 @@ class pipelineExecutor(object):
                 return True
         return False
                         
+    def walltime_deadline(self):
+        """When the batch job we're running in runs out of walltime: the batch system knows best (we may
+        have been started well into the job, e.g., by a server submitted with --submit-server), so we only
+        count down --time from our start if it can't tell us.  None if neither works."""
+        time_left = q.remaining_walltime()
+        if time_left is None:
+            try:
+                time_left = q.timestr_to_secs(self.time)
+            except Exception:
+                logger.info("I couldn't determine our remaining walltime, so I'll take stages of any length.")
+                return None
+        return time.time() + time_left
+
+    def walltime_news(self):
+        """What to tell the server about our remaining walltime when registering (only if it's known)."""
+        return dict(time_left=self.deadline - time.time()) if self.deadline else {}
+
     def is_time_to_drain(self):
         # check whether there is a limit to how long the executor
         # is allowed to accept jobs for. 
@@ -444,24 +656,96 @@ class pipelineExecutor(object):
     #            self.runningProcs -= child.procs
     #            self.runningChildren.remove(child)
 
-    #@Pyro4.oneway
-    def notifyStageTerminated(self, i, returncode=None):
-        #try:
-            if returncode == 0:
-                logger.debug("Setting stage %d finished on the server side", i)
-                self.wrapPyroCall(lambda p: p.setStageFinished, i, self.clientURI)
-                logger.debug("Done setting stage finished")
+    def notifyStageTerminated(self, i, returncode=None, usage=None):
+        # a None returncode is also considered a failure
+        logger.debug("Stage %d terminated with return code %s; will report this to the server", i, returncode)
+        with self.lock:
+            self.unreported_results.append((i, returncode, usage))
+        self.e.set()  # some work finished, so wake up and tell the server
+
+    def notifyStagesNotRun(self, indices):
+        logger.debug("Stages %s weren't run; will give them back to the server", indices)
+        with self.lock:
+            self.unreported_not_run.extend(indices)
+        self.e.set()
+
+    def report_stage_results(self, tick=None):
+        """Send the results of stages finished since the last report (and, if `tick`
+        is given, a heartbeat) to the server in a single call."""
+        with self.lock:
+            # (the results of stages the server refused to adopt after a handoff are of no interest)
+            results = [r for r in self.unreported_results if r[0] in self.assigned_stages]
+            not_run = [i for i in self.unreported_not_run if i in self.assigned_stages]
+            self.unreported_results = []
+            self.unreported_not_run = []
+        # (only mention scratch space and unrun stages to the server if there's anything to say)
+        held, copied = self.scratch.take_news() if self.scratch else ([], [])
+        scratch_news = dict(held=held, copied_out=copied) if self.scratch else {}
+        fused_news = dict(not_run=not_run) if not_run else {}
+        try:
+            requests = self.wrapPyroCall(lambda p: p.reportStageResults, self.clientURI, results, tick=tick,
+                                         **scratch_news, **fused_news)
+        except:
+            # keep the results around in case there's a chance to report them later
+            with self.lock:
+                self.unreported_results = results + self.unreported_results
+                self.unreported_not_run = not_run + self.unreported_not_run
+            if self.scratch:
+                self.scratch.restore_news(held, copied)
+            raise
+        for i, _returncode, _usage in results:
+            del self.assigned_stages[i]
+        for i in not_run:
+            del self.assigned_stages[i]
+        if requests and requests.get('cancel'):
+            self.cancel_stages(requests['cancel'])
+        elif self.pending_cancellations:
+            self.cancel_stages(())
+        if requests and self.scratch:
+            self.scratch.handle_requests(requests)
+
+    def await_successor(self):
+        """Having lost the server, wait for the next one to appear (see --handoff) and hand over
+        the stages it gave us, so they needn't be re-run (raises if it doesn't appear in time)."""
+        logger.info("Waiting for the next server to take over %d stages", len(self.assigned_stages))
+        self.release_server_proxy()
+        deadline = time.time() + self.handoff_timeout
+        while time.time() < deadline:
+            time.sleep(HANDOFF_POLL_INTERVAL)
+            try:
+                serverURI = self.locate_server().asString()
+            except Exception:
+                continue
+            if serverURI == self.serverURI:
+                continue
+            try:
+                self.hand_over_stages(serverURI)
+            except Exception:
+                logger.exception("Could not hand over stages to the server at %s", serverURI)
+                self.release_server_proxy()
             else:
-                # a None returncode is also considered a failure
-                logger.debug("Setting stage %d failed on the server side. Return code: %s", i, returncode)
-                self.wrapPyroCall(lambda p: p.setStageFailed, i, self.clientURI)
-                logger.debug("Done setting stage failed")
-            # the server may have shutdown or otherwise become unavailable
-            # (currently this is expected when a long-running job completes;
-            # we should add a more elegant check for this state of affairs),
-            # but the executor may have running jobs that shouldn't be killed
-            # TODO add similar error handling around certain other Pyro calls)
-            self.e.set()  # some work finished and server notified, so wake up
+                return
+        raise Exception("No server took over within %d s" % self.handoff_timeout)
+
+    def hand_over_stages(self, serverURI):
+        self.setServerURI(serverURI)
+        self.wrapPyroCall(lambda p: p.registerClient, self.clientURI, self.mem, **self.walltime_news())
+        adopted = set(self.wrapPyroCall(lambda p: p.adoptStages, self.clientURI,
+                                        [(i, s.cmd) for i, s in self.assigned_stages.items()]))
+        for i in list(self.assigned_stages):
+            if i not in adopted:
+                # (if it's still running, its result will be ignored)
+                logger.warning("The new server refused stage %d; forgetting about it", i)
+                del self.assigned_stages[i]
+        self.connection_time_with_server = time.time()
+        logger.info("Handed over %d stages to the server at %s", len(adopted), serverURI)
+
+    @Pyro4.oneway
+    def wakeup(self):
+        """Called by the server when stages have become runnable after we were told to wait,
+        so ask for work now rather than at the next main loop tick."""
+        logger.debug("Woken up by the server")
+        self.e.set()
 
     def idle(self):
         return self.runningMem == 0 and self.runningProcs == 0 and self.prev_time
@@ -469,7 +753,16 @@ class pipelineExecutor(object):
     # use an event set/timeout system to run the executor mainLoop -
     # we might want to pass some extra information in addition to waking the system
     def mainLoop(self):
-        while self.mainFn():
+        while True:
+            try:
+                if not self.mainFn():
+                    break
+            except Exception:
+                if not (self.handoff and self.assigned_stages):
+                    raise
+                logger.exception("Lost the server")
+                self.await_successor()
+                continue
             self.e.wait(EXECUTOR_MAIN_LOOP_INTERVAL)
             self.e.clear()
         logger.info("Main loop finished")
@@ -492,10 +785,10 @@ class pipelineExecutor(object):
         # to other servers)
         #self.free_resources()
 
-        logger.debug("Updating timestamp with heartbeat tick: %d", self.heartbeat_tick)
-        self.wrapPyroCall(lambda p: p.updateClientTimestamp, self.clientURI, tick=self.heartbeat_tick)
+        logger.debug("Sending heartbeat tick %d and stage results to the server", self.heartbeat_tick)
+        self.report_stage_results(tick=self.heartbeat_tick)
         self.heartbeat_tick += 1
-        logger.debug("Done updating timestamp")
+        logger.debug("Done sending heartbeat")
 
         if self.idle():
             self.idle_time += self.current_time - self.prev_time
@@ -515,78 +808,110 @@ class pipelineExecutor(object):
             #return False
             return True
 
-        # TODO we get only one stage per loop iteration, so we have to wait for
-        # another event/timeout to get another.  In general we might want 
-        # getCommand to order multiple stages to be run on the same server
-        # (just setting the event immediately would be somewhat hackish)
-        # FIXME send/get the whole stageinfo here (it contains an `ix` field, right?)?!
-        logger.debug("Going to get command from server")
-        cmd, i = self.wrapPyroCall(lambda p: p.getCommand, clientURIstr=self.clientURI,
-                                                           clientMemFree=self.mem - self.runningMem,
-                                                           clientProcsFree=self.procs - self.runningProcs)
-        logger.debug("Done getting command from server")
+        logger.debug("Going to get stages from server")
+        cmd, stages = self.wrapPyroCall(lambda p: p.getCommands, clientURIstr=self.clientURI,
+                                                                 clientMemFree=self.mem - self.runningMem,
+                                                                 clientProcsFree=self.procs - self.runningProcs)
+        logger.debug("Done getting stages from server")
 
         if cmd == "shutdown_normally":
             logger.info('Saw shutdown command from server')
             return False
+        elif cmd == "handoff":
+            # the server is shutting down before the pipeline is complete
+            if not self.assigned_stages:
+                logger.info('Saw handoff command from server with no stages to hand over; shutting down')
+                return False
+            self.await_successor()
+            return True
         # TODO this won't work yet since we'll just go to shutdown normally
         # and wait for jobs to finish instead of killing them -
         # maybe throwing an exception is better?
         elif cmd == "wait":
             return True
-        elif cmd == "run_stage":
-            logger.debug("Going to get stage info for stage: %d", i)
-            stage = self.wrapPyroCall(lambda p: p.get_stage_info,i)
-            logger.debug("Done getting stage information for stage: %d", i)
-            # we trust that the server has given us a stage
-            # that we have enough memory and processors to run ...
-            # reset the idle time, we are running a stage!
+        elif cmd == "run_stages":
+            # the server has already marked these stages as started on this executor,
+            # and we trust that we have enough memory and processors to run them all ...
+            # reset the idle time, we are running stages!
             self.idle_time = 0
-            with self.lock:
-                self.runningMem += stage.mem
-                self.runningProcs += stage.procs
-            # The multiprocessing library must pickle things in order to execute them.
-            # I wanted the following function (runStage) to be a function of the pipelineExecutor
-            # class. That way we can access self.serverURI and self.clientURI from
-            # within the function. However, bound methods are not picklable (a bound method
-            # is a method that has "self" as its first argument, because if I understand 
-            # this correctly, that binds the function to a class instance). There is
-            # a way to make a bound function picklable, but this seems cumbersome. So instead
-            # runStage is now a standalone function.
-
-            # callback for result of runStage, run by executor
-            def process_result(result):
-                ix, res = result
+            for stage in stages:
+                self.submitStage(stage)
+            return True
+        else:
+            raise Exception("Got invalid cmd from server: %s" % cmd)
+
+    def submitStage(self, stage):
+        """Run a stage handed out (and already marked as started) by the server in the pool,
+        along with any stages fused onto it (see --fuse-stages), one after another."""
+        i = stage.ix
+        chain = [stage] + list(stage.fused)
+        for s in chain:
+            self.assigned_stages[s.ix] = s
+        # (the stages are run one at a time, so the largest one's resources suffice)
+        mem, procs = max(s.mem for s in chain), max(s.procs for s in chain)
+        with self.lock:
+            self.runningMem += mem
+            self.runningProcs += procs
+        # The multiprocessing library must pickle things in order to execute them.
+        # I wanted the following function (runStage) to be a function of the pipelineExecutor
+        # class. That way we can access self.serverURI and self.clientURI from
+        # within the function. However, bound methods are not picklable (a bound method
+        # is a method that has "self" as its first argument, because if I understand
+        # this correctly, that binds the function to a class instance). There is
+        # a way to make a bound function picklable, but this seems cumbersome. So instead
+        # runStage is now a standalone function.
+
+        if self.scratch:
+            for s in chain:
+                self.scratch.acquire(s.scratch)
+        # callback for result of runStages, run by executor
+        def process_result(results):
+            for (ix, res, usage), s in zip(results, chain):
                 if isinstance(res, int):
                     # it's a return code
                     # don't do this logging in the callback for politenessoliphant
-                    self.notifyStageTerminated(ix, res)
+                    if res == 0 and self.scratch:
+                        # (before the result is reported, so the server learns of the files along with it)
+                        self.scratch.record_outputs(s.scratch)
+                    self.notifyStageTerminated(ix, res, usage)
                 elif isinstance(res, Exception):
                     # runStage raised an exception.  We could use apply_async's error_callback to handle this case
                     # instead, but we need to know the index of the stage we were attempting to run, so we'd have
                     # to catch the exception anyway to stuff the index into it ... this seems cleaner (no re-raising).
                     self.notifyStageTerminated(ix)
-                logger.debug("Freeing up resources for stage %i.", ix)
-                stage = self.runningChildren[ix]
-                with self.lock:
-                    self.runningMem -= stage.mem
-                    self.runningProcs -= stage.procs
-                del self.runningChildren[ix]
-
-            # why does this need a separate call? should be able to infer that this stage will start from getCommand...
-            logger.debug("Telling the server that stage %d has started", i)
-            self.wrapPyroCall(lambda p: p.setStageStarted, i, self.clientURI)
-            logger.debug("Server knows that stage started")
-            result = self.pool.apply_async(runStage, args=(),
-                                           kwds={ "clientURI" : self.clientURI, "stage" : stage,
-                                                  "cmd_wrapper" : self.cmd_wrapper},
-                                           callback=process_result)
-            self.runningChildren[i] = ChildProcess(i, result, stage.mem, stage.procs)
-
-            logger.debug("Added stage %i to the running pool.", i)
-            return True
-        else:
-            raise Exception("Got invalid cmd from server: %s" % cmd)
+            if len(results) < len(chain):
+                # (a stage failed, so those fused onto it weren't run)
+                self.notifyStagesNotRun([s.ix for s in chain[len(results):]])
+            if self.scratch:
+                for s in chain:
+                    self.scratch.release(s.scratch)
+            logger.debug("Freeing up resources for stage %i.", i)
+            child = self.runningChildren[i]
+            with self.lock:
+                self.runningMem -= child.mem
+                self.runningProcs -= child.procs
+            del self.runningChildren[i]
+
+        result = self.pool.apply_async(runStages, args=(),
+                                       kwds={ "clientURI" : self.clientURI, "stages" : [self.localize(s) for s in chain],
+                                              "cmd_wrapper" : self.cmd_wrapper,
+                                              "artifact_cache" : self.artifact_cache,
+                                              "pid_dir" : self.pid_dir },
+                                       callback=process_result)
+        self.runningChildren[i] = ChildProcess(i, result, mem, procs)
+
+        logger.debug("Added stage %i to the running pool.", i)
+
+    def localize(self, stage):
+        """The stage to run in place of the given one, which reads or writes files in our scratch space."""
+        if not (self.scratch and stage.scratch):
+            return stage
+        # (`stage` keeps the original command, by which it's known to any later server)
+        return StageInfo(mem=stage.mem, procs=stage.procs, ix=stage.ix, log_file=stage.log_file,
+                         cmd=self.scratch.localize(stage.cmd, stage.scratch),
+                         artifact_key=stage.artifact_key,
+                         outputs=[self.scratch.local_path(f) if f in stage.scratch else f
+                                  for f in stage.outputs])
                 
 
 def main():
@@ -4,6 +4,7 @@ from datetime import datetime
 from os.path import isdir, basename
 from os import mkdir
 import os
+import re
 import subprocess
 
 # FIXME huge hack around not being able to pretty-print
@@ -40,6 +41,16 @@ def timestr_to_secs(ts):
     except:
         raise Exception("invalid (H...)HH:MM:SS timestring: %s" % ts)
 
+def remaining_walltime():
+    """The walltime (in seconds) left to the PBS job we're running in, according to qstat,
+    or None if we aren't in one or it can't be determined."""
+    try:
+        output = subprocess.check_output(['qstat', '-f', os.environ["PBS_JOBID"]],
+                                         stderr=subprocess.STDOUT, universal_newlines=True)
+        return int(re.search(r'Walltime.Remaining = (\d+)', output).group(1))
+    except Exception:
+        return None
+
 class runOnQueueingSystem():
     def __init__(self, options, sysArgs=None):
         #Note: options are the same as whatever is in calling program
@@ -0,0 +1,55 @@
+"""Fingerprints of the files a stage reads and writes.  These are recorded in the finished
+stages log when a stage finishes, so that on restart a stage can be re-run if its inputs
+have changed or its outputs have gone missing since, even though its command hasn't changed."""
+
+import hashlib
+import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Callable, Dict, Iterable
+
+# how to decide whether a previously finished stage can be skipped on restart:
+#   command - its command was run before (the files themselves aren't checked)
+#   stat    - additionally, the size and modification time of its inputs and outputs are unchanged
+#   content - additionally, the size and a hash of (the start and end of) its inputs and outputs are unchanged
+RESTART_CHECKS = ["command", "stat", "content"]
+# number of bytes at each end of a file which are hashed in 'content' mode
+CONTENT_SAMPLE_BYTES = 64 * 1024
+# stat/read calls are mostly waiting on the (network) filesystem, so use plenty of threads
+VERIFY_THREADS = 32
+
+
+def file_signature(path, check):
+    """A short string which changes when the file at `path` does (as judged by `check`)."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return "missing"
+    if stat.S_ISDIR(st.st_mode):
+        return "dir"
+    if check == "stat":
+        return "%d:%d" % (st.st_size, st.st_mtime_ns)
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        h.update(f.read(CONTENT_SAMPLE_BYTES))
+        if st.st_size > CONTENT_SAMPLE_BYTES:
+            f.seek(max(CONTENT_SAMPLE_BYTES, st.st_size - CONTENT_SAMPLE_BYTES))
+            h.update(f.read(CONTENT_SAMPLE_BYTES))
+    return "%d:%s" % (st.st_size, h.hexdigest())
+
+
+def file_signatures(paths: Iterable[str], check: str, threads: int = VERIFY_THREADS) -> Dict[str, str]:
+    """Signatures of many files, computed in parallel."""
+    paths = list(set(paths))
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return dict(zip(paths, pool.map(lambda p: file_signature(p, check), paths)))
+
+
+def stage_fingerprint(files: Iterable[str], check: str, signature: Callable[[str], str]) -> str:
+    """Combine the signatures of a stage's files into a single string (free of commas and whitespace,
+    so that it can be stored in the finished stages log) which also records how it was computed."""
+    h = hashlib.md5()
+    for f in files:
+        h.update(("%s=%s\n" % (f, signature(f))).encode())
+    return "%s:%s" % (check, h.hexdigest())
@@ -0,0 +1,128 @@
+"""Deciding whether, when and with how much memory to retry a failed stage (see --max-retries, --retry-delay,
+--oom-mem-factor and --retry-policy).
+
+A failure is classified by the stage's return code and, if the executor measured it, its peak memory use.
+A stage killed by SIGKILL (the kernel's or the batch system's OOM killer) or which used nearly all the memory
+it requested is retried with more memory; one whose command couldn't be run at all isn't retried, since
+that won't help; any other failure (e.g., a transient I/O error) is retried as it was.  Retries are delayed,
+increasingly with each attempt, by putting the stage on a timer heap which the server checks as it goes
+about its business, rather than by sleeping (which would block every executor's calls)."""
+
+import heapq
+import itertools
+import logging
+import signal
+import time
+
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# failure classes
+MEMORY = "memory"          # killed for (probably) running out of memory
+SIGNALLED = "signalled"    # killed by some other signal
+UNRUNNABLE = "unrunnable"  # the command wasn't found or couldn't be executed
+ERROR = "error"            # any other failure, including an exception while starting the stage
+
+# a stage which used at least this fraction of the memory it requested is assumed to have run out
+NEAR_MEMORY_LIMIT = 0.95
+# unless overridden for a tool, retries are delayed by --retry-delay, multiplied by this for each further
+# attempt, up to a limit (in seconds)
+RETRY_BACKOFF = 2.0
+MAX_RETRY_DELAY = 600.0
+# (the exit statuses with which a shell reports a command it couldn't execute or find)
+UNRUNNABLE_STATUSES = (126, 127)
+
+RetryPolicy = NamedTuple('RetryPolicy', [('max_retries', int),
+                                         ('delay', float),      # seconds before the first retry ...
+                                         ('backoff', float),    # ... multiplied by this for each further one
+                                         ('max_delay', float),
+                                         ('mem_factor', float)  # memory escalation after a MEMORY failure
+                                         ])
+
+
+def classify(returncode: Optional[int], peak_mem: Optional[float] = None, mem: Optional[float] = None) -> str:
+    """The class of a failure, given the stage's return code (negative if killed by a signal, None if
+    it couldn't be started) and, if known, its peak memory use and the memory it requested (in G).
+    >>> classify(-signal.SIGKILL), classify(128 + signal.SIGKILL), classify(1, peak_mem=3.9, mem=4)
+    ('memory', 'memory', 'memory')
+    >>> classify(-signal.SIGSEGV), classify(127), classify(1, peak_mem=1, mem=4), classify(None)
+    ('signalled', 'unrunnable', 'error', 'error')
+    """
+    if returncode is None:
+        return ERROR
+    # (a shell reports a command killed by signal n as exiting with status 128 + n)
+    sig = -returncode if returncode < 0 else returncode - 128 if 128 < returncode < 128 + 64 else None
+    if sig == signal.SIGKILL or (peak_mem is not None and mem and peak_mem >= NEAR_MEMORY_LIMIT * mem):
+        return MEMORY
+    if sig is not None:
+        return SIGNALLED
+    if returncode in UNRUNNABLE_STATUSES:
+        return UNRUNNABLE
+    return ERROR
+
+
+def parse_retry_policy(spec: str) -> Tuple[str, Dict[str, float]]:
+    """Parse a per-tool retry policy, TOOL:FIELD=VALUE[,FIELD=VALUE...], into the tool and the fields
+    of `RetryPolicy` it overrides.
+    >>> parse_retry_policy("mincANTS:max_retries=4,mem_factor=2")
+    ('mincANTS', {'max_retries': 4, 'mem_factor': 2.0})
+    """
+    tool, sep, fields = spec.partition(":")
+    if not (tool and sep and fields):
+        raise ValueError("expected TOOL:FIELD=VALUE[,FIELD=VALUE...], got %r" % spec)
+    overrides = {}  # type: Dict[str, float]
+    for field in fields.split(","):
+        k, _, v = field.partition("=")
+        k = k.strip()
+        if k not in RetryPolicy._fields:
+            raise ValueError("unknown retry policy field %r (expected one of %s)"
+                             % (k, ", ".join(RetryPolicy._fields)))
+        overrides[k] = int(v) if k == "max_retries" else float(v)
+    return tool, overrides
+
+
+class Retries(object):
+    """The retry policies (a default and per-tool overrides), the stages waiting to be retried (a heap of
+    (due time, sequence number, stage index)), and the failures seen so far, by class."""
+    def __init__(self, default: RetryPolicy, overrides: List[Tuple[str, Dict[str, float]]] = ()) -> None:
+        self.default = default
+        self.policies = { tool : default._replace(**fields) for tool, fields in overrides }
+        self.waiting = []  # type: List[Tuple[float, int, int]]
+        self._seq = itertools.count()
+        self.failures = Counter()  # type: Counter
+
+    def policy(self, tool: str) -> RetryPolicy:
+        return self.policies.get(tool, self.default)
+
+    def decide(self, tool: str, failure: str, attempt: int) -> Optional[float]:
+        """How long to wait before retrying a stage of the given tool after its `attempt`-th failure
+        (counting from 0), or None if it shouldn't be retried."""
+        self.failures[failure] += 1
+        p = self.policy(tool)
+        if failure == UNRUNNABLE or attempt >= p.max_retries:
+            return None
+        return min(p.delay * p.backoff ** attempt, p.max_delay)
+
+    def escalated_mem(self, tool: str, mem: float, max_mem: float) -> float:
+        return min(mem * self.policy(tool).mem_factor, max_mem)
+
+    def schedule(self, i: int, delay: float, now: Optional[float] = None) -> None:
+        now = time.time() if now is None else now
+        heapq.heappush(self.waiting, (now + delay, next(self._seq), i))
+
+    def due(self, now: Optional[float] = None) -> List[int]:
+        """Remove and return the stages whose retries are due."""
+        now = time.time() if now is None else now
+        ready = []
+        while self.waiting and self.waiting[0][0] <= now:
+            ready.append(heapq.heappop(self.waiting)[2])
+        return ready
+
+    def __len__(self) -> int:
+        return len(self.waiting)
+
+    def report(self) -> str:
+        return "Stage failures by class: " + (", ".join("%s: %d" % kv for kv in sorted(self.failures.items()))
+                                              or "none")
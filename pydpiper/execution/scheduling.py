@@ -0,0 +1,404 @@
+"""Data structures the server uses to decide which runnable stage to hand to an executor."""
+
+import bisect
+import heapq
+import math
+from array import array
+from collections import Counter, deque
+
+from typing import Dict, List, Optional, Tuple
+
+
+# slack used when comparing a stage's memory request to an executor's free memory
+MEM_EPS = 0.000001
+# the runnable stages' memory requests are bucketed to this many significant bits (so 8 buckets for each
+# doubling of memory), since estimated requests are nearly all distinct
+MEM_BUCKET_BITS = 4
+
+
+def mem_bucket(mem: float) -> float:
+    """The memory amount keying the bucket of stages needing `mem`: the least amount at least `mem`
+    with `MEM_BUCKET_BITS` significant bits.
+    >>> mem_bucket(1.0), mem_bucket(1.01), mem_bucket(1.9), mem_bucket(24.0), mem_bucket(0)
+    (1.0, 1.125, 2.0, 24.0, 0)
+    """
+    if mem <= 0 or math.isinf(mem):
+        return mem
+    m, e = math.frexp(mem)
+    return math.ldexp(math.ceil(m * 2**MEM_BUCKET_BITS) / 2**MEM_BUCKET_BITS, e)
+
+
+class RunnableIndex(object):
+    """The set of runnable stage indices, bucketed by resource requirements.
+
+    Stages with the same processor count and similar memory requests (see `mem_bucket`) share a
+    bucket, which is a heap ordered by stage priority; for each processor count the buckets' memory
+    amounts are kept sorted, so that the buckets fitting into an executor's free memory and processors
+    can be found by bisection instead of popping arbitrary stages and putting them back when they
+    don't fit.  Only the bucket straddling the free memory (or `min_mem`) is scanned for the stages
+    which fit.  Of the fitting stages, the one with the highest priority is handed out (ties between
+    buckets going to the largest stage, by memory and then processors).
+    Removal is lazy: `discard` only forgets the index, and stale bucket entries are
+    skipped when popping.
+    A stage may be added as preferring a particular executor (e.g., one holding its inputs in
+    local scratch space; see scratch.py), in which case it's kept in a separate index for that
+    executor: it's handed to that executor ahead of any other stage, and to other executors
+    only if nothing else fits.
+    A stage's expected runtime may also be given, so as to only hand out stages which will finish
+    within some time (e.g., before an executor's walltime runs out); finding these means scanning
+    the fitting buckets, so this is best reserved for the few executors which need it.
+    >>> r = RunnableIndex()
+    >>> r.add(0, mem=2.0, procs=1); r.add(1, mem=40.0, procs=1); r.add(2, mem=8.0, procs=1)
+    >>> r.pop_fitting(mem_free=10, procs_free=1)
+    2
+    >>> r.pop_fitting(mem_free=1, procs_free=1) is None
+    True
+    >>> sorted(r)
+    [0, 1]
+    >>> r.add(3, mem=1.0, procs=1, priority=5)
+    >>> r.pop_fitting(mem_free=100, procs_free=1)
+    3
+    >>> r.add(4, mem=1.0, procs=1, preferred="e1")
+    >>> r.pop_fitting(mem_free=100, procs_free=1, client="e1"), r.pop_fitting(mem_free=1, procs_free=1)
+    (4, None)
+    >>> r.pop_fitting(mem_free=100, procs_free=1, min_mem=1.0), r.pop_fitting(mem_free=100, procs_free=1, min_mem=40.0)
+    (1, None)
+    >>> r.discard(0); r.add(5, mem=2.0, procs=1, runtime=3600); r.add(6, mem=2.0, procs=1, runtime=60)
+    >>> r.pop_fitting(mem_free=100, procs_free=1, max_runtime=600), r.pop_fitting(mem_free=100, procs_free=1, max_runtime=600)
+    (6, None)
+    """
+    def __init__(self):
+        # index -> (bucket key, sequence number of its live bucket entry, memory request)
+        self._entry_of = {}  # type: Dict[int, Tuple[Tuple[int, float], int, float]]
+        # (bucket entries are (-priority, sequence number, index, expected runtime, memory request))
+        self._buckets  = {}  # type: Dict[Tuple[int, float], List[Tuple[float, int, int, float, float]]]
+        self._counts   = {}  # type: Dict[Tuple[int, float], int]
+        # procs -> sorted list of the memory amounts keying non-empty buckets
+        self._mems     = {}  # type: Dict[int, List[float]]
+        self._seq = 0
+        # executor -> index of the stages preferring that executor
+        self._preferred = {}  # type: Dict[str, RunnableIndex]
+
+    def __len__(self):
+        return len(self._entry_of) + sum(len(r) for r in self._preferred.values())
+
+    def __contains__(self, i):
+        return i in self._entry_of or any(i in r for r in self._preferred.values())
+
+    def __iter__(self):
+        return iter(list(self._entry_of) + [i for r in self._preferred.values() for i in r])
+
+    def add(self, i, mem, procs, priority=0, preferred=None, runtime=0.0):
+        """Add stage `i`; adding a stage which is already present does nothing."""
+        if i in self:
+            return
+        if preferred is not None:
+            self._preferred.setdefault(preferred, RunnableIndex()).add(i, mem, procs, priority, runtime=runtime)
+            return
+        key = (procs, mem_bucket(mem))
+        if key not in self._buckets:
+            self._buckets[key] = []
+            self._counts[key] = 0
+            bisect.insort(self._mems.setdefault(procs, []), key[1])
+        self._seq += 1
+        # FIFO among stages of equal priority
+        heapq.heappush(self._buckets[key], (-priority, self._seq, i, runtime, mem))
+        self._counts[key] += 1
+        self._entry_of[i] = (key, self._seq, mem)
+
+    def discard(self, i):
+        entry = self._entry_of.pop(i, None)
+        if entry is not None:
+            self._decrement(entry[0])
+        for client, r in list(self._preferred.items()):
+            r.discard(i)
+            if not r:
+                del self._preferred[client]
+
+    def _decrement(self, key):
+        self._counts[key] -= 1
+        if self._counts[key] == 0:
+            procs, mem = key
+            del self._buckets[key]
+            del self._counts[key]
+            mems = self._mems[procs]
+            del mems[bisect.bisect_left(mems, mem)]
+            if not mems:
+                del self._mems[procs]
+
+    def _live(self, e):
+        entry = self._entry_of.get(e[2])
+        return entry is not None and entry[1] == e[1]
+
+    def _head(self, key):
+        """The (live) highest-priority entry of a bucket."""
+        bucket = self._buckets[key]
+        while not self._live(bucket[0]):
+            heapq.heappop(bucket)
+        return bucket[0]
+
+    def _best_in(self, key, mem_free, min_mem, max_runtime):
+        """The highest-priority live entry of a bucket whose stage needs at most `mem_free` (and more than
+        `min_mem`, if given) and is expected to take at most `max_runtime` (if given)."""
+        return min((e for e in self._buckets[key]
+                    if e[4] <= mem_free + MEM_EPS and (not min_mem or e[4] > min_mem + MEM_EPS)
+                    and (max_runtime is None or e[3] <= max_runtime) and self._live(e)),
+                   default=None)
+
+    def _best_fitting(self, mem_free, procs_free, min_mem=0, max_runtime=None):
+        """The bucket and entry of the stage `pop_fitting` should hand out (if any)."""
+        best = None  # type: Optional[Tuple[Tuple[float, float, int], Tuple[int, float], Tuple]]
+        # (the buckets which may hold stages needing too much or too little memory)
+        straddling = {mem_bucket(mem_free + MEM_EPS), mem_bucket(min_mem + MEM_EPS) if min_mem else None}
+        for procs, mems in self._mems.items():
+            if procs > procs_free:
+                continue
+            lo = bisect.bisect_right(mems, min_mem + MEM_EPS) if min_mem else 0
+            for mem in mems[lo:bisect.bisect_right(mems, mem_bucket(mem_free + MEM_EPS))]:
+                key = (procs, mem)
+                if max_runtime is None and mem not in straddling:
+                    entry = self._head(key)
+                else:
+                    entry = self._best_in(key, mem_free, min_mem, max_runtime)
+                if entry is None:
+                    continue
+                candidate = (-entry[0], entry[4], procs)
+                if best is None or candidate > best[0]:
+                    best = (candidate, key, entry)
+        return None if best is None else best[1:]
+
+    def pop_fitting(self, mem_free, procs_free, client=None, min_mem=0, max_runtime=None):
+        """Remove and return the index of the highest-priority stage (the largest one, by memory
+        and then processors, in case of ties) which fits into the given free resources (and needs
+        more than `min_mem`, and is expected to take at most `max_runtime`, if given), or None if there
+        is no such stage.  The stages preferring the given `client` come first, and those preferring
+        other executors last."""
+        if client in self._preferred:
+            i = self._preferred[client].pop_fitting(mem_free, procs_free, min_mem=min_mem, max_runtime=max_runtime)
+            if i is not None:
+                if not self._preferred[client]:
+                    del self._preferred[client]
+                return i
+        found = self._best_fitting(mem_free, procs_free, min_mem, max_runtime)
+        if found is None:
+            return self._pop_preferred_elsewhere(mem_free, procs_free, client, min_mem, max_runtime)
+        key, entry = found
+        if entry is self._buckets[key][0]:
+            heapq.heappop(self._buckets[key])
+        # (otherwise the entry is left in the heap, to be skipped as stale once it reaches the head)
+        i = entry[2]
+        del self._entry_of[i]
+        self._decrement(key)
+        return i
+
+    def _pop_preferred_elsewhere(self, mem_free, procs_free, client, min_mem=0, max_runtime=None):
+        best = None
+        for other, r in self._preferred.items():
+            found = None if other == client else r._best_fitting(mem_free, procs_free, min_mem, max_runtime)
+            if found is not None:
+                (procs, _mem), entry = found
+                candidate = (-entry[0], entry[4], procs)
+                if best is None or candidate > best[0]:
+                    best = (candidate, other)
+        if best is None:
+            return None
+        other = best[1]
+        i = self._preferred[other].pop_fitting(mem_free, procs_free, min_mem=min_mem, max_runtime=max_runtime)
+        if not self._preferred[other]:
+            del self._preferred[other]
+        return i
+
+    def pop(self):
+        """Remove and return the highest-priority runnable stage; raises KeyError if empty."""
+        i = self.pop_fitting(float('inf'), float('inf'))
+        if i is None:
+            raise KeyError('pop from an empty RunnableIndex')
+        return i
+
+    def max_mem(self):
+        """The largest memory request of any runnable stage (None if there are none)."""
+        # (the largest request is in the largest bucket for some processor count)
+        return max([max(e[4] for e in self._buckets[(procs, mems[-1])] if self._live(e))
+                    for procs, mems in self._mems.items()]
+                   + [m for m in (r.max_mem() for r in self._preferred.values()) if m is not None],
+                   default=None)
+
+    def memory_requirements(self):
+        return ([mem for _key, _seq, mem in self._entry_of.values()]
+                + [m for r in self._preferred.values() for m in r.memory_requirements()])
+
+
+# runtime (in seconds) assumed for stages without a runtime estimate
+DEFAULT_STAGE_RUNTIME = 60.0
+
+# when choosing executor size classes, memory requests are rounded up to a multiple of this (in GB) ...
+SIZE_CLASS_GRANULARITY = 0.25
+# ... and a further class is only worthwhile if it saves at least this fraction of the memory the stages need
+SIZE_CLASS_MIN_SAVING = 0.1
+
+
+def critical_path_priorities(topological_order, successors, runtime):
+    """For each node of a DAG, the total runtime along the longest (by runtime)
+    path from that node to a sink, including the node itself.  Stages with large
+    values gate more of the remaining work, so should run first.
+    >>> succs = {0: [1, 2], 1: [3], 2: [], 3: []}
+    >>> critical_path_priorities([0, 1, 2, 3], lambda n: succs[n], lambda n: [1, 5, 10, 1][n])
+    [11, 6, 10, 1]
+    """
+    topological_order = list(topological_order)
+    priorities = [0] * len(topological_order)
+    for n in reversed(topological_order):
+        priorities[n] = runtime(n) + max((priorities[s] for s in successors(n)), default=0)
+    return priorities
+
+
+def fusible_links(n, successors, predecessors, fits):
+    """For each node of a DAG on 0 .. n-1, the node to run right after it in the same executor job
+    (see --fuse-stages), or -1: its only successor, provided that it's the only predecessor of that
+    successor and both `fits` into an executor (a chain of stages run one after another needs as much
+    memory and as many processors as its largest member).  Following these links gives the chains.
+    >>> preds = {0: [], 1: [0], 2: [1], 3: [1], 4: [3], 5: [4], 6: [5]}
+    >>> succs = {0: [1], 1: [2, 3], 2: [], 3: [4], 4: [5], 5: [6], 6: []}
+    >>> list(fusible_links(7, lambda i: succs[i], lambda i: preds[i], fits=lambda i: i != 6))
+    [1, -1, -1, 4, 5, -1, -1]
+    """
+    links = array('i', [-1]) * n
+    for i in range(n):
+        succs = successors(i)
+        if len(succs) == 1 and len(predecessors(succs[0])) == 1 and fits(i) and fits(succs[0]):
+            links[i] = succs[0]
+    return links
+
+
+def size_classes(mems, max_classes):
+    """Divide stages with the given memory requests into at most `max_classes` classes of similar size,
+    to be run by executors sized for the largest stage of their class, so as to minimize the memory
+    requested but not needed (using fewer classes where more wouldn't save much).  Returns the
+    largest request of each class, smallest first.
+    >>> size_classes([2.0] * 5000 + [40.0] * 3, max_classes=3)
+    [2.0, 40.0]
+    >>> size_classes([1.75] * 10 + [2.0] * 10 + [16.0] * 5, max_classes=3)
+    [2.0, 16.0]
+    >>> size_classes([1.0, 40.0], max_classes=1)
+    [40.0]
+    """
+    counts = Counter(math.ceil(m / SIZE_CLASS_GRANULARITY - MEM_EPS) * SIZE_CLASS_GRANULARITY for m in mems)
+    values = sorted(counts)
+    n = len(values)
+    if n == 0:
+        return []
+    # prefix sums of the numbers of stages and of their requests, so that the memory wasted by
+    # a class spanning values[a:b] is (stages[b] - stages[a]) * values[b-1] - (needed[b] - needed[a])
+    stages, needed = [0], [0.0]
+    for v in values:
+        stages.append(stages[-1] + counts[v])
+        needed.append(needed[-1] + counts[v] * v)
+    def waste(a, b):
+        return (stages[b] - stages[a]) * values[b - 1] - (needed[b] - needed[a])
+    # waste[k][b], start[k][b]: the least memory wasted by k classes spanning values[:b], and where the last starts
+    k_max = min(max_classes, n)
+    least = [[0.0] + [float('inf')] * n]
+    start = [[0] * (n + 1)]
+    for k in range(1, k_max + 1):
+        least.append([float('inf')] * (n + 1))
+        start.append([0] * (n + 1))
+        for b in range(k, n + 1):
+            for a in range(k - 1, b):
+                w = least[k - 1][a] + waste(a, b)
+                if w < least[k][b]:
+                    least[k][b], start[k][b] = w, a
+    k = 1
+    while k < k_max and least[k][n] - least[k_max][n] > SIZE_CLASS_MIN_SAVING * needed[n]:
+        k += 1
+    bounds, b = [], n
+    for j in range(k, 0, -1):
+        bounds.append(values[b - 1])
+        b = start[j][b]
+    return bounds[::-1]
+
+
+def executor_fleet(mems, number, procs, max_mem, max_classes, greedy=False):
+    """How to launch `number` executors for runnable stages with the given memory requests: a list of
+    (largest stage, executor memory, number of executors) triples, one per size class (see `size_classes`),
+    largest first.  An executor requests enough memory to run `procs` of the largest stages of its class
+    at once (at most `max_mem`, or exactly that if `greedy`).  Each class gets an executor in turn, largest
+    first, until it has one per stage.
+    >>> executor_fleet([2.0] * 5000 + [40.0] * 3, number=10, procs=4, max_mem=64, max_classes=3)
+    [(40.0, 64, 3), (2.0, 8.0, 7)]
+    >>> executor_fleet([2.0] * 5000 + [40.0] * 3, number=10, procs=4, max_mem=64, max_classes=1)
+    [(40.0, 64, 10)]
+    """
+    bounds = size_classes(mems, max_classes)
+    classes = [[] for _ in bounds]  # type: List[List[float]]
+    for m in sorted(mems, reverse=True):
+        classes[bisect.bisect_left(bounds, m - MEM_EPS)].append(m)
+    fleet = []  # type: List[List]
+    for bound, ms in reversed(list(zip(bounds, classes))):
+        mem = max_mem if greedy else min(max_mem, sum(ms[:procs]))
+        if fleet and fleet[-1][1] == mem:
+            # (the executors for this class would be the same as for the next larger one)
+            fleet[-1][3] += len(ms)
+        else:
+            fleet.append([bound, mem, 0, len(ms)])
+    remaining = number
+    while remaining > 0:
+        wanting = [f for f in fleet if f[2] < f[3]]
+        if not wanting:
+            break
+        for f in wanting[:remaining]:
+            f[2] += 1
+            remaining -= 1
+    return [(bound, mem, n) for bound, mem, n, _num_stages in fleet if n > 0]
+
+
+def forecast_demand(runnable, running, successors, unfinished_preds, runtime, slots, since, until,
+                    became_runnable=None):
+    """The largest number of stages running or waiting to run at any time between `since` and `until`
+    (in seconds from now), simulating the DAG with at most `slots` stages running at once (in order of
+    `runnable`, then in the order successors become runnable).  `running` maps the running stages to their
+    expected remaining runtimes; `unfinished_preds` gives the current number of unfinished predecessors
+    of a stage.  Only events up to `until` are simulated, so this is cheap for short horizons.
+    If given, the list `became_runnable` is extended with the stages which become runnable meanwhile.
+    >>> succs = {0: [2], 1: [2], 2: [3, 4], 3: [], 4: []}
+    >>> preds = {2: 2, 3: 1, 4: 1}
+    >>> # two registrations, then an average of their results, then two resamplings with the average
+    >>> forecast_demand([], {0: 10, 1: 20}, lambda i: succs[i], preds.get, lambda i: 10, slots=2, since=12, until=25)
+    1
+    >>> forecast_demand([], {0: 10, 1: 20}, lambda i: succs[i], preds.get, lambda i: 10, slots=1, since=25, until=35)
+    2
+    """
+    events = [(t, i) for i, t in running.items()]  # type: List[Tuple[float, int]]
+    heapq.heapify(events)
+    waiting = deque(runnable)
+    remaining_preds = {}  # type: Dict[int, int]
+    busy = len(running)
+
+    def start(now):
+        nonlocal busy
+        while waiting and busy < slots:
+            i = waiting.popleft()
+            heapq.heappush(events, (now + runtime(i), i))
+            busy += 1
+
+    start(0.0)
+    demand, peak = busy + len(waiting), 0
+    while events and events[0][0] <= until:
+        now = events[0][0]
+        if now > since:
+            # (the demand since the previous event lasted until now)
+            peak = max(peak, demand)
+        while events and events[0][0] == now:
+            _t, i = heapq.heappop(events)
+            busy -= 1
+            for s in successors(i):
+                n = remaining_preds.get(s)
+                if n is None:
+                    n = unfinished_preds(s)
+                remaining_preds[s] = n - 1
+                if n == 1:
+                    waiting.append(s)
+                    if became_runnable is not None:
+                        became_runnable.append(s)
+        start(now)
+        demand = busy + len(waiting)
+    return max(peak, demand)
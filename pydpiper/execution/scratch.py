@@ -0,0 +1,226 @@
+"""Keeping intermediate files (see intermediates.py) in node-local scratch space (see --local-scratch)
+rather than writing them to the shared output directory only to read them back, often on the
+same node, in the next stage.
+
+The server tracks which executor holds which files (`ScratchFiles`) and prefers to hand a stage to
+the executor holding its inputs; if another executor runs it, the holder first copies those inputs
+out to their usual location in the shared output directory.  The executor rewrites the commands it
+runs to use its scratch directory (`LocalScratch`).  A stage's file is only kept in scratch space if
+its path appears verbatim in the command, since otherwise it can't be redirected.
+Files which were held by an executor we've lost contact with are re-created by re-running the stages
+which wrote them."""
+
+import logging
+import os
+import queue
+import re
+import shutil
+import tempfile
+import threading
+
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .intermediates import IntermediateFiles
+
+logger = logging.getLogger(__name__)
+
+
+def mentions(cmd: List[str], path: str) -> bool:
+    return any(path in a for a in cmd)
+
+
+class ScratchFiles(IntermediateFiles):
+    """Server side: which executor holds which intermediate files, and which of them it should copy
+    out to shared storage or delete (these requests are sent along with the replies to its heartbeats).
+    `producers` maps the files to the indices of the stages writing them.  Unneeded files are
+    'deleted' by asking their holders to delete them."""
+    def __init__(self, files: Set[str], producers: Dict[str, int]) -> None:
+        super().__init__(files)
+        self.producers = producers
+        self.holders = {}  # type: Dict[str, str]
+        self.copying = set()  # type: Set[str]
+        # executor -> (files to copy out, files to delete)
+        self.requests = {}  # type: Dict[str, Tuple[Set[str], Set[str]]]
+
+    def scratch_outputs(self, stage) -> List[str]:
+        """The stage's outputs which it can write to scratch space."""
+        return [f for f in stage.outputFiles if f in self.files and mentions(stage.cmd, f)]
+
+    def hold(self, clientURI: str, paths: Iterable[str]) -> None:
+        for f in paths:
+            self.holders[f] = clientURI
+
+    def preferred_executor(self, stage) -> Optional[str]:
+        """The executor holding the stage's inputs, if one holds them all."""
+        holders = {self.holders[f] for f in stage.inputFiles if f in self.holders}
+        return holders.pop() if len(holders) == 1 else None
+
+    def not_local_to(self, stage, clientURI: Optional[str]) -> List[str]:
+        """The stage's inputs which must be copied out before it can run on the given executor."""
+        return [f for f in stage.inputFiles if f in self.holders
+                and (self.holders[f] != clientURI or not mentions(stage.cmd, f))]
+
+    def copy_out(self, path: str) -> Optional[str]:
+        """Ask the holder of `path` to copy it out, returning the holder if this is a new request."""
+        if path in self.copying:
+            return None
+        self.copying.add(path)
+        holder = self.holders[path]
+        self.requests.setdefault(holder, (set(), set()))[0].add(path)
+        return holder
+
+    def copied_out(self, path: str) -> None:
+        self.copying.discard(path)
+        self.holders.pop(path, None)
+
+    def delete(self, path: str) -> None:
+        holder = self.holders.pop(path, None)
+        if holder is not None:
+            self.copying.discard(path)
+            copy, delete = self.requests.setdefault(holder, (set(), set()))
+            copy.discard(path)
+            delete.add(path)
+            self.deleted += 1
+
+    def take_requests(self, clientURI: str):
+        copy, delete = self.requests.pop(clientURI, (set(), set()))
+        if not (copy or delete):
+            return None
+        return dict(copy_out=sorted(copy), delete=sorted(delete))
+
+    def lost(self, clientURI: str) -> List[str]:
+        """Forget the files held by a lost executor, returning those which are still needed."""
+        self.requests.pop(clientURI, None)
+        lost = [f for f, holder in self.holders.items() if holder == clientURI]
+        for f in lost:
+            del self.holders[f]
+            self.copying.discard(f)
+        return [f for f in lost if self.consumers[f] > 0]
+
+
+class LocalScratch(object):
+    """Executor side: the executor's own directory in node-local scratch space (removed when the
+    executor shuts down), which files it holds there, and the copying of files out to shared storage
+    (in a background thread, started lazily as elsewhere).  The files are referred to by their
+    usual (shared) paths; `on_copied` is called when a copy finishes."""
+    def __init__(self, root: str, on_copied=None) -> None:
+        self.dir = tempfile.mkdtemp(prefix="pydpiper-executor-", dir=root)
+        self.on_copied = on_copied
+        self.held = set()  # type: Set[str]
+        # the number of running stages using each file, and those files which have been copied out
+        # but whose local copies are still in use (these are removed once the stages finish)
+        self.in_use = Counter()  # type: Counter
+        self.stale = set()  # type: Set[str]
+        # files held or copied out since the server was last told
+        self.new_held = []  # type: List[str]
+        self.copied = []  # type: List[str]
+        self._lock = threading.Lock()
+        self._queue = None  # type: queue.Queue
+        self._pid = None  # type: int
+
+    def local_path(self, path: str) -> str:
+        return os.path.join(self.dir, os.path.abspath(path).lstrip(os.sep))
+
+    def localize(self, cmd: List[str], paths: List[str]) -> List[str]:
+        """The command with the given paths replaced by their locations in scratch space."""
+        if not paths:
+            return cmd
+        local = {f: self.local_path(f) for f in paths}
+        for f in local.values():
+            os.makedirs(os.path.dirname(f), exist_ok=True)
+        # (in one pass, longest first, so a path isn't replaced within another or its replacement)
+        pattern = re.compile('|'.join(re.escape(f) for f in sorted(local, key=len, reverse=True)))
+        return [pattern.sub(lambda m: local[m.group(0)], a) for a in cmd]
+
+    def acquire(self, paths: List[str]) -> None:
+        with self._lock:
+            self.in_use.update(paths)
+
+    def release(self, paths: List[str]) -> None:
+        with self._lock:
+            self.in_use.subtract(paths)
+            for f in paths:
+                if self.in_use[f] <= 0:
+                    self.in_use.pop(f, None)
+                    if f in self.stale:
+                        self.stale.discard(f)
+                        self._remove_local(f)
+
+    def _remove_local(self, path):
+        try:
+            os.remove(self.local_path(path))
+        except FileNotFoundError:
+            pass
+
+    def record_outputs(self, paths: List[str]) -> None:
+        """Note which of the given files (written by a stage) are now in scratch space."""
+        with self._lock:
+            for f in paths:
+                if f not in self.held and f not in self.stale and os.path.exists(self.local_path(f)):
+                    self.held.add(f)
+                    self.new_held.append(f)
+
+    def take_news(self) -> Tuple[List[str], List[str]]:
+        with self._lock:
+            news = self.new_held, self.copied
+            self.new_held, self.copied = [], []
+        return news
+
+    def restore_news(self, held: List[str], copied: List[str]) -> None:
+        with self._lock:
+            self.new_held = held + self.new_held
+            self.copied = copied + self.copied
+
+    def handle_requests(self, requests) -> None:
+        for f in requests['delete']:
+            with self._lock:
+                self.held.discard(f)
+                self._remove_local(f)
+        for f in requests['copy_out']:
+            self.copy_out_async(f)
+
+    def copy_out_async(self, path: str) -> None:
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._queue = queue.Queue()
+            t = threading.Thread(target=self._work, args=(self._queue,))
+            t.daemon = True
+            t.start()
+        self._queue.put(path)
+
+    def _work(self, q):
+        while True:
+            path = q.get()
+            try:
+                self.copy_out(path)
+            except OSError:
+                logger.exception("Could not copy %s out of scratch space", path)
+            if self.on_copied:
+                self.on_copied()
+
+    def copy_out(self, path: str) -> None:
+        with self._lock:
+            if path not in self.held:
+                return
+            tmp = path + '.tmp' + str(os.getpid())
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            shutil.copy2(self.local_path(path), tmp)
+            os.replace(tmp, path)
+            if self.in_use[path]:
+                # (a stage running here is reading it)
+                self.stale.add(path)
+            else:
+                self._remove_local(path)
+            self.held.discard(path)
+            self.copied.append(path)
+        logger.debug("Copied %s out of scratch space", path)
+
+    def copy_out_all(self) -> None:
+        """Copy out all the files held, e.g., before shutting down (files no longer needed
+        will have been deleted at the server's request)."""
+        for f in sorted(self.held):
+            self.copy_out(f)
+
+    def remove(self) -> None:
+        shutil.rmtree(self.dir, ignore_errors=True)
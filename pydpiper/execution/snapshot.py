@@ -0,0 +1,96 @@
+"""A binary snapshot of the server's scheduler state (the stage table and dependency graph,
+together with the stages' memory estimates, hooks and retry counts), from which a later server --
+e.g., the next generation of a server submitted with --submit-server -- can resume without
+rebuilding the pipeline's stages.
+
+A snapshot is a short header (magic string, format version and the key identifying the pipeline
+definition it was made from) followed by the zlib-compressed pickled state.  Which stages have
+finished isn't part of the snapshot: as on any restart, that comes from the finished stages log,
+which is always at least as recent."""
+
+import gc
+import hashlib
+import logging
+import os
+import pickle
+import struct
+import zlib
+
+from typing import Any, Dict, Iterable, Optional
+
+from .restart import file_signature
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"PYDPIPER-SNAPSHOT\n"
+# increment whenever the layout of the snapshot state changes
+SNAPSHOT_VERSION = 1
+# how often (in seconds) a running server refreshes its snapshot
+SNAPSHOT_INTERVAL = 1800
+
+_HEADER = struct.Struct("<II")  # version, length of the definition key
+
+
+def definition_key(argv: Iterable[str], version: str) -> str:
+    """Identifies a pipeline definition by the pydpiper version and the command which built it,
+    including the sizes and modification times of any files (the program itself, input images,
+    protocols, ...) named on the command line, since the stages can depend on their contents."""
+    h = hashlib.md5(version.encode())
+    for arg in argv:
+        h.update(b"\0" + arg.encode())
+        for value in [arg] + ([arg.split('=', 1)[1]] if arg.startswith('-') and '=' in arg else []):
+            if os.path.isfile(value):
+                h.update(("=" + file_signature(value, "stat")).encode())
+    return h.hexdigest()
+
+
+def write_snapshot(path: str, key: str, state: Dict[str, Any]) -> None:
+    """Atomically replace the snapshot at `path` (raises if the state can't be pickled)."""
+    data = zlib.compress(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL), 1)
+    tmp = "%s.tmp.%d" % (path, os.getpid())
+    try:
+        with open(tmp, 'wb') as fh:
+            fh.write(MAGIC)
+            fh.write(_HEADER.pack(SNAPSHOT_VERSION, len(key)))
+            fh.write(key.encode())
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def read_snapshot(path: str, key: str) -> Optional[Dict[str, Any]]:
+    """The state saved at `path`, or None if there's no usable snapshot there (none at all,
+    or one of a different format version or pipeline definition, or a damaged one)."""
+    try:
+        with open(path, 'rb') as fh:
+            if fh.read(len(MAGIC)) != MAGIC:
+                logger.info("%s is not a scheduler snapshot; ignoring it", path)
+                return None
+            version, key_len = _HEADER.unpack(fh.read(_HEADER.size))
+            if version != SNAPSHOT_VERSION:
+                logger.info("Scheduler snapshot has format version %d (not %d); ignoring it",
+                            version, SNAPSHOT_VERSION)
+                return None
+            if fh.read(key_len).decode() != key:
+                logger.info("Pipeline definition has changed since the scheduler snapshot was made; ignoring it")
+                return None
+            data = zlib.decompress(fh.read())
+        # unpickling creates an object or two per stage, each (needlessly) counting towards
+        # a collection of the young generation, which would repeatedly traverse the growing stage table
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return pickle.loads(data)
+        finally:
+            if enabled:
+                gc.enable()
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logger.exception("Could not read scheduler snapshot %s; ignoring it", path)
+        return None
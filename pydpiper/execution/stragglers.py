@@ -0,0 +1,165 @@
+"""Running backup copies of straggling stages (see --backup-stragglers), since a few stages of each generation
+of a model build tend to land on overloaded or slow nodes, and the averaging after them waits for the slowest.
+
+A running stage is a straggler once it has run for longer than a given percentile of the runtimes of its
+peers -- the finished stages running the same tool at the same depth in the stage graph, i.e., in the same
+generation -- which have finished in this run.  An executor with nothing to do is then given a copy of the
+straggler writing its outputs to a private location (a hidden subdirectory of each output's directory, so
+the outputs can be moved into place atomically).  If the copy finishes first, the original is cancelled and
+everything the copy wrote moved into place once it has stopped (including files it doesn't declare, such as
+the grids beside a nonlinear transform); if the original finishes first, the copy is cancelled and its
+outputs deleted.  Only stages whose outputs all appear verbatim in their commands can be
+copied, since otherwise they can't be redirected.
+The copies' directories are created, and their outputs moved into place or deleted, by a background thread,
+since they're likely on a network filesystem and the server would otherwise keep executors' requests waiting."""
+
+import logging
+import math
+import os
+import queue
+import re
+import shutil
+import threading
+
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# the least number of finished peers from which to judge whether a stage is straggling
+MIN_PEERS = 3
+# what the background thread does to a copy's files (as `Backup` methods), for its error messages
+FILE_ACTIONS = { "create_dirs" : "create the output directories",
+                 "promote"     : "move into place the outputs",
+                 "remove"      : "delete the outputs" }
+
+
+def percentile(values: List[float], p: float) -> float:
+    """The p-th percentile (by nearest rank) of some values.
+    >>> percentile([10, 20, 30, 40], 50), percentile([10, 20, 30, 40], 90), percentile([10], 0)
+    (20, 40, 10)
+    """
+    values = sorted(values)
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def backup_path(path: str, ix: int) -> str:
+    """Where the backup copy of stage `ix` writes its output `path` instead."""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, ".backup-%d" % ix, name)
+
+
+def redirect(cmd: List[str], paths: Dict[str, str]) -> List[str]:
+    """The command with the given paths replaced.
+    >>> redirect(["mincblur", "a.mnc", "tmp/a", "--out=tmp/a_blur.mnc"], {"tmp/a" : "tmp/.backup-1/a"})
+    ['mincblur', 'a.mnc', 'tmp/.backup-1/a', '--out=tmp/.backup-1/a_blur.mnc']
+    """
+    # (in one pass, longest first, so a path isn't replaced within another or its replacement)
+    pattern = re.compile('|'.join(re.escape(f) for f in sorted(paths, key=len, reverse=True)))
+    return [pattern.sub(lambda m: paths[m.group(0)], a) for a in cmd]
+
+
+class Backup(object):
+    """A backup copy of a running stage."""
+    def __init__(self, ix: int, outputs: List[str]) -> None:
+        # the stage's outputs and where the copy writes them instead
+        self.outputs = { f : backup_path(f, ix) for f in outputs }
+        # whether its output directories have been created, so it can be handed out ...
+        self.ready = False
+        # ... and the executor running it, once it has been
+        self.client = None  # type: Optional[str]
+        # whether the copy succeeded before the original finished (so the original is being cancelled) ...
+        self.won = False
+        # ... or the original finished first (so the copy is being cancelled)
+        self.cancelled = False
+
+    def create_dirs(self) -> None:
+        for f in self.outputs.values():
+            os.makedirs(os.path.dirname(f), exist_ok=True)
+
+    def promote(self) -> None:
+        """Move everything the copy wrote into place (each file atomically), since its declared outputs may
+        refer to others beside them, e.g., an .xfm to its grid files."""
+        for d in self.dirs():
+            directory = os.path.dirname(d)
+            for name in os.listdir(d):
+                target = os.path.join(directory, name)
+                if os.path.isdir(target) and not os.path.islink(target):
+                    shutil.rmtree(target)
+                os.replace(os.path.join(d, name), target)
+        self.remove()
+
+    def dirs(self) -> Set[str]:
+        return {os.path.dirname(f) for f in self.outputs.values()}
+
+    def remove(self) -> None:
+        for d in self.dirs():
+            shutil.rmtree(d, ignore_errors=True)
+
+
+class Stragglers(object):
+    """The runtimes of the stages finished so far, by peer group, and the backup copies, by stage.
+    The copies' files are dealt with by a background thread (see `submit`), started lazily since threads
+    don't survive the fork into the process running the Pyro daemon."""
+    def __init__(self, percentile: float) -> None:
+        self.percentile = percentile
+        self.runtimes = defaultdict(list)  # type: Dict[object, List[float]]
+        self.backups = {}  # type: Dict[int, Backup]
+        # the stages whose copies' outputs are being moved into place
+        self.promoting = set()  # type: Set[int]
+        self.launched = 0
+        self.won = 0
+        self._queue = None  # type: queue.Queue
+        self._done = None  # type: queue.Queue
+        self._pid = None  # type: int
+
+    def submit(self, ix: int, backup: Backup, action: str) -> None:
+        """Have the background thread call the given method (one of `FILE_ACTIONS`) of the copy of stage `ix`;
+        see `completed`."""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._queue, self._done = queue.Queue(), queue.Queue()
+            t = threading.Thread(target=self._work, args=(self._queue, self._done))
+            t.daemon = True
+            t.start()
+        self._queue.put((ix, backup, action))
+
+    def _work(self, q, done):
+        while True:
+            ix, backup, action = q.get()
+            try:
+                getattr(backup, action)()
+                ok = True
+            except OSError:
+                logger.warning("Could not %s of the copy of stage %d", FILE_ACTIONS[action], ix, exc_info=True)
+                ok = False
+            done.put((ix, backup, action, ok))
+            q.task_done()
+
+    def completed(self, block: bool = False) -> List[Tuple[int, Backup, str, bool]]:
+        """The (stage index, copy, action, success) of the submitted actions done since last asked
+        (waiting for all of them if `block`)."""
+        if self._pid != os.getpid():
+            return []
+        if block:
+            self._queue.join()
+        done = []
+        while True:
+            try:
+                done.append(self._done.get_nowait())
+            except queue.Empty:
+                return done
+
+    def finished(self, group, runtime: float) -> None:
+        self.runtimes[group].append(runtime)
+
+    def threshold(self, group) -> Optional[float]:
+        """How long a stage of the given peer group may run before it's considered a straggler (if known)."""
+        runtimes = self.runtimes.get(group)
+        if not runtimes or len(runtimes) < MIN_PEERS:
+            return None
+        return percentile(runtimes, self.percentile)
+
+    def report(self) -> str:
+        return ("Ran backup copies of %d straggling stages, of which %d finished first"
+                % (self.launched, self.won))
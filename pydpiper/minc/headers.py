@@ -0,0 +1,190 @@
+"""A process-wide cache of the MINC header information (dimensions, starts and step sizes)
+needed by the memory hooks of registration stages and by the checks on a pipeline's input files.
+
+Many stages share the same few inputs (e.g., every registration to an average), so without a cache
+the same headers are opened over and over -- often from a networked filesystem.  Entries are keyed
+by path and checked against the file's current size and modification time, so a file which has been
+rewritten since (e.g., by a re-run stage) is read again.  The cache can also be persisted to a file
+(see `MincHeaderCache.persist`) so that a restarted pipeline starts with a warm cache."""
+
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+from operator import mul
+
+import typing
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+# libminc (via HDF5) isn't thread-safe, so headers are read in separate processes rather than threads
+PREFETCH_WORKERS = 16
+# number of files read by a worker process at a time
+PREFETCH_CHUNK_SIZE = 16
+
+
+class MincHeader(typing.NamedTuple('MincHeader', [('dims', Tuple[int, ...]),
+                                                  ('starts', Tuple[float, ...]),
+                                                  ('separations', Tuple[float, ...])])):
+    """The geometry of a MINC volume.
+    >>> MincHeader(dims=(10, 20, 30), starts=(0.0, 0.0, 0.0), separations=(0.1, 0.1, 0.1)).voxels
+    6000
+    """
+    __slots__ = ()
+
+    @property
+    def voxels(self) -> int:
+        return reduce(mul, self.dims, 1)
+
+
+def read_minc_header(path: str) -> MincHeader:
+    """Read the header of the MINC file at `path` (but none of its data)."""
+    from pyminc.volumes.factory import volumeFromFile  # type: ignore
+    vol = volumeFromFile(path)
+    try:
+        return MincHeader(dims=tuple(int(d) for d in vol.getSizes()),
+                          starts=tuple(vol.starts),
+                          separations=tuple(vol.separations))
+    finally:
+        vol.closeVolume()
+
+
+def file_key(path: str) -> Tuple[int, int]:
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def format_record(path, key, header):
+    return json.dumps([path, key[0], key[1]] + [list(h) for h in header]) + "\n"
+
+
+def _read_or_error(reader, path):
+    # errors are returned rather than raised so that one bad file doesn't abort a whole batch
+    # (and as strings, since not all exceptions can be sent back from a worker process)
+    try:
+        return reader(path), None
+    except Exception as e:
+        return None, "%s: %s" % (type(e).__name__, e)
+
+
+class MincHeaderCache(object):
+    """A cache of `MincHeader`s by path.  `get` reads a single header (if not already cached),
+    `prefetch` many in parallel."""
+    def __init__(self, reader: Callable[[str], MincHeader] = read_minc_header) -> None:
+        self.reader = reader
+        self.path = None  # type: Optional[str]
+        self._headers = {}  # type: Dict[str, Tuple[Tuple[int, int], MincHeader]]
+        self._lock = threading.Lock()
+        # `get` may be called from several threads (e.g., the server's hook threads), but libminc isn't thread-safe
+        self._read_lock = threading.Lock()
+        self._fh = None
+        self._pid = None  # type: Optional[int]
+
+    def __len__(self):
+        return len(self._headers)
+
+    def _cached(self, path, key):
+        entry = self._headers.get(path)
+        return entry[1] if entry is not None and entry[0] == key else None
+
+    def _add(self, path, key, header):
+        with self._lock:
+            self._headers[path] = (key, header)
+            if self.path is not None:
+                fh = self._file()
+                fh.write(format_record(path, key, header))
+                fh.flush()
+
+    def _file(self):
+        # opened lazily (and per process) since the server runs in a process forked from the one which called `persist`
+        if self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._fh = open(self.path, 'a')
+            self._pid = os.getpid()
+        return self._fh
+
+    def get(self, path: str) -> MincHeader:
+        """The header of the MINC file at `path`; raises OSError if the file doesn't exist and
+        whatever the reader raises if it can't be read."""
+        key = file_key(path)
+        header = self._cached(path, key)
+        if header is None:
+            with self._read_lock:
+                header = self._cached(path, key)  # another thread may have just read it
+                if header is None:
+                    header = self.reader(path)
+                    self._add(path, key, header)
+        return header
+
+    def prefetch(self, paths: Iterable[str], workers: int = PREFETCH_WORKERS) -> Dict[str, str]:
+        """Read the headers of all `paths` not already cached, using up to `workers` processes.
+        Returns a description of the problem for each file which couldn't be read (or doesn't exist)."""
+        errors = {}  # type: Dict[str, str]
+        misses = []
+        for path in sorted(set(paths)):
+            try:
+                key = file_key(path)
+            except OSError as e:
+                errors[path] = "%s: %s" % (type(e).__name__, e)
+                continue
+            if self._cached(path, key) is None:
+                misses.append((path, key))
+        if len(misses) > 1 and workers > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(misses))) as pool:
+                results = list(pool.map(_read_or_error, [self.reader] * len(misses), [p for p, _ in misses],
+                                        chunksize=PREFETCH_CHUNK_SIZE))
+        else:
+            results = [_read_or_error(self.reader, p) for p, _ in misses]
+        for (path, key), (header, error) in zip(misses, results):
+            if error is None:
+                self._add(path, key, header)
+            else:
+                errors[path] = error
+        return errors
+
+    def persist(self, path: str) -> None:
+        """Load the headers previously saved to `path` and save newly read headers there from now on.
+        (The file is an append-only log with a JSON list per line; it's rewritten here if it contains
+        duplicate entries, so it doesn't grow without bound over many restarts, or lacks headers
+        which were read before this call.)"""
+        if path == self.path:
+            return
+        self.close()
+        n_lines, saved = 0, set()
+        try:
+            with open(path, 'r') as fh:
+                for l in fh:
+                    try:
+                        p, size, mtime, dims, starts, seps = json.loads(l)
+                    except ValueError:  # e.g., a line cut short by a crash
+                        continue
+                    n_lines += 1
+                    saved.add(p)
+                    # headers read in this process are at least as recent
+                    self._headers.setdefault(p, ((size, mtime), MincHeader(tuple(dims), tuple(starts), tuple(seps))))
+        except FileNotFoundError:
+            pass
+        self.path = path
+        if n_lines != len(saved) or len(saved) != len(self._headers):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            tmp = "%s.tmp.%d" % (path, os.getpid())
+            with open(tmp, 'w') as fh:
+                fh.writelines(format_record(p, key, header) for p, (key, header) in self._headers.items())
+            os.replace(tmp, path)
+
+    def close(self) -> None:
+        if self._fh is not None and self._pid == os.getpid():
+            self._fh.close()
+        self._fh, self._pid, self.path = None, None, None
+
+
+# the process-wide cache used by the registration code
+header_cache = MincHeaderCache()
+
+
+def minc_header(path: str) -> MincHeader:
+    return header_cache.get(path)
+
+
+def prefetch_minc_headers(paths: Iterable[str], workers: int = PREFETCH_WORKERS) -> Dict[str, str]:
+    return header_cache.prefetch(paths, workers=workers)
@@ -2,24 +2,20 @@ import csv
 import os
 import random
 import shlex
-import subprocess
 import sys
 import warnings
 import time
-from operator import mul
 
 from configargparse import Namespace
+from functools import partial
 from typing import Any, cast, Dict, Generic, Iterable, List, Optional, Set, Tuple, TypeVar, Union, Callable
 
-from functools import reduce
-
 from pydpiper.core.files import FileAtom
-from pydpiper.core.stages import CmdStage, Result, Stages
+from pydpiper.core.stages import CmdStage, Result, Stages, LOWEST_PRIORITY
 from pydpiper.core.util import pairs, AutoEnum, NamedTuple, raise_, flatten
 from pydpiper.minc.files import MincAtom, XfmAtom
 from pydpiper.minc.containers import XfmHandler
-
-from pyminc.volumes.factory import volumeFromFile  # type: ignore
+from pydpiper.minc.headers import minc_header, prefetch_minc_headers
 
 # TODO push down into lsq12_pairwise?
 gen = random.Random(137)  # seed must be a small int; see #291
@@ -167,6 +163,24 @@ default_mincblur_mem_cfg = MincblurMemCfg(base_mem=1.25e-02, mem_per_voxel=5.9e-
                                           tmpdir_factor=2.5, include_tmpdir=True)
 
 
+# Stage hooks are partial applications of module-level functions rather than closures so that,
+# like the rest of a stage, they can be pickled (into the server's scheduler snapshot).
+
+def print_message(message, _stage):
+    print(message)
+
+
+def set_mincblur_memory(img_path, mem_cfg, stage):
+    # we pass the stage itself as an argument since the stage will be converted to an old-style CmdStage,
+    # so `stage` will have no effect.  In order to receive this argument, hooks must now take a self-argument
+    # (instead of no arguments as previously).
+    voxels = minc_header(img_path).voxels
+    stage.input_voxels = voxels  # lets the server consult the stage history
+    #default_mem = self.mem #hack; see pipeline.addStage method
+    stage.setMem((mem_cfg.base_mem + voxels * mem_cfg.mem_per_voxel)
+                 * (mem_cfg.tmpdir_factor if mem_cfg.include_tmpdir else 1))
+
+
 def mincblur(img: MincAtom,
              fwhm: float,
              gradient: bool = True,
@@ -200,18 +214,10 @@ def mincblur(img: MincAtom,
     #stage.set_log_file(os.path.join(out_img.dir, "..", "log",
     #                                "%s_%s.log" % ("mincblur", out_img.filename_wo_ext)))
 
-    def set_memory(stage, mem_cfg):
-        # we pass the stage itself as an argument since the stage will be converted to an old-style CmdStage,
-        # so `stage` will have no effect.  In order to receive this argument, hooks must now take a self-argument
-        # (instead of no arguments as previously).
-        voxels = reduce(mul, volumeFromFile(img.path).getSizes())
-        #default_mem = self.mem #hack; see pipeline.addStage method
-        stage.setMem((mem_cfg.base_mem + voxels * mem_cfg.mem_per_voxel)
-                     * (mem_cfg.tmpdir_factor if mem_cfg.include_tmpdir else 1))
     # FIXME this is the final word; we might want (1) either the executor/system to look at it
     # or (2) a wrapper that enforces some sensible minimum, as with Pydpiper 1.x
     # (but the default_job_mem is not accessible here ... could make exec_options an arg to the hooks ...? crazy)
-    stage.when_runnable_hooks.append(lambda s: set_memory(s, default_mincblur_mem_cfg))
+    stage.when_runnable_hooks.append(partial(set_mincblur_memory, img.path, default_mincblur_mem_cfg))
 
     return Result(stages=Stages((stage,)),
                   output=Namespace(img=out_img, gradient=out_gradient) if gradient else Namespace(img=out_img))
@@ -281,7 +287,7 @@ def mincaverage(imgs: List[MincAtom],
     status_update_message = "\n\n* * * * * * *\nStatus update: \nFinished creating the following average:\n" \
                             + str(avg.path) + "\n" + time.ctime() + "\n* * * * * * *\n"
 
-    avg_cmd.when_finished_hooks.append(lambda _: print(status_update_message))
+    avg_cmd.when_finished_hooks.append(partial(print_message, status_update_message))
 
     s.add(avg_cmd)
     return Result(stages=s, output=avg)
@@ -290,6 +296,12 @@ def mincaverage(imgs: List[MincAtom],
 PMincAverageMemCfg = NamedTuple("PMincAverageMemCfg", [('base_mem', float), ('mem_per_voxel', float)])
 default_pmincaverage_mem_cfg = PMincAverageMemCfg(base_mem=0.5, mem_per_voxel=14.0/(430*13158000.0))
 
+
+def set_pmincaverage_memory(img_path, n_imgs, cfg, st):
+    voxels_per_file = minc_header(img_path).voxels
+    st.input_voxels = voxels_per_file * n_imgs
+    st.setMem(cfg.base_mem + voxels_per_file * cfg.mem_per_voxel * n_imgs)
+
 # FIXME this doesn't implement the avg_file and other mincaverage stuff (other than copy_header ...)
 # ... maybe there's enough similarity to parametrize over these and maybe others (xfmavg?!)
 def pmincaverage(imgs: List[MincAtom],
@@ -335,18 +347,15 @@ def pmincaverage(imgs: List[MincAtom],
                          out_atom=combined_mask))
         avg.mask = combined_mask
 
-    def set_memory(st, cfg):
-        voxels_per_file = reduce(mul, volumeFromFile(imgs[0].path).getSizes())
-        st.setMem(cfg.base_mem + voxels_per_file * cfg.mem_per_voxel * len(imgs))
-
-    avg_cmd.when_runnable_hooks.append(lambda st: set_memory(st, default_pmincaverage_mem_cfg))
+    avg_cmd.when_runnable_hooks.append(partial(set_pmincaverage_memory, imgs[0].path, len(imgs),
+                                               default_pmincaverage_mem_cfg))
 
     # averages in a pipeline often indicate important progress. Let's report that back to the user
     # in terms of a status update:
     status_update_message = "\n\n* * * * * * *\nStatus update: \nFinished creating the following average:\n" \
                             + str(avg.path) + "\n" + time.ctime() + "\n* * * * * * *\n"
 
-    avg_cmd.when_finished_hooks.append(lambda _: print(status_update_message))
+    avg_cmd.when_finished_hooks.append(partial(print_message, status_update_message))
 
     s.add(avg_cmd)
 
@@ -1104,6 +1113,13 @@ MinctraccMemCfg = NamedTuple("MinctraccMemCfg",
 default_minctracc_mem_cfg = MinctraccMemCfg(base_mem=3e-1, mem_per_voxel=6e-7)
 
 
+def set_minctracc_memory(source_path, cfg, st):
+    voxels = minc_header(source_path).voxels
+    st.input_voxels = voxels
+    st.setMem(voxels * cfg.mem_per_voxel + cfg.base_mem)   # FIXME hard-coded 7 is a hack ...
+    # TODO make a wrapper to generate these set_memory functions?
+
+
 # TODO: add memory estimation hook
 def minctracc(source: MincAtom,
               target: MincAtom,
@@ -1227,12 +1243,7 @@ def minctracc(source: MincAtom,
                      outputs=(out_xfm,))
 
     if nlin_conf is not None:  # TODO at the moment basically ignore resource requirements for linear stages ...
-        def set_memory(st, cfg):
-            voxels = reduce(mul, volumeFromFile(source.path).getSizes())
-            st.setMem(voxels * cfg.mem_per_voxel + cfg.base_mem)   # FIXME hard-coded 7 is a hack ...
-            # TODO make a wrapper to generate these set_memory functions?
-
-        stage.when_runnable_hooks.append(lambda st: set_memory(st, default_minctracc_mem_cfg))
+        stage.when_runnable_hooks.append(partial(set_minctracc_memory, source.path, default_minctracc_mem_cfg))
 
     s.add(stage)
 
@@ -1484,6 +1495,14 @@ MincANTSMemCfg = NamedTuple("MincANTSMemCfg",
 default_mincANTS_mem_cfg = MincANTSMemCfg(base_mem=0.177, mem_per_voxel_coarse=1.385e-7, mem_per_voxel_fine=2.1e-7)
 
 
+def set_mincANTS_memory(source_path, coarse, mem_cfg, st):
+    # see comments re: mincblur memory configuration
+    voxels = minc_header(source_path).voxels
+    st.input_voxels = voxels
+    mem_per_voxel = mem_cfg.mem_per_voxel_coarse if coarse else mem_cfg.mem_per_voxel_fine
+    st.setMem(mem_cfg.base_mem + voxels * mem_per_voxel)
+
+
 def ANTS(source: MincAtom,
          target: MincAtom,
          conf: MincANTSConf,
@@ -1557,16 +1576,10 @@ def ANTS(source: MincAtom,
             + (['-x', source.mask.path] if conf.use_mask and source.mask else []))
 
 
-    def set_memory(st, mem_cfg):
-        # see comments re: mincblur memory configuration
-        voxels = reduce(mul, volumeFromFile(source.path).getSizes())
-        mem_per_voxel = (mem_cfg.mem_per_voxel_coarse
-                         if int(conf.iterations.split('x')[-1]) == 0  # yikes ... this parsing should be done earlier
-                         else mem_cfg.mem_per_voxel_fine)
-        st.setMem(mem_cfg.base_mem + voxels * mem_per_voxel)
-
     # see comments re: mincblur memory configuration
-    stage.when_runnable_hooks.append(lambda st: set_memory(st, default_mincANTS_mem_cfg))
+    stage.when_runnable_hooks.append(partial(set_mincANTS_memory, source.path,
+                                             int(conf.iterations.split('x')[-1]) == 0,  # yikes ... this parsing should be done earlier
+                                             default_mincANTS_mem_cfg))
 
     s.add(stage)
     resampled = (s.defer(mincresample(img=source, xfm=out_xfm, like=target,
@@ -2110,36 +2123,33 @@ def lsq12_nlin_build_model(imgs       : List[MincAtom],
 
 
 def can_read_MINC_file(filename: str) -> bool:
-    """Can the MINC file `filename` with be read with `mincinfo`?"""
-    # FIXME: opening and closing this file many times might be quite slow on some platforms ...
-    # better to change to can_read_MINC_files.
-    with open(os.devnull, 'w') as dev_null:
-        ok = subprocess.call(["mincinfo", filename], stdout=dev_null, stderr=dev_null) == 0
-    return ok
+    """Can the header of the MINC file `filename` be read?  (The header is cached for later use.)"""
+    try:
+        minc_header(filename)
+    except Exception:
+        return False
+    return True
 
 
 def check_MINC_input_files(args: List[str]) -> None:
     """
-    This is a general function that checks MINC input files to a pipeline. It uses
-    the program mincinfo to test whether the input files are readable MINC files,
+    This is a general function that checks MINC input files to a pipeline. It reads
+    the headers of the input files (in parallel; the headers are cached, so later checks
+    and memory estimates don't read them again) to test whether they are readable MINC files,
     and ensures that the input files have distinct filenames. (A directory is created
     for each input file based on the filename without extension, which means that 
     filenames need to be distinct)
+    All problems found are reported before raising an error.
     
     args: names of input files
     """
     if len(args) < 1:
         raise ValueError("\nNo input files are provided.\n")
-    else:
-        # here we should also check that the input files can be read
-        issuesWithInputs = False
-        for inputF in args:
-            if not can_read_MINC_file(inputF):  # FIXME this will be quite slow on SciNet, etc.
-                print("\nError: can not read input file: " + str(inputF) + "\n", file=sys.stderr)
-                issuesWithInputs = True
-        if issuesWithInputs:
-            raise ValueError("\nIssues reading input files.\n")
-    # lastly we should check that the actual filenames are distinct, because
+    # here we should also check that the input files can be read
+    unreadable = prefetch_minc_headers(args)
+    for inputF, problem in sorted(unreadable.items()):
+        print("\nError: can not read input file: " + str(inputF) + " (" + problem + ")\n", file=sys.stderr)
+    # we should also check that the actual filenames are distinct, because
     # directories are made based on the basename
 
     duplicates_exist = False
@@ -2151,6 +2161,8 @@ def check_MINC_input_files(args: List[str]) -> None:
                           "input file list:\n" + str(fileBase) + ".mnc")
             duplicates_exist = True
         seen.add(fileBase)
+    if unreadable:
+        raise ValueError("\nIssues reading %d input file(s).\n" % len(unreadable))
     if duplicates_exist:
         raise ValueError("Please provide unique names for all input files")
 
@@ -2165,21 +2177,19 @@ def check_MINC_files_have_equal_dimensions_and_resolution(args: List[str],
     if len(args) < 2:
         return True
 
-    first_file = volumeFromFile(args[0])
-    img_dimensions_first = ([int(element) for element in first_file.getSizes()])
-    img_separations_first = first_file.separations
-    img_starts_first = first_file.starts
-    for other_img in args[1:]:
-        other_volume = volumeFromFile(other_img)
-        if not img_dimensions_first   == ([int(element) for element in other_volume.getSizes()]) or \
-            not img_separations_first == other_volume.separations or \
-            not img_starts_first      == other_volume.starts :
-            print("\nThe input files do not all have the same "
-                  "dimensions/starts/step sizes. The first input "
-                  "file:\n", str(args[0]), " differs from:\n",
-                  str(other_img), "\n")
-            raise ValueError("Not all input images have similar bounding boxes. "
-                             + additional_msg)
+    unreadable = prefetch_minc_headers(args)  # usually already cached by `check_MINC_input_files`
+    if unreadable:
+        raise IOError("\nError: can not read input file(s): %s\n" % ", ".join(sorted(unreadable)))
+    first_header = minc_header(args[0])
+    # compares dimensions, starts and step sizes
+    different = [other_img for other_img in args[1:] if minc_header(other_img) != first_header]
+    if different:
+        print("\nThe input files do not all have the same "
+              "dimensions/starts/step sizes. The first input "
+              "file:\n", str(args[0]), " differs from:\n",
+              "\n".join(str(other_img) for other_img in different), "\n")
+        raise ValueError("Not all input images have similar bounding boxes. "
+                         + additional_msg)
 
 
 # data structures to hold setting for the parameter settings we know about:
@@ -2812,10 +2822,10 @@ def get_resolution_from_file(input_file: str) -> float:
     input_file -- string pointing to an existing MINC file
     """
     # quite important is that this file actually exists...
-    if not can_read_MINC_file(input_file):
-        raise IOError("\nError: can not read input file: %s\n" % input_file)
-
-    image_resolution = volumeFromFile(input_file).separations
+    try:
+        image_resolution = minc_header(input_file).separations
+    except Exception as e:
+        raise IOError("\nError: can not read input file: %s (%s)\n" % (input_file, e))
 
     return min([abs(x) for x in image_resolution])
 
@@ -2853,9 +2863,8 @@ def create_quality_control_images(imgs: List[MincAtom],
         img_verification = img.newname_with_suffix("_QC_image",
                                                    subdir="tmp",
                                                    ext=".png")
-        # TODO: the memory and procs are set to 0 to ensure that
-        # these stages finish soonish. No other stages depend on
-        # these, but we do want them to finish as soon as possible
+        # no other stages depend on these, so let the scheduler run
+        # them after anything which other stages are waiting for
         mincpik_stage = CmdStage(
             inputs=(img,),
             outputs=(img_verification,),
@@ -2864,7 +2873,8 @@ def create_quality_control_images(imgs: List[MincAtom],
                  "-triplanar",
                  img.path, img_verification.path],
             memory=1,
-            procs=1)
+            procs=1,
+            priority=LOWEST_PRIORITY)
         s.add(mincpik_stage)
         individualImages.append(img_verification)
 
@@ -2876,7 +2886,7 @@ def create_quality_control_images(imgs: List[MincAtom],
                                                            subdir="tmp",
                                                            ext=".png")
         # FIXME: no other stages depend on
-        # these, but we do want them to finish as soon as possible
+        # these, so they get the lowest priority
         # -- perhaps we could instead return the montage stage (or, if no montage is to be created,
         # an empty stage) from this whole procedure and add it as in input (or better, a non-input dependency,
         # which isn't currently supported) to succeeding stages as desired?
@@ -2888,7 +2898,8 @@ def create_quality_control_images(imgs: List[MincAtom],
                  img_verification.path,
                  img_verification_convert.path],
             memory=1,
-            procs=1)
+            procs=1,
+            priority=LOWEST_PRIORITY)
         s.add(convert_stage)
         individualImagesLabeled.append(img_verification_convert)
 
@@ -2904,15 +2915,15 @@ def create_quality_control_images(imgs: List[MincAtom],
                 [labeled_img.path for labeled_img in individualImagesLabeled] +
                 [montage_output_fileatom.path],
             memory=1,
-            procs=1)
+            procs=1,
+            priority=LOWEST_PRIORITY)
         montage_stage.set_log_file(os.path.join(os.path.dirname(montage_output_fileatom.path),
                                                 "log",
                                                 montage_output_fileatom.filename_wo_ext + ".log"))
         message_to_print = ("\n* * * * * * *\nPlease consider the following verification "
                             "image, showing %s. \n%s\n* * * * * * *\n" % (message, montage_output_fileatom.path))
 
-        montage_stage.when_finished_hooks.append(
-            lambda _: print(message_to_print))
+        montage_stage.when_finished_hooks.append(partial(print_message, message_to_print))
 
         s.add(montage_stage)
 
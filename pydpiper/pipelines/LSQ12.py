@@ -4,7 +4,7 @@ import sys
 
 from pydpiper.core.arguments import (AnnotatedParser, execution_parser, # lsq6_parser,
                                      lsq12_parser, registration_parser, application_parser, parse, CompoundParser)
-from pydpiper.execution.application import execute
+from pydpiper.execution.application import resume_or_execute
 from pydpiper.minc.registration import (lsq12_pairwise, LSQ12Conf,
                                         default_lsq12_multilevel_minctracc,
                                         parse_minctracc_nonlinear_protocol_file, get_resolution_from_file,
@@ -42,8 +42,7 @@ def main(args):
            lsq12_parser])
 
     options = parse(p, args[1:])
-    stages = LSQ12_pipeline(options).stages
-    execute(stages, options)
+    resume_or_execute(options, lambda: LSQ12_pipeline(options).stages)
 
 if __name__ == '__main__':
     main(sys.argv)
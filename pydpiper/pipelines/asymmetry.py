@@ -14,7 +14,7 @@ from pydpiper.core.stages import Result, Stages
 from pydpiper.pipelines.twolevel_model_building import two_level
 from pydpiper.core.arguments import (execution_parser, registration_parser, application_parser, parse, CompoundParser,
                                      AnnotatedParser)
-from pydpiper.execution.application import execute
+from pydpiper.execution.application import resume_or_execute
 from pydpiper.minc.registration import volflip, check_MINC_input_files
 from pydpiper.minc.files import MincAtom
 
@@ -57,8 +57,7 @@ def main(args):
            AnnotatedParser(parser=mbm_parser, namespace="mbm")])
 
     options = parse(p, args[1:])
-    stages = asymmetry_pipeline(options).stages
-    execute(stages, options)
+    resume_or_execute(options, lambda: asymmetry_pipeline(options).stages)
 
 
 if __name__ == '__main__':
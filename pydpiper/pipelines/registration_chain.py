@@ -23,7 +23,7 @@ from pydpiper.minc.registration import (Subject, Stages, mincANTS_NLIN_build_mod
                                         parse_minctracc_nonlinear_protocol, get_nonlinear_configuration_from_options,
                                         mincresample)
 from pydpiper.minc.files import MincAtom
-from pydpiper.execution.application import execute  # type: ignore
+from pydpiper.execution.application import resume_or_execute  # type: ignore
 from pydpiper.core.arguments import (application_parser,
                                      chain_parser,
                                      execution_parser,
@@ -729,25 +729,7 @@ def get_chain_transforms_for_stats(pipeline_subject_info, intersubj_xfms_dict, c
     return Result(stages=s, output=(dict_transforms_to_common_avg, dict_transforms_to_subject_common_tp))
 
 
-if __name__ == "__main__":
-
-    p = CompoundParser(
-          [execution_parser,
-           application_parser,
-           registration_parser,
-           lsq6_parser,
-           # TODO: either switch back to automatically unpacking as part of `parse`
-           # or write a helper to do \ns: C(**vars(ns))
-           lsq12_parser, # should be MBM or build_model ...
-           nlin_parser,
-           #AnnotatedParser(parser=BaseParser(addLSQ12ArgumentGroup), namespace='lsq12-inter-subj'),
-           #addNLINArgumentGroup,
-           stats_parser,
-           AnnotatedParser(parser=_chain_parser, prefix="chain", namespace="chain")])
-    
-    # TODO could abstract and then parametrize by prefix/ns ??
-    options = parse(p, sys.argv[1:])
-
+def chain_pipeline_stages(options):
     # TODO: the registration resolution should be set somewhat outside
     # of any actual function? Maybe the right time to set this, is here
     # when options are gathered?
@@ -808,4 +790,25 @@ if __name__ == "__main__":
 
     #chain_stages = chain(options).stages
 
-    execute(chain_result.stages, options)
+    return chain_result.stages
+
+
+if __name__ == "__main__":
+
+    p = CompoundParser(
+          [execution_parser,
+           application_parser,
+           registration_parser,
+           lsq6_parser,
+           # TODO: either switch back to automatically unpacking as part of `parse`
+           # or write a helper to do \ns: C(**vars(ns))
+           lsq12_parser, # should be MBM or build_model ...
+           nlin_parser,
+           #AnnotatedParser(parser=BaseParser(addLSQ12ArgumentGroup), namespace='lsq12-inter-subj'),
+           #addNLINArgumentGroup,
+           stats_parser,
+           AnnotatedParser(parser=_chain_parser, prefix="chain", namespace="chain")])
+    
+    # TODO could abstract and then parametrize by prefix/ns ??
+    options = parse(p, sys.argv[1:])
+    resume_or_execute(options, lambda: chain_pipeline_stages(options))
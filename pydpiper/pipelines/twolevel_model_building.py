@@ -17,7 +17,7 @@ from pydpiper.minc.registration import (concat_xfmhandlers, invert_xfmhandler, m
                                         TargetType, get_pride_of_models_mapping, get_resolution_from_file,
                                         registration_targets)
 from pydpiper.pipelines.MBM import mbm, MBMConf, mk_mbm_parser
-from pydpiper.execution.application import execute
+from pydpiper.execution.application import resume_or_execute
 from pydpiper.core.util import NamedTuple, maybe_deref_path
 from pydpiper.core.stages import Stages, Result
 from pydpiper.core.arguments import (AnnotatedParser, CompoundParser, application_parser,
@@ -255,8 +255,7 @@ def main(args):
            ])  # TODO add more stats parsers?
 
     options = parse(p, args[1:])
-
-    execute(two_level_pipeline(options).stages, options)
+    resume_or_execute(options, lambda: two_level_pipeline(options).stages)
 
 if __name__ == "__main__":
     main(sys.argv)
\ No newline at end of file
@@ -33,7 +33,7 @@ setup(name='pydpiper',
                    [os.path.join("config", f)
                     for f in ['CCM_HPF.cfg', 'MICe.cfg', 'MICe_dev.cfg', 'SciNet.cfg', 'SciNet_debug.cfg']])],
       scripts=([os.path.join("pydpiper/execution", script) for script in
-                ['pipeline_executor.py', 'check_pipeline_status.py']] +
+                ['pipeline_executor.py', 'check_pipeline_status.py', 'artifact_cache.py']] +
                [os.path.join("pydpiper/pipelines", f) for f in
                 ['asymmetry.py', 'LSQ12.py', 'LSQ6.py', 'MAGeT.py', 'MBM.py', 'NLIN.py',
                  'registration_chain.py', 'twolevel_model_building.py']]),
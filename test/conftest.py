@@ -0,0 +1,20 @@
+import pytest
+
+from pydpiper.core.arguments import CompoundParser, application_parser, execution_parser, parse
+
+
+@pytest.fixture()
+def options():
+    """A function returning the options of a pipeline named 'p' run with the default application and execution
+    arguments, except for the given overrides (of either kind), e.g., `options(gc_intermediates=True)`."""
+    def f(**overrides):
+        opts = parse(CompoundParser([application_parser, execution_parser]), [])
+        opts.application.pipeline_name = "p"
+        opts.execution.urifile = "uri"
+        for k, v in overrides.items():
+            ns = opts.application if hasattr(opts.application, k) else opts.execution
+            if not hasattr(ns, k):
+                raise AttributeError("no such option: %s" % k)
+            setattr(ns, k, v)
+        return opts
+    return f
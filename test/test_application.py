@@ -0,0 +1,67 @@
+import pytest
+from configargparse import Namespace
+
+from pydpiper.core.files import FileAtom
+from pydpiper.core.stages import CmdStage
+from pydpiper.execution import application
+from pydpiper.execution.application import convert_and_check_stages, ensure_no_problems, resume_or_execute
+
+
+@pytest.fixture()
+def pipeline_dir(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    return str(tmpdir)
+
+
+def stage(cmd, pipeline_dir, output):
+    out = FileAtom(output if output.startswith("/") else "%s/%s" % (pipeline_dir, output),
+                   pipeline_sub_dir=pipeline_dir)
+    return CmdStage(inputs=(), outputs=(out,), cmd=[cmd, out.path])
+
+
+def check(stages, pipeline_dir):
+    return convert_and_check_stages(stages, pipeline_name="p", pipeline_dir=pipeline_dir)
+
+
+class TestConvertAndCheckStages():
+    def test_ok(self, pipeline_dir):
+        converted, problems = check([stage("touch", pipeline_dir, "a.txt"),
+                                     stage("touch", pipeline_dir, "b.txt")], pipeline_dir)
+        assert problems == []
+        assert [c.outputFiles for c in converted] == [[pipeline_dir + "/a.txt"], [pipeline_dir + "/b.txt"]]
+        with open("p_pipeline_stages.txt") as f:
+            assert len(f.readlines()) == 2
+    def test_nondistinct_outputs(self, pipeline_dir):
+        _, problems = check([stage("touch", pipeline_dir, "foo.txt"),
+                             stage("cp", pipeline_dir, "foo.txt"),
+                             stage("touch", pipeline_dir, "foo.txt")], pipeline_dir)
+        assert len(problems) == 1
+        conflicts = problems[0].args[1]
+        assert list(conflicts) == [pipeline_dir + "/foo.txt"]
+        assert len(conflicts[pipeline_dir + "/foo.txt"]) == 2
+    def test_all_problems_found(self, pipeline_dir):
+        _, problems = check([stage("touch", pipeline_dir, "x" * 300 + ".txt"),
+                             stage("touch", pipeline_dir, "/elsewhere/a.txt"),
+                             stage("no-such-command-pydpiper", pipeline_dir, "b.txt")], pipeline_dir)
+        assert len(problems) == 4  # the stage's log file name is too long, too
+        with pytest.raises(ValueError, match="too long"):
+            ensure_no_problems(problems)
+
+
+class TestResumeOrExecute():
+    @pytest.fixture()
+    def ran(self, monkeypatch):
+        ran = []
+        monkeypatch.setattr(application, "run_pipeline", lambda pipeline, options: ran.append(("resumed", pipeline)))
+        monkeypatch.setattr(application, "execute", lambda stages, options: ran.append(("executed", stages)))
+        return ran
+    def options(self):
+        return Namespace(application=Namespace(persist_minc_headers=False))
+    def test_stages_not_constructed_when_resuming(self, ran, monkeypatch):
+        monkeypatch.setattr(application, "resume_pipeline", lambda options: "snapshot")
+        resume_or_execute(self.options(), lambda: pytest.fail("stages constructed"))
+        assert ran == [("resumed", "snapshot")]
+    def test_executed_otherwise(self, ran, monkeypatch):
+        monkeypatch.setattr(application, "resume_pipeline", lambda options: None)
+        resume_or_execute(self.options(), lambda: "stages")
+        assert ran == [("executed", "stages")]
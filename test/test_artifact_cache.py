@@ -0,0 +1,135 @@
+import os
+import time
+
+import pytest
+
+from pydpiper.execution.artifact_cache import ArtifactCache, command_template, main
+from pydpiper.execution.pipeline import Pipeline, CmdStage, InputFile, OutputFile
+
+
+def write(path, contents):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(contents)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+@pytest.fixture()
+def cache(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    return ArtifactCache(str(tmpdir.join("cache")))
+
+
+def stored(cache, cmd, inputs, outputs):
+    """Run (well, pretend to run) a stage and publish its outputs, returning its key."""
+    key = cache.stage_key(cmd, inputs, outputs)
+    for out in outputs:
+        write(out, "output of %s" % " ".join(cmd))
+    cache.publish(key, cmd, outputs)
+    return key
+
+
+class TestArtifactCache():
+    def test_template_independent_of_directory(self):
+        assert (command_template(["blur", "/a/x.mnc", "/a/tmp/x_blur.mnc"], ["/a/x.mnc"], ["/a/tmp/x_blur.mnc"])
+                == command_template(["blur", "/b/x.mnc", "/b/tmp/x_blur.mnc"], ["/b/x.mnc"], ["/b/tmp/x_blur.mnc"]))
+    def test_key_depends_on_input_contents(self, cache):
+        write("in.mnc", "scan")
+        key = cache.stage_key(["blur", "in.mnc", "out.mnc"], ["in.mnc"], ["out.mnc"])
+        write("in.mnc", "another scan")
+        assert cache.stage_key(["blur", "in.mnc", "out.mnc"], ["in.mnc"], ["out.mnc"]) != key
+    def test_restore(self, cache):
+        write("in.mnc", "scan")
+        key = stored(cache, ["blur", "in.mnc", "out.mnc"], ["in.mnc"], ["out.mnc"])
+        os.remove("out.mnc")
+        assert cache.restore(key, ["elsewhere/out.mnc"])
+        assert read("elsewhere/out.mnc") == "output of blur in.mnc out.mnc"
+        # (linked to the store, which mustn't then be written to)
+        assert os.stat("elsewhere/out.mnc").st_nlink == 2
+        assert not os.access("elsewhere/out.mnc", os.W_OK) or os.geteuid() == 0
+    def test_miss_detaches_linked_outputs(self, cache):
+        write("in.mnc", "scan")
+        key = stored(cache, ["blur", "in.mnc", "out.mnc"], ["in.mnc"], ["out.mnc"])
+        os.remove("out.mnc")
+        cache.restore(key, ["out.mnc"])
+        assert not cache.restore("0" * 64, ["out.mnc"])
+        assert not os.path.exists("out.mnc")
+    def test_transform_stored_with_its_grid(self, cache):
+        write("in.mnc", "scan")
+        cmd = ["mincANTS", "in.mnc", "nlin.xfm"]
+        key = cache.stage_key(cmd, ["in.mnc"], ["nlin.xfm"])
+        write("nlin.xfm", "Displacement_Volume = nlin_grid_0.mnc;")
+        write("nlin_grid_0.mnc", "grid")
+        cache.publish(key, cmd, ["nlin.xfm"])
+        assert cache.restore(key, ["elsewhere/nlin.xfm"])
+        assert read("elsewhere/nlin_grid_0.mnc") == "grid"
+        # (and a stage reading the transform depends on the grid's contents)
+        resample = ["mincresample", "-transform", "nlin.xfm", "out.mnc"]
+        before = cache.stage_key(resample, ["nlin.xfm"], ["out.mnc"])
+        write("nlin_grid_0.mnc", "another grid")
+        assert cache.stage_key(resample, ["nlin.xfm"], ["out.mnc"]) != before
+    def test_transform_referring_elsewhere_not_stored(self, cache):
+        write("in.mnc", "scan")
+        cmd = ["mincANTS", "in.mnc", "nlin.xfm"]
+        key = cache.stage_key(cmd, ["in.mnc"], ["nlin.xfm"])
+        write("nlin.xfm", "Displacement_Volume = %s;" % os.path.abspath("grids/nlin_grid_0.mnc"))
+        write("grids/nlin_grid_0.mnc", "grid")
+        cache.publish(key, cmd, ["nlin.xfm"])
+        assert cache.lookup(key) is None
+    def test_prune_least_recently_used(self, cache):
+        write("in.mnc", "scan")
+        old = stored(cache, ["blur", "in.mnc", "old.mnc"], ["in.mnc"], ["old.mnc"])
+        os.utime(cache.entry_path(old), (time.time() - 100, time.time() - 100))
+        new = stored(cache, ["resample", "in.mnc", "new.mnc"], ["in.mnc"], ["new.mnc"])
+        evicted, freed = cache.prune(max_bytes=len("output of resample in.mnc new.mnc"))
+        assert (evicted, freed) == (1, len("output of blur in.mnc old.mnc"))
+        assert cache.lookup(old) is None and cache.lookup(new) is not None
+    def test_prune_keeps_recent_orphans(self, cache):
+        write("in.mnc", "scan")
+        key = stored(cache, ["blur", "in.mnc", "out.mnc"], ["in.mnc"], ["out.mnc"])
+        os.remove(cache.entry_path(key))
+        assert cache.prune(max_bytes=0) == (0, 0)
+        assert len(cache.objects()) == 1
+    def test_command_line(self, cache, capsys):
+        write("in.mnc", "scan")
+        stored(cache, ["blur", "in.mnc", "out.mnc"], ["in.mnc"], ["out.mnc"])
+        main([cache.root, "list"])
+        assert "blur" in capsys.readouterr().out
+        main([cache.root, "clear"])
+        assert "Evicted 1 entries" in capsys.readouterr().out
+        main([cache.root, "stats"])
+        assert "Entries: 0" in capsys.readouterr().out
+
+
+class TestPipelineReuse():
+    def chain(self, tmpdir, options):
+        return Pipeline([CmdStage(["blur", InputFile("in.mnc"), OutputFile("blur.mnc")]),
+                         CmdStage(["resample", InputFile("blur.mnc"), OutputFile("out.mnc")])],
+                        options(local=True, artifact_cache=str(tmpdir.join("cache"))))
+    def test_hit_finishes_stage_without_running_it(self, cache, tmpdir, options):
+        write("in.mnc", "scan")
+        key = stored(cache, ["blur", "in.mnc", "blur.mnc"], ["in.mnc"], ["blur.mnc"])
+        os.remove("blur.mnc")
+        p = self.chain(tmpdir, options)
+        p.enqueue_runnable_stages()
+        p.wait_for_hooks()
+        assert p.stages[0].status == "finished" and p.restored_stages == 1
+        assert read("blur.mnc") == "output of blur in.mnc blur.mnc"
+        # (the resampling hasn't been stored, so must be run, storing its outputs under its key)
+        assert list(p.runnable) == [1]
+        p.registerClient("c1", 8)
+        info = p.get_stage_info(1)
+        assert info.artifact_key == cache.stage_key(p.stages[1].cmd, ["blur.mnc"], ["out.mnc"])
+        assert info.outputs == ["out.mnc"]
+        assert key != info.artifact_key
+    def test_miss_runs_stage(self, cache, tmpdir, options):
+        write("in.mnc", "scan")
+        p = self.chain(tmpdir, options)
+        p.enqueue_runnable_stages()
+        p.wait_for_hooks()
+        assert list(p.runnable) == [0] and p.restored_stages == 0
+        assert p.get_stage_info(0).artifact_key == cache.stage_key(p.stages[0].cmd, ["in.mnc"], ["blur.mnc"])
@@ -0,0 +1,130 @@
+import os
+import stat
+import threading
+
+import pytest
+
+from pydpiper.execution.autoscaling import Autoscaler
+from pydpiper.execution.pipeline import Pipeline, CmdStage, InputFile, OutputFile
+
+FAKE_QBATCH = """#!/bin/sh
+# records its arguments and the number of executors submitted (one per line of the script)
+echo "$@" $(grep -c '') >> "%s"
+"""
+
+
+@pytest.fixture()
+def qbatch(tmpdir, monkeypatch):
+    """A stand-in for qbatch on the PATH; returns a function giving the submissions made so far."""
+    monkeypatch.chdir(tmpdir)
+    bindir = tmpdir.mkdir("bin")
+    log = str(tmpdir.join("submissions"))
+    script = str(bindir.join("qbatch"))
+    with open(script, 'w') as f:
+        f.write(FAKE_QBATCH % log)
+    os.chmod(script, os.stat(script).st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", str(bindir) + os.pathsep + os.environ["PATH"])
+    def submissions():
+        if not os.path.exists(log):
+            return []
+        with open(log) as f:
+            return [(next(a for a in line.split() if a.startswith("--mem=")), int(line.split()[-1]))
+                    for line in f]
+    return submissions
+
+
+@pytest.fixture()
+def start(options):
+    """A function starting a pipeline of the given stages, autoscaling its executors unless told otherwise."""
+    def f(stages, **kwargs):
+        overrides = dict(default_job_mem=1.0, mem=8, ppn=1, num_exec=10, monitor_heartbeats=False, autoscale=True,
+                         queue_wait=100, queue_type="pbs", time=None)
+        overrides.update(kwargs)
+        p = Pipeline(stages, options(**overrides))
+        p.shutdown_ev = threading.Event()
+        p.memAvail = 8
+        p.enqueue_runnable_stages()
+        p.wait_for_hooks()
+        return p
+    return f
+
+
+def average_then_resample(runtime=50.0):
+    """A narrow phase (a single average) followed by a wide one (resampling six images with the average)."""
+    stages = [CmdStage(["mincaverage", InputFile("a.mnc"), InputFile("b.mnc"), OutputFile("avg.mnc")])]
+    stages[0].estimated_runtime = runtime
+    stages.extend(CmdStage(["mincresample", InputFile("avg.mnc"), OutputFile("out%d.mnc" % k)]) for k in range(6))
+    return stages
+
+
+class TestAutoscaler():
+    def test_queue_wait_learned(self):
+        a = Autoscaler(queue_wait=300)
+        a.launched(2, t=0)
+        a.registered(t=200)
+        assert a.queue_wait == pytest.approx(270)
+        assert len(a.launch_times) == 1
+    def test_executors_started_by_hand_ignored(self):
+        a = Autoscaler(queue_wait=300)
+        a.registered(t=200)
+        assert a.queue_wait == 300
+    def test_plan(self):
+        a = Autoscaler(queue_wait=300)
+        a.plan(demand_on_arrival=20, demand_until_replaced=5, active=4, max_executors=10)
+        assert (a.to_launch, a.surplus) == (6, 0)
+        a.plan(demand_on_arrival=1, demand_until_replaced=2, active=4, max_executors=10)
+        assert (a.to_launch, a.surplus) == (0, 2)
+
+
+class TestPipelineAutoscaling():
+    def test_initial_launch(self, qbatch, start):
+        p = start(average_then_resample())
+        p.manageExecutors()
+        assert qbatch() == [("--mem=1GB", 1)]
+    def test_launch_ahead_of_wide_phase(self, qbatch, start):
+        p = start(average_then_resample())
+        p.registerClient("c1", 8)
+        flag, [info] = p.getCommands("c1", 8, 1)
+        assert info.ix == 0 and len(p.runnable) == 0
+        # (the resamplings become runnable after 50 s, before executors launched now could arrive)
+        p.manageExecutors()
+        assert qbatch() == [("--mem=1GB", 5)]
+        assert p.number_launched_and_waiting_clients == 5
+    def test_no_launch_for_work_done_before_arrival(self, qbatch, start):
+        p = start(average_then_resample(runtime=500))
+        p.registerClient("c1", 8)
+        p.getCommands("c1", 8, 1)
+        p.manageExecutors()
+        assert qbatch() == []
+    def test_wide_phase_drained_before_arrival(self, qbatch, start):
+        stages = [CmdStage(["mincresample", InputFile("in%d.mnc" % k), OutputFile("out%d.mnc" % k)]) for k in range(4)]
+        for s in stages:
+            s.estimated_runtime = 10.0
+        p = start(stages)
+        p.registerClient("c1", 8)
+        p.registerClient("c2", 8)
+        p.manageExecutors()
+        assert qbatch() == []
+        assert p.autoscaler.surplus == 0
+    def test_idle_executors_released(self, qbatch, start):
+        p = start(average_then_resample(runtime=500))
+        for c in ["c1", "c2", "c3"]:
+            p.registerClient(c, 8)
+        p.getCommands("c1", 8, 1)
+        p.manageExecutors()
+        assert p.autoscaler.surplus == 2
+        assert p.getCommands("c2", 8, 1) == ("shutdown_normally", None)
+        assert p.getCommands("c3", 8, 1) == ("shutdown_normally", None)
+        # (the executor running the average is kept, and the retiring ones aren't counted again)
+        p.manageExecutors()
+        assert p.autoscaler.surplus == 0
+        p.unregisterClient("c2")
+        assert p.autoscaler.retiring == {"c3"}
+    def test_not_autoscaling(self, qbatch, start):
+        p = start(average_then_resample(), autoscale=False)
+        for c in ["c1", "c2"]:
+            p.registerClient(c, 8)
+        p.getCommands("c1", 8, 1)
+        p.manageExecutors()
+        assert p.getCommands("c2", 8, 1) == ("wait", None)
+        assert qbatch() == []
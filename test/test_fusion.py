@@ -0,0 +1,94 @@
+import threading
+
+import pytest
+
+from pydpiper.execution.journal import FinishedStagesJournal
+from pydpiper.execution.pipeline import Pipeline, CmdStage, InputFile, OutputFile
+from pydpiper.execution.pipeline_executor import StageInfo, runStages
+
+
+@pytest.fixture()
+def pipeline(tmpdir, monkeypatch, options):
+    """Blurring an image, registering the blurred image and resampling with the resulting transform,
+    as well as making a QC image of the blurred image (so the blurring has two successors)."""
+    monkeypatch.chdir(tmpdir)
+    def make(fuse_stages=True):
+        stages = [CmdStage(["mincblur", InputFile("a.mnc"), OutputFile("b.mnc")]),
+                  CmdStage(["minctracc", InputFile("b.mnc"), OutputFile("c.xfm")]),
+                  CmdStage(["mincresample", InputFile("c.xfm"), OutputFile("d.mnc")]),
+                  CmdStage(["mincpik", InputFile("d.mnc"), OutputFile("d.png")]),
+                  CmdStage(["mincpik", InputFile("b.mnc"), OutputFile("b.png")])]
+        p = Pipeline(stages, options(default_job_mem=1.0, mem=8, proc=2, local=True, fuse_stages=fuse_stages,
+                                     retry_delay=0))  # (so a failed chain is retried at once)
+        p.shutdown_ev = threading.Event()
+        p.enqueue_runnable_stages()
+        p.wait_for_hooks()
+        p.registerClient("c1", 8)
+        return p
+    return make
+
+
+def blur(p):
+    flag, [info] = p.getCommands("c1", 8, 1)
+    assert info.ix == 0 and info.fused == []
+    p.reportStageResults("c1", [(0, 0, None)])
+
+
+class TestFusion():
+    def test_links(self, pipeline):
+        assert list(pipeline().fused_next) == [-1, 2, 3, -1, -1]
+    def test_not_fused_by_default(self, pipeline):
+        assert pipeline(fuse_stages=False).fused_next is None
+    def test_chain_sent_together(self, pipeline):
+        p = pipeline()
+        blur(p)
+        flag, [info] = p.getCommands("c1", 8, 1)
+        assert flag == "run_stages" and info.ix == 1
+        assert [f.ix for f in info.fused] == [2, 3]
+        assert p.currently_running_stages == {1, 2, 3}
+        # the rest of the chain isn't handed out again when the first stage finishes
+        p.reportStageResults("c1", [(1, 0, None)])
+        assert 2 not in p.runnable and list(p.runnable) == [4]
+        p.reportStageResults("c1", [(2, 0, None), (3, 0, None)])
+        p.finished_stages_journal.flush()
+        assert [ix for ix, _h, _fingerprint in FinishedStagesJournal(p.backupFileLocation).records()] == [0, 1, 2, 3]
+    def test_chain_limited_by_free_resources(self, pipeline):
+        p = pipeline()
+        p.stages[3].setMem(6.0)
+        blur(p)
+        flag, [first, second] = p.getCommands("c1", 4, 2)
+        assert [first.ix] + [f.ix for f in first.fused] == [1, 2]
+        assert second.ix == 4
+    def test_chain_ends_at_unprepared_stage(self, pipeline):
+        p = pipeline()
+        p.stages[2].add_runnable_hook(lambda s: s.setMem(2.0))
+        p.prepared[2] = 0
+        blur(p)
+        p.collect_prepared_stages()
+        flag, [info] = p.getCommands("c1", 8, 1)
+        assert info.ix == 1 and info.fused == []
+    def test_failure_gives_back_rest_of_chain(self, pipeline):
+        p = pipeline()
+        blur(p)
+        p.getCommands("c1", 8, 1)
+        p.reportStageResults("c1", [(1, 1, None)], not_run=[2, 3])
+        assert p.currently_running_stages == set()
+        assert p.stages[2].status is None and 2 not in p.runnable
+        # (the registration is retried, again with the rest of the chain)
+        flag, [info, _qc] = p.getCommands("c1", 8, 2)
+        assert (info.ix, [f.ix for f in info.fused]) == (1, [2, 3])
+    def test_lost_chain(self, pipeline):
+        p = pipeline()
+        blur(p)
+        p.getCommands("c1", 8, 1)
+        p.unregisterClient("c1")
+        assert sorted(p.runnable) == [1, 4]
+        assert p.stages[2].status is None and p.stages[3].status is None
+
+
+class TestRunStages():
+    def test_stops_at_failure(self, tmpdir):
+        stages = [StageInfo(mem=1, procs=1, ix=ix, cmd=[cmd], log_file=str(tmpdir.join("log%d" % ix)))
+                  for ix, cmd in enumerate(["true", "false", "true"])]
+        results = runStages(clientURI="c1", stages=stages, cmd_wrapper="")
+        assert [(ix, ret) for ix, ret, _usage in results] == [(0, 0), (1, 1)]
@@ -0,0 +1,48 @@
+import random
+
+import networkx as nx
+import pytest
+
+from pydpiper.execution.graph import StageGraph
+
+
+def random_dag(n=200, seed=1):
+    rng = random.Random(seed)
+    return [sorted(rng.sample(range(i), min(i, rng.randint(0, 3)))) for i in range(n)]
+
+
+@pytest.fixture()
+def graphs():
+    preds = random_dag()
+    G = nx.DiGraph()
+    G.add_nodes_from(range(len(preds)))
+    G.add_edges_from((p, i) for i, ps in enumerate(preds) for p in ps)
+    return StageGraph(preds), G
+
+
+class TestStageGraph():
+    def test_neighbours_match_networkx(self, graphs):
+        S, G = graphs
+        assert S.order() == G.order() and S.number_of_edges() == G.number_of_edges()
+        for n in G.nodes():
+            assert sorted(S.successors(n)) == sorted(G.successors(n))
+            assert sorted(S.predecessors(n)) == sorted(G.predecessors(n))
+    def test_topological_sort(self, graphs):
+        S, _ = graphs
+        position = {n: k for k, n in enumerate(S.topological_sort())}
+        assert len(position) == S.order()
+        assert all(position[p] < position[n] for n in S.nodes_iter() for p in S.predecessors(n))
+    def test_cycle(self):
+        with pytest.raises(ValueError):
+            StageGraph([[1], [0]]).topological_sort()
+    def test_dfs_successors_reaches_descendants(self, graphs):
+        S, G = graphs
+        for n in [0, 5, 50]:
+            tree = S.dfs_successors(n)
+            reached = {c for children in tree.values() for c in children}
+            assert reached == nx.descendants(G, n)
+    def test_to_networkx(self, graphs):
+        S, G = graphs
+        H = S.to_networkx(lambda n: dict(label=str(n)))
+        assert sorted(H.edges()) == sorted(G.edges())
+        assert H.node[3]["label"] == "3"
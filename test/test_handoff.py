@@ -0,0 +1,61 @@
+import pytest
+
+from pydpiper.execution.handoff import read_running_stages, write_running_stages
+from pydpiper.execution.pipeline import Pipeline, CmdStage, InputFile, OutputFile
+
+
+@pytest.fixture()
+def mk_pipeline(options):
+    return lambda: Pipeline([CmdStage(["mincblur", InputFile("a.mnc"), OutputFile("b.mnc")]),
+                             CmdStage(["mincblur", InputFile("c.mnc"), OutputFile("d.mnc")]),
+                             CmdStage(["mincaverage", InputFile("b.mnc"), InputFile("d.mnc"), OutputFile("e.mnc")])],
+                            options(local=True, handoff=True))
+
+
+@pytest.fixture()
+def handed_off(tmpdir, monkeypatch, mk_pipeline):
+    """A pipeline which has handed off its two running stages (both on executor 'c1')."""
+    monkeypatch.chdir(tmpdir)  # (the pipeline's logs are written to the current directory)
+    old = mk_pipeline()
+    old.enqueue_runnable_stages()
+    old.wait_for_hooks()
+    old.registerClient("c1", 8)
+    for i in [0, 1]:
+        old.setStageStarted(i, "c1")
+    old.hand_off_running_stages()
+    return old
+
+
+class TestRunningStagesFile():
+    def test_round_trip(self, tmpdir):
+        path = str(tmpdir.join("p_running_stages"))
+        assert read_running_stages(path) == {}
+        write_running_stages(path, {3: "aa", 10: "bb"})
+        assert read_running_stages(path) == {3: "aa", 10: "bb"}
+
+
+class TestHandoff():
+    def test_results_refused_after_handoff(self, handed_off, mk_pipeline):
+        with pytest.raises(Exception):
+            handed_off.reportStageResults("c1", [(0, 0, None)])
+    def test_adopt(self, handed_off, mk_pipeline):
+        new = mk_pipeline()
+        new.reserve_handed_off_stages()
+        new.enqueue_runnable_stages()
+        assert sorted(new.reserved) == [0, 1] and len(new.runnable) == 0
+        new.registerClient("c1", 8)
+        assert new.adoptStages("c1", [(0, new.stages[0].cmd), (1, new.stages[1].cmd)]) == [0, 1]
+        assert not new.reserved
+        new.reportStageResults("c1", [(0, 0, None), (1, 0, None)])
+        new.wait_for_hooks()
+        assert list(new.runnable) == [2]
+    def test_refuse_changed_stage(self, handed_off, mk_pipeline):
+        new = mk_pipeline()
+        new.reserve_handed_off_stages()
+        new.registerClient("c1", 8)
+        assert new.adoptStages("c1", [(0, ["mincblur", "x.mnc", "b.mnc"])]) == []
+        # unclaimed stages are eventually re-run
+        new.reserved_until = 0
+        new.release_reserved_stages()
+        new.wait_for_hooks()
+        assert sorted(new.runnable) == [0, 1]
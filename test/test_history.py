@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+from pydpiper.execution.history import StageHistory, FLUSH_RECORDS, MEMORY_MARGIN
+
+
+@pytest.fixture()
+def history(tmpdir):
+    h = StageHistory(str(tmpdir.join("history.sqlite")))
+    for voxels, mem in [(1000, 1.5), (2000, 2.5), (3000, 3.5)]:
+        h.record("mincblur", voxels, wall_time=voxels / 100, cpu_time=voxels / 100, peak_mem=mem)
+    return h
+
+
+class TestStageHistory():
+    def test_too_little_history(self, history):
+        assert history.estimate_memory("mincANTS", 1000) is None
+        history.record("mincANTS", 1000, wall_time=10, cpu_time=10, peak_mem=4.0)
+        assert history.estimate_runtime("mincANTS") is None
+    def test_fitted_memory(self, history):
+        assert history.estimate_memory("mincblur", 4000) == pytest.approx(4.5 * MEMORY_MARGIN)
+    def test_fitted_runtime(self, history):
+        assert history.estimate_runtime("mincblur", 10000) == pytest.approx(100)
+    def test_estimate_covers_outliers(self, history):
+        history.record("mincblur", 2000, wall_time=20, cpu_time=20, peak_mem=5.0)
+        assert history.estimate_memory("mincblur", 2000) >= 5.0
+    def test_unknown_voxels(self, history):
+        assert history.estimate_memory("mincblur") == pytest.approx(3.5 * MEMORY_MARGIN)
+        assert history.estimate_runtime("mincblur") == pytest.approx(20)
+    def test_persisted(self, history):
+        history.flush()
+        reloaded = StageHistory(history.path)
+        assert reloaded.estimate_memory("mincblur", 4000) == pytest.approx(4.5 * MEMORY_MARGIN)
+    def test_recording_only_buffers(self, history):
+        for _ in range(FLUSH_RECORDS):
+            history.record("mincANTS", 1000, wall_time=10, cpu_time=10, peak_mem=4.0)
+        assert not os.path.exists(history.path)
+        history.flush_if_due()
+        assert StageHistory(history.path).estimate_memory("mincANTS") == pytest.approx(4.0 * MEMORY_MARGIN)
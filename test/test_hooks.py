@@ -0,0 +1,45 @@
+import threading
+
+from pydpiper.execution.hooks import HookRunner
+
+
+def wait_for(runner, n):
+    done = []
+    while len(done) < n:
+        done.extend(runner.completed(block=True))
+    return done
+
+
+class TestHookRunner():
+    def test_outcomes(self):
+        def run(i, speculative):
+            if i == 2:
+                raise ValueError("no such file")
+            return i != 1
+        runner = HookRunner(run, threads=2)
+        for i in range(3):
+            runner.submit(i)
+        assert sorted(wait_for(runner, 3)) == [(0, False, True), (1, False, False), (2, False, False)]
+    def test_speculative_requests_wait(self):
+        started, release, order = threading.Event(), threading.Event(), []
+        def run(i, speculative):
+            if i == 0:
+                started.set()
+                release.wait()
+            order.append(i)
+            return True
+        runner = HookRunner(run, threads=1)
+        runner.submit(0)
+        started.wait()
+        runner.submit(1, speculative=True)
+        runner.submit(2)
+        release.set()
+        wait_for(runner, 3)
+        assert order == [0, 2, 1]
+    def test_on_ready(self):
+        ready = []
+        runner = HookRunner(lambda i, speculative: True, on_ready=lambda: ready.append(1), threads=1)
+        runner.submit(1)
+        runner.submit(0, speculative=True)  # (served last, so `on_ready` has run by the time it's done)
+        wait_for(runner, 2)
+        assert len(ready) == 1
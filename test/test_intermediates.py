@@ -0,0 +1,81 @@
+import os
+import time
+
+import pytest
+
+from pydpiper.core.conversion import convertCmdStage
+from pydpiper.core.files import FileAtom
+from pydpiper.core.stages import CmdStage as Stage
+from pydpiper.execution.intermediates import find_intermediates
+from pydpiper.execution.journal import format_record
+from pydpiper.execution.pipeline import Pipeline, CmdStage, InputFile, OutputFile
+
+
+def wait_until_deleted(path, timeout=5):
+    deadline = time.time() + timeout
+    while os.path.exists(path) and time.time() < deadline:
+        time.sleep(0.01)
+    return not os.path.exists(path)
+
+
+@pytest.fixture()
+def chain(tmpdir, monkeypatch, options):
+    """A pipeline blurring a.mnc into tmp/b.mnc, registering that to get c.xfm, and resampling with c.xfm."""
+    monkeypatch.chdir(tmpdir)  # (the pipeline's logs are written to the current directory)
+    os.mkdir("tmp")
+    for f in ["a.mnc", "tmp/b.mnc", "c.xfm"]:
+        open(f, 'w').close()
+    return lambda: Pipeline([CmdStage(["mincblur", InputFile("a.mnc"), OutputFile("tmp/b.mnc")]),
+                             CmdStage(["minctracc", InputFile("tmp/b.mnc"), OutputFile("c.xfm")]),
+                             CmdStage(["mincresample", InputFile("tmp/b.mnc"), InputFile("c.xfm"),
+                                       OutputFile("d.mnc")])],
+                            options(local=True, gc_intermediates=True))
+
+
+def run(p, i):
+    p.setStageStarted(i, "c1")
+    p.setStageFinished(i, "c1")
+
+
+class TestFindIntermediates():
+    def test_tmp_and_marked(self):
+        s1 = CmdStage(["blur", InputFile("in.mnc"), OutputFile("tmp/blur.mnc"), OutputFile("tmp/unread.mnc")])
+        s2 = CmdStage(["reg", InputFile("tmp/blur.mnc"), OutputFile("marked.xfm"), OutputFile("kept.xfm")])
+        s2.temporary_outputs = ("marked.xfm",)
+        s3 = CmdStage(["resample", InputFile("marked.xfm"), InputFile("kept.xfm"), OutputFile("out.mnc")])
+        assert find_intermediates([s1, s2, s3]) == {"tmp/blur.mnc", "marked.xfm"}
+    def test_marked_on_file_atom(self):
+        f = FileAtom("/scratch/img.mnc")._replace(temporary=True)
+        s = convertCmdStage(Stage(inputs=(), outputs=(f,), cmd=["touch", f.path]))
+        assert s.temporary_outputs == ("/scratch/img.mnc",)
+        assert not f.newname_with_suffix("_blur").temporary
+
+
+class TestCollection():
+    def test_deleted_once_read(self, chain):
+        p = chain()
+        p.intermediates.count_consumers(p.stages)
+        p.registerClient("c1", 8)
+        run(p, 0)
+        run(p, 1)
+        assert os.path.exists("tmp/b.mnc")
+        run(p, 2)
+        assert wait_until_deleted("tmp/b.mnc")
+        assert os.path.exists("c.xfm")
+    def test_restart_keeps_deleted_file_deleted(self, chain):
+        p = chain()
+        with open(p.backupFileLocation, 'w') as f:
+            f.writelines(format_record(i, p.stages[i].getHash()) for i in [0, 1, 2])
+        os.remove("tmp/b.mnc")
+        p.skip_completed_stages()
+        assert p.allStagesCompleted()
+    def test_restart_recreates_needed_file(self, chain):
+        p = chain()
+        with open(p.backupFileLocation, 'w') as f:
+            f.writelines(format_record(i, p.stages[i].getHash()) for i in [0, 1])
+        os.remove("tmp/b.mnc")
+        p.skip_completed_stages()
+        assert [s.isFinished() for s in p.stages] == [False, True, False]
+        p.enqueue_runnable_stages()
+        p.wait_for_hooks()
+        assert list(p.runnable) == [0]
@@ -0,0 +1,38 @@
+import pytest
+
+from pydpiper.execution.journal import FinishedStagesJournal
+
+
+@pytest.fixture()
+def journal(tmpdir):
+    return FinishedStagesJournal(str(tmpdir.join("p_finished_stages")), flush_records=3, flush_interval=3600)
+
+
+class TestFinishedStagesJournal():
+    def test_group_commit(self, journal):
+        journal.append(0, "aa")
+        journal.append(1, "bb", "stat:cc")
+        assert journal.records() == []
+        journal.append(2, "dd")
+        assert journal.records() == [(0, "aa", None), (1, "bb", "stat:cc"), (2, "dd", None)]
+    def test_flush(self, journal):
+        journal.append(0, "aa")
+        journal.flush()
+        assert journal.records() == [(0, "aa", None)]
+    def test_flush_if_due(self, journal):
+        journal.flush_interval = 0
+        journal.append(0, "aa")
+        assert journal.records() == [(0, "aa", None)]
+    def test_torn_line_skipped(self, journal):
+        with open(journal.path, 'w') as fh:
+            fh.write("0,aa\n1,bb\n2")
+        assert journal.records() == [(0, "aa", None), (1, "bb", None)]
+    def test_compact_then_append(self, journal):
+        for i in range(3):
+            journal.append(i, "h%d" % i)
+        journal.compact([(1, "h1", None)])
+        journal.append(5, "h5")
+        journal.close()
+        assert journal.records() == [(1, "h1", None), (5, "h5", None)]
+    def test_missing(self, journal):
+        assert journal.records() == []
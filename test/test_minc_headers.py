@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+import pydpiper.minc.headers
+from pydpiper.minc.headers import MincHeader, MincHeaderCache
+from pydpiper.minc.registration import (check_MINC_input_files,
+                                        check_MINC_files_have_equal_dimensions_and_resolution,
+                                        get_resolution_from_file)
+
+reads = []
+
+
+def fake_reader(path):
+    """Stands in for reading a MINC header: the 'files' just contain their dimensions."""
+    reads.append(path)
+    with open(path) as f:
+        dims = tuple(int(d) for d in f.read().split())
+    return MincHeader(dims=dims, starts=(0.0,) * len(dims), separations=(0.1,) * len(dims))
+
+
+@pytest.fixture()
+def imgs(tmpdir):
+    del reads[:]
+    paths = [str(tmpdir.join("img_%d.mnc" % i)) for i in range(3)]
+    for p in paths:
+        with open(p, 'w') as f:
+            f.write("10 20 30")
+    return paths
+
+
+class TestMincHeaderCache():
+    def test_read_once(self, imgs):
+        cache = MincHeaderCache(reader=fake_reader)
+        assert cache.get(imgs[0]).voxels == 6000
+        assert cache.get(imgs[0]).voxels == 6000
+        assert reads == [imgs[0]]
+    def test_reread_when_changed(self, imgs):
+        cache = MincHeaderCache(reader=fake_reader)
+        cache.get(imgs[0])
+        with open(imgs[0], 'w') as f:
+            f.write("10 20 30 2")
+        st = os.stat(imgs[0])
+        os.utime(imgs[0], ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        assert cache.get(imgs[0]).voxels == 12000
+    def test_prefetch(self, imgs, tmpdir):
+        with open(imgs[2], 'w') as f:
+            f.write("not a MINC file")
+        cache = MincHeaderCache(reader=fake_reader)
+        errors = cache.prefetch(imgs + [str(tmpdir.join("missing.mnc"))], workers=2)
+        assert sorted(errors) == [imgs[2], str(tmpdir.join("missing.mnc"))]
+        assert len(cache) == 2
+    def test_persist(self, imgs, tmpdir):
+        saved = str(tmpdir.join("headers.jsonl"))
+        cache = MincHeaderCache(reader=fake_reader)
+        cache.persist(saved)
+        cache.get(imgs[0])
+        cache.close()
+        warm = MincHeaderCache(reader=fake_reader)
+        warm.persist(saved)
+        assert warm.get(imgs[0]) == cache.get(imgs[0])
+        assert reads == [imgs[0]]
+
+
+@pytest.fixture()
+def fake_cache(monkeypatch):
+    monkeypatch.setattr(pydpiper.minc.headers, "header_cache", MincHeaderCache(reader=fake_reader))
+
+
+class TestInputChecks():
+    def test_reports_all_unreadable(self, imgs, fake_cache, capsys):
+        for p in imgs[1:]:
+            with open(p, 'w') as f:
+                f.write("garbage")
+        with pytest.raises(ValueError):
+            check_MINC_input_files(imgs)
+        err = capsys.readouterr().err
+        assert imgs[1] in err and imgs[2] in err and imgs[0] not in err
+    def test_later_checks_use_cache(self, imgs, fake_cache):
+        check_MINC_input_files(imgs)
+        # (the headers may have been read in other processes, so `reads` can't tell us)
+        pydpiper.minc.headers.header_cache.reader = None
+        check_MINC_files_have_equal_dimensions_and_resolution(imgs)
+        assert get_resolution_from_file(imgs[0]) == pytest.approx(0.1)
+    def test_different_dimensions(self, imgs, fake_cache):
+        with open(imgs[1], 'w') as f:
+            f.write("10 20 31")
+        with pytest.raises(ValueError):
+            check_MINC_files_have_equal_dimensions_and_resolution(imgs)
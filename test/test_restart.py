@@ -0,0 +1,74 @@
+import os
+import threading
+
+import pytest
+
+from pydpiper.execution.restart import (CONTENT_SAMPLE_BYTES, file_signature, file_signatures,
+                                        stage_fingerprint)
+from pydpiper.execution.journal import FinishedStagesJournal
+from pydpiper.execution.pipeline import Pipeline, CmdStage, InputFile, OutputFile
+
+
+@pytest.fixture()
+def files(tmpdir):
+    paths = [str(tmpdir.join("in.mnc")), str(tmpdir.join("out.mnc"))]
+    for p in paths:
+        with open(p, 'wb') as f:
+            f.write(b"\0" * (3 * CONTENT_SAMPLE_BYTES))
+    return paths
+
+
+def fingerprint(files, check):
+    return stage_fingerprint(files, check, file_signatures(files, check).get)
+
+
+class TestFileSignature():
+    def test_missing(self, tmpdir):
+        assert file_signature(str(tmpdir.join("nope.mnc")), "stat") == "missing"
+    def test_stat_sees_touch(self, files):
+        before = file_signature(files[0], "stat")
+        st = os.stat(files[0])
+        os.utime(files[0], ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        assert file_signature(files[0], "stat") != before
+    def test_content_ignores_touch(self, files):
+        before = file_signature(files[0], "content")
+        st = os.stat(files[0])
+        os.utime(files[0], ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        assert file_signature(files[0], "content") == before
+    def test_content_sees_new_header(self, files):
+        before = file_signature(files[0], "content")
+        with open(files[0], 'r+b') as f:
+            f.write(b"CDF")
+        assert file_signature(files[0], "content") != before
+
+
+class TestStageFingerprint():
+    def test_records_check(self, files):
+        assert fingerprint(files, "content").startswith("content:")
+        assert "," not in fingerprint(files, "stat")
+    def test_deleted_output(self, files):
+        before = fingerprint(files, "stat")
+        os.remove(files[1])
+        assert fingerprint(files, "stat") != before
+    def test_unchanged(self, files):
+        assert fingerprint(files, "content") == fingerprint(files, "content")
+
+
+class TestPipelineFingerprints():
+    def test_computed_off_the_reporting_thread(self, tmpdir, monkeypatch, options):
+        monkeypatch.chdir(tmpdir)
+        p = Pipeline([CmdStage(["mincblur", InputFile("in.mnc"), OutputFile("out.mnc")])],
+                     options(default_job_mem=1.0, mem=8, local=True, restart_check="stat"))
+        p.shutdown_ev = threading.Event()
+        p.enqueue_runnable_stages()
+        p.wait_for_hooks()
+        p.registerClient("c1", 8)
+        p.getCommands("c1", 8, 1)
+        threads = []
+        compute = p.stage_fingerprint
+        monkeypatch.setattr(p, "stage_fingerprint", lambda i: threads.append(threading.current_thread()) or compute(i))
+        p.reportStageResults("c1", [(0, 0, None)])
+        p.flush_journal()
+        [(ix, _h, fingerprint)] = FinishedStagesJournal(p.backupFileLocation).records()
+        assert ix == 0 and fingerprint.startswith("stat:")
+        assert threads and threading.current_thread() not in threads
@@ -0,0 +1,88 @@
+import signal
+import threading
+
+import pytest
+
+from pydpiper.execution import retries
+from pydpiper.execution.pipeline import Pipeline, CmdStage, InputFile, OutputFile
+from pydpiper.execution.retries import Retries, RetryPolicy, parse_retry_policy
+
+
+@pytest.fixture()
+def clock(monkeypatch):
+    """The time as seen by the retry heap, which the test can move forward."""
+    now = [1000.0]
+    monkeypatch.setattr(retries.time, "time", lambda: now[0])
+    return now
+
+
+def start(tmpdir, monkeypatch, options, **kwargs):
+    """A pipeline blurring an image and then resampling with the result, with the blur handed to executor c1."""
+    monkeypatch.chdir(tmpdir)
+    stages = [CmdStage(["mincblur", InputFile("in.mnc"), OutputFile("blur.mnc")]),
+              CmdStage(["mincresample", InputFile("blur.mnc"), OutputFile("out.mnc")])]
+    p = Pipeline(stages, options(default_job_mem=1.0, mem=8, ppn=1, num_exec=0, monitor_heartbeats=False, time=None,
+                                 **kwargs))
+    p.shutdown_ev = threading.Event()
+    p.memAvail = 8
+    p.enqueue_runnable_stages()
+    p.wait_for_hooks()
+    p.registerClient("c1", 8)
+    flag, [info] = p.getCommands("c1", 8, 1)
+    assert info.ix == 0
+    return p
+
+
+class TestRetries():
+    def test_backoff(self):
+        r = Retries(RetryPolicy(max_retries=3, delay=10, backoff=2, max_delay=30, mem_factor=1.5))
+        assert [r.decide("mincblur", retries.ERROR, k) for k in range(4)] == [10, 20, 30, None]
+        assert r.decide("mincblur", retries.UNRUNNABLE, 0) is None
+        assert r.failures == { retries.ERROR : 4, retries.UNRUNNABLE : 1 }
+    def test_per_tool_policy(self):
+        r = Retries(RetryPolicy(max_retries=2, delay=10, backoff=2, max_delay=600, mem_factor=1.5),
+                    [parse_retry_policy("mincANTS:max_retries=0,mem_factor=3")])
+        assert r.decide("mincANTS", retries.MEMORY, 0) is None
+        assert r.escalated_mem("mincANTS", 2, max_mem=8) == 6
+        assert r.escalated_mem("mincANTS", 4, max_mem=8) == 8
+        assert r.decide("mincblur", retries.MEMORY, 0) == 10
+    def test_bad_policy(self):
+        with pytest.raises(ValueError):
+            parse_retry_policy("mincANTS:retries=4")
+    def test_due_in_order(self):
+        r = Retries(RetryPolicy(max_retries=2, delay=10, backoff=2, max_delay=600, mem_factor=1.5))
+        r.schedule(3, 20, now=0)
+        r.schedule(5, 10, now=0)
+        assert r.due(now=5) == [] and len(r) == 2
+        assert r.due(now=25) == [5, 3] and len(r) == 0
+
+
+class TestPipelineRetries():
+    def test_delayed_retry(self, tmpdir, monkeypatch, options, clock):
+        p = start(tmpdir, monkeypatch, options)
+        p.reportStageResults("c1", [(0, 1, None)])
+        assert p.getCommands("c1", 8, 1) == ("wait", None)
+        # (the server keeps going while the stage waits)
+        assert p.continueLoop()
+        clock[0] += 10
+        flag, [info] = p.getCommands("c1", 8, 1)
+        assert info.ix == 0 and info.mem == 1.0
+    def test_memory_escalated(self, tmpdir, monkeypatch, options, clock):
+        p = start(tmpdir, monkeypatch, options)
+        p.reportStageResults("c1", [(0, -signal.SIGKILL, None)])
+        clock[0] += 10
+        flag, [info] = p.getCommands("c1", 8, 1)
+        assert info.mem == 1.5
+        p.reportStageResults("c1", [(0, 1, dict(wall_time=5, cpu_time=5, peak_mem=1.48))])
+        clock[0] += 20
+        flag, [info] = p.getCommands("c1", 8, 1)
+        assert info.mem == 2.25
+    def test_retries_exhausted(self, tmpdir, monkeypatch, options, clock):
+        p = start(tmpdir, monkeypatch, options, max_retries=0)
+        p.reportStageResults("c1", [(0, 1, None)])
+        assert p.stages[0].status == "failed"
+    def test_unrunnable_not_retried(self, tmpdir, monkeypatch, options, clock):
+        p = start(tmpdir, monkeypatch, options)
+        p.reportStageResults("c1", [(0, 127, None)])
+        assert p.stages[0].status == "failed" and len(p.retries) == 0
+        assert p.retries.report() == "Stage failures by class: unrunnable: 1"
@@ -0,0 +1,153 @@
+import threading
+
+import pytest
+
+from pydpiper.execution import pipeline
+from pydpiper.execution.pipeline import Pipeline, CmdStage, InputFile, OutputFile
+from pydpiper.execution.scheduling import MEM_BUCKET_BITS, RunnableIndex, critical_path_priorities, executor_fleet, size_classes
+
+
+@pytest.fixture()
+def runnable():
+    r = RunnableIndex()
+    for i, (mem, procs) in enumerate([(1.0, 1), (2.0, 1), (40.0, 1), (8.0, 4), (2.0, 1)]):
+        r.add(i, mem=mem, procs=procs)
+    return r
+
+
+class TestRunnableIndex():
+    def test_largest_fitting_stage(self, runnable):
+        assert runnable.pop_fitting(mem_free=10, procs_free=1) in (1, 4)
+        assert runnable.pop_fitting(mem_free=10, procs_free=4) == 3
+    def test_nothing_fits(self, runnable):
+        assert runnable.pop_fitting(mem_free=0.5, procs_free=8) is None
+        assert len(runnable) == 5
+    def test_procs_respected(self, runnable):
+        assert runnable.pop_fitting(mem_free=100, procs_free=1) == 2
+        assert 3 not in [runnable.pop_fitting(mem_free=100, procs_free=1) for _ in range(3)]
+    def test_add_is_idempotent(self, runnable):
+        runnable.add(0, mem=1.0, procs=1)
+        assert len(runnable) == 5
+    def test_discard(self, runnable):
+        runnable.discard(2)
+        assert runnable.max_mem() == 8.0
+        assert sorted(runnable.memory_requirements()) == [1.0, 2.0, 2.0, 8.0]
+    def test_rediscard_and_readd(self, runnable):
+        runnable.discard(1)
+        runnable.add(1, mem=2.0, procs=1)
+        assert sorted(runnable.pop_fitting(mem_free=2, procs_free=1) for _ in range(2)) == [1, 4]
+    def test_pop_drains(self, runnable):
+        assert sorted(runnable.pop() for _ in range(5)) == [0, 1, 2, 3, 4]
+        with pytest.raises(KeyError):
+            runnable.pop()
+        assert runnable.max_mem() is None
+    def test_priority_beats_size(self, runnable):
+        runnable.add(5, mem=0.5, procs=1, priority=10)
+        assert runnable.pop_fitting(mem_free=100, procs_free=8) == 5
+    def test_readd_with_new_priority(self, runnable):
+        runnable.discard(0)
+        runnable.add(0, mem=1.0, procs=1, priority=10)
+        assert runnable.pop_fitting(mem_free=100, procs_free=8) == 0
+        assert 0 not in runnable
+    def test_distinct_mems_share_buckets(self):
+        r = RunnableIndex()
+        for i in range(1000):
+            r.add(i, mem=1.0 + i / 1000, procs=1)
+        assert len(r._buckets) <= 2 ** MEM_BUCKET_BITS
+        assert r.max_mem() == 1.999
+        # (a bucket straddling the free memory only gives out the stages which fit)
+        assert sorted(r.pop_fitting(mem_free=1.05, procs_free=1) for _ in range(51)) == list(range(51))
+        assert r.pop_fitting(mem_free=1.05, procs_free=1) is None
+        assert r.pop_fitting(mem_free=2, procs_free=1, min_mem=1.9975) == 998
+        assert r.pop_fitting(mem_free=2, procs_free=1, min_mem=1.999) is None
+    def test_preferred_executor_first(self, runnable):
+        runnable.add(5, mem=1.0, procs=1, preferred="e1")
+        assert len(runnable) == 6 and 5 in runnable
+        assert runnable.pop_fitting(mem_free=100, procs_free=8, client="e1") == 5
+        assert 5 not in runnable
+    def test_preferred_elsewhere_last(self, runnable):
+        runnable.add(5, mem=1.0, procs=1, priority=10, preferred="e1")
+        assert runnable.max_mem() == 40.0
+        assert 5 not in [runnable.pop_fitting(mem_free=100, procs_free=8, client="e2") for _ in range(5)]
+        assert runnable.pop_fitting(mem_free=100, procs_free=8, client="e2") == 5
+        assert len(runnable) == 0
+    def test_min_mem(self, runnable):
+        assert runnable.pop_fitting(mem_free=10, procs_free=8, min_mem=2.0) == 3
+        assert runnable.pop_fitting(mem_free=10, procs_free=8, min_mem=2.0) is None
+    def test_max_runtime(self, runnable):
+        runnable.add(5, mem=2.0, procs=1, priority=10, runtime=3 * 3600)
+        runnable.add(6, mem=2.0, procs=1, priority=5, runtime=600, preferred="e1")
+        assert runnable.pop_fitting(mem_free=10, procs_free=1, max_runtime=1200) in (1, 4)
+        assert runnable.pop_fitting(mem_free=10, procs_free=1, max_runtime=1200, client="e1") == 6
+        assert runnable.pop_fitting(mem_free=10, procs_free=1) == 5
+    def test_discard_preferred(self, runnable):
+        runnable.add(5, mem=1.0, procs=1, preferred="e1")
+        runnable.discard(5)
+        assert len(runnable) == 5 and 5 not in runnable
+
+
+class TestCriticalPath():
+    def test_chain_outranks_leaves(self):
+        # 0 -> 1 -> 2 -> 3 (the model-building chain) and 0 -> 4 (a QC leaf)
+        succs = {0: [1, 4], 1: [2], 2: [3], 3: [], 4: []}
+        p = critical_path_priorities(range(5), lambda n: succs[n], lambda n: 1)
+        assert p == [4, 3, 2, 1, 1]
+    def test_weighted_by_runtime(self):
+        succs = {0: [2], 1: [2], 2: []}
+        p = critical_path_priorities([1, 0, 2], lambda n: succs[n], lambda n: [100, 1, 5][n])
+        assert p == [105, 6, 5]
+
+
+class TestSizeClasses():
+    def test_one_class_is_sized_for_largest_stages(self):
+        assert executor_fleet([1.0, 2.0, 2.0, 8.0], number=2, procs=2, max_mem=64, max_classes=1) == [(8.0, 10.0, 2)]
+    def test_few_large_stages_get_own_class(self):
+        assert size_classes([2.0] * 500 + [40.0] * 3 + [12.0] * 100, max_classes=3) == [2.0, 12.0, 40.0]
+        assert size_classes([2.0] * 500 + [40.0] * 3 + [12.0] * 100, max_classes=2) == [2.0, 40.0]
+    def test_similar_stages_share_class(self):
+        assert size_classes([2.0, 2.1, 2.2, 1.9], max_classes=3) == [2.25]
+    def test_no_more_executors_than_stages(self):
+        assert executor_fleet([40.0, 2.0, 2.0], number=10, procs=1, max_mem=64, max_classes=2) == [(40.0, 40.0, 1),
+                                                                                                 (2.0, 2.0, 2)]
+    def test_classes_with_same_executors_merged(self):
+        assert executor_fleet([36.0, 40.0], number=4, procs=1, max_mem=32, max_classes=2) == [(40.0, 32, 2)]
+    def test_greedy(self):
+        assert executor_fleet([2.0] * 10 + [40.0], number=2, procs=1, max_mem=64, max_classes=2, greedy=True) == [(40.0, 64, 2)]
+
+
+class TestExecutorSizeClasses():
+    @pytest.fixture()
+    def p(self, tmpdir, monkeypatch, options):
+        """Many small resamplings and a large registration, with executors launched by the server."""
+        monkeypatch.chdir(tmpdir)
+        launched = []
+        monkeypatch.setattr(pipeline, "launchPipelineExecutors",
+                            lambda options, mem_needed, number, uri_file: launched.append((mem_needed, number)))
+        stages = [CmdStage(["mincresample", InputFile("in%d.mnc" % k), OutputFile("out%d.mnc" % k)]) for k in range(6)]
+        stages.append(CmdStage(["antsRegistration", InputFile("a.mnc"), OutputFile("a.xfm")]))
+        stages[-1].setMem(40.0)
+        p = Pipeline(stages, options(default_job_mem=1.0, mem=64, proc=2, num_exec=3, monitor_heartbeats=False,
+                                     executor_size_classes=2, local=True))
+        p.shutdown_ev = threading.Event()
+        p.memAvail = 64
+        p.enqueue_runnable_stages()
+        p.wait_for_hooks()
+        p.launched = launched
+        return p
+    def test_mixed_fleet(self, p):
+        p.manageExecutors()
+        assert p.launched == [(40.0, 1), (2.0, 2)]
+        assert p.number_launched_and_waiting_clients == 3
+    def test_large_executor_takes_large_stage(self, p):
+        p.manageExecutors()
+        p.registerClient("large", 40.0)
+        p.registerClient("small", 2.0)
+        # (it would fit two resamplings alongside the registration, but those can run elsewhere)
+        flag, [info] = p.getCommands("large", 40.0, 1)
+        assert info.ix == 6
+    def test_large_executor_takes_small_stages_when_idle(self, p):
+        p.manageExecutors()
+        p.registerClient("large", 40.0)
+        p.runnable.discard(6)
+        flag, stages = p.getCommands("large", 40.0, 2)
+        assert len(stages) == 2
@@ -0,0 +1,98 @@
+import os
+import threading
+
+import pytest
+
+from pydpiper.execution.pipeline import Pipeline, CmdStage, InputFile, OutputFile
+from pydpiper.execution.scratch import LocalScratch
+
+
+@pytest.fixture()
+def pipeline(tmpdir, monkeypatch, options):
+    """A pipeline blurring a.mnc into tmp/b.mnc, which two further stages read, running on executors 'c1' and 'c2'."""
+    monkeypatch.chdir(tmpdir)  # (the pipeline's logs are written to the current directory)
+    p = Pipeline([CmdStage(["mincblur", InputFile("a.mnc"), OutputFile("tmp/b.mnc")]),
+                  CmdStage(["minctracc", InputFile("tmp/b.mnc"), OutputFile("c.xfm")]),
+                  CmdStage(["mincresample", InputFile("tmp/b.mnc"), OutputFile("d.mnc")])],
+                 options(local=True, local_scratch=str(tmpdir)))
+    p.shutdown_ev = threading.Event()
+    p.scratch.count_consumers(p.stages)
+    p.enqueue_runnable_stages()
+    p.wait_for_hooks()
+    for c in ["c1", "c2"]:
+        p.registerClient(c, 8)
+    return p
+
+
+def run_blur(p):
+    """Run the first stage on 'c1', which keeps its output in scratch space."""
+    flag, [info] = p.getCommands("c1", 8, 1)
+    assert info.scratch == ["tmp/b.mnc"]
+    assert p.reportStageResults("c1", [(0, 0, None)], held=["tmp/b.mnc"]) is None
+
+
+class TestLocalScratch():
+    def test_localize(self, tmpdir):
+        scratch = LocalScratch(str(tmpdir))
+        cmd = scratch.localize(["blur", "/d/tmp/b.mnc", "/d/tmp/b.mnc.gz", "-o=/d/tmp/b.mnc"],
+                               ["/d/tmp/b.mnc", "/d/tmp/b.mnc.gz"])
+        local = scratch.local_path("/d/tmp/b.mnc")
+        assert cmd == ["blur", local, local + ".gz", "-o=" + local]
+        assert os.path.isdir(os.path.dirname(local))
+    def test_copy_out(self, tmpdir):
+        scratch = LocalScratch(str(tmpdir.mkdir("scratch")))
+        shared = str(tmpdir.join("out", "tmp", "b.mnc"))
+        os.makedirs(os.path.dirname(scratch.local_path(shared)))
+        with open(scratch.local_path(shared), 'w') as f:
+            f.write("b")
+        scratch.record_outputs([shared, str(tmpdir.join("elsewhere.mnc"))])
+        assert scratch.held == {shared}
+        scratch.copy_out_all()
+        with open(shared) as f:
+            assert f.read() == "b"
+        assert not os.path.exists(scratch.local_path(shared))
+        assert scratch.take_news() == ([shared], [shared])
+        scratch.remove()
+        assert not os.path.exists(scratch.dir)
+    def test_copy_out_while_in_use(self, tmpdir):
+        scratch = LocalScratch(str(tmpdir.mkdir("scratch")))
+        shared = str(tmpdir.join("b.mnc"))
+        [local] = scratch.localize([shared], [shared])
+        open(local, 'w').close()
+        scratch.record_outputs([shared])
+        scratch.acquire([shared])
+        scratch.copy_out(shared)
+        assert os.path.exists(shared) and os.path.exists(scratch.local_path(shared))
+        scratch.record_outputs([shared])  # (a stage which read it has finished)
+        assert scratch.held == set()
+        scratch.release([shared])
+        assert not os.path.exists(scratch.local_path(shared))
+
+
+class TestScratchScheduling():
+    def test_holder_runs_consumers(self, pipeline):
+        run_blur(pipeline)
+        flag, stages = pipeline.getCommands("c1", 8, 2)
+        assert sorted(s.ix for s in stages) == [1, 2]
+        assert all(s.scratch == ["tmp/b.mnc"] for s in stages)
+    def test_copied_out_for_other_executor(self, pipeline):
+        run_blur(pipeline)
+        assert pipeline.getCommands("c2", 8, 2) == ("wait", None)
+        assert pipeline.awaiting_copy_out == {1: {"tmp/b.mnc"}, 2: {"tmp/b.mnc"}}
+        assert pipeline.reportStageResults("c1", []) == dict(copy_out=["tmp/b.mnc"], delete=[])
+        pipeline.reportStageResults("c1", [], copied_out=["tmp/b.mnc"])
+        flag, stages = pipeline.getCommands("c2", 8, 2)
+        assert sorted(s.ix for s in stages) == [1, 2]
+        assert all(s.scratch == [] for s in stages)
+    def test_deleted_once_read(self, pipeline):
+        run_blur(pipeline)
+        pipeline.getCommands("c1", 8, 2)
+        assert pipeline.reportStageResults("c1", [(1, 0, None)]) is None
+        assert pipeline.reportStageResults("c1", [(2, 0, None)]) == dict(copy_out=[], delete=["tmp/b.mnc"])
+    def test_lost_executor(self, pipeline):
+        run_blur(pipeline)
+        pipeline.unregisterClient("c1")
+        assert not pipeline.stages[0].isFinished()
+        assert list(pipeline.unfinished_pred_counts) == [0, 1, 1]
+        flag, [info] = pipeline.getCommands("c2", 8, 2)
+        assert info.ix == 0
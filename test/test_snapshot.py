@@ -0,0 +1,72 @@
+import os
+from functools import partial
+
+import pytest
+
+from pydpiper.execution.snapshot import definition_key, read_snapshot, write_snapshot
+from pydpiper.execution.pipeline import Pipeline, CmdStage, InputFile, OutputFile
+
+
+def set_memory(mem, stage):
+    stage.setMem(mem)
+
+
+@pytest.fixture()
+def pipeline(tmpdir, monkeypatch, options):
+    monkeypatch.chdir(tmpdir)  # (the pipeline's logs are written to the current directory)
+    a, b, c = (str(tmpdir.join(f)) for f in ["a.mnc", "b.mnc", "c.mnc"])
+    s1 = CmdStage(["mincblur", InputFile(a), OutputFile(b)])
+    s2 = CmdStage(["mincresample", InputFile(b), OutputFile(c)])
+    s2._runnable_hooks.append(partial(set_memory, 5))
+    return Pipeline([s1, s2], options(local=True))
+
+
+class TestSnapshotFile():
+    def test_round_trip(self, tmpdir):
+        path = str(tmpdir.join("snapshot"))
+        write_snapshot(path, "key", dict(x=[1, 2]))
+        assert read_snapshot(path, "key") == dict(x=[1, 2])
+    def test_definition_changed(self, tmpdir):
+        path = str(tmpdir.join("snapshot"))
+        write_snapshot(path, "key", dict(x=1))
+        assert read_snapshot(path, "other key") is None
+    def test_missing_or_damaged(self, tmpdir):
+        path = str(tmpdir.join("snapshot"))
+        assert read_snapshot(path, "key") is None
+        write_snapshot(path, "key", dict(x=1))
+        with open(path, 'r+b') as fh:
+            fh.truncate(os.path.getsize(path) - 2)
+        assert read_snapshot(path, "key") is None
+    def test_key_sees_changed_input(self, tmpdir):
+        img = str(tmpdir.join("img.mnc"))
+        with open(img, 'w') as fh:
+            fh.write("x")
+        before = definition_key(["MBM.py", "--files", img], "1.0")
+        assert definition_key(["MBM.py", "--files", img], "1.0") == before
+        st = os.stat(img)
+        os.utime(img, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        assert definition_key(["MBM.py", "--files", img], "1.0") != before
+        assert definition_key(["MBM.py", "--files", img], "1.1") != before
+
+
+class TestPipelineSnapshot():
+    def test_resume(self, pipeline, tmpdir, options):
+        pipeline.stages[0].incrementNumberOfRetries()
+        pipeline.stages[0].setFinished()
+        pipeline.snapshot_path, pipeline.definition_key = str(tmpdir.join("p_scheduler_snapshot")), "key"
+        pipeline.write_snapshot()
+        resumed = Pipeline.from_snapshot(pipeline.snapshot_path, "key", options(local=True))
+        assert [s.cmd for s in resumed.stages] == [s.cmd for s in pipeline.stages]
+        assert resumed.G.predecessors(1) == [0]
+        assert resumed.stages[0].getNumberOfRetries() == 1
+        # (which stages have finished comes from the finished stages log)
+        assert not resumed.stages[0].isFinished()
+        assert list(resumed.unfinished_pred_counts) == [0, 1]
+        resumed.run_hooks(1)
+        assert resumed.stages[1].mem == 5
+    def test_unpicklable_hook(self, pipeline, tmpdir):
+        pipeline.stages[1]._runnable_hooks.append(lambda s: None)
+        pipeline.snapshot_path, pipeline.definition_key = str(tmpdir.join("p_scheduler_snapshot")), "key"
+        pipeline.write_snapshot()
+        assert pipeline.snapshot_path is None
+        assert not os.path.exists(str(tmpdir.join("p_scheduler_snapshot")))
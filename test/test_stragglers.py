@@ -0,0 +1,177 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from pydpiper.execution.pipeline import Pipeline, CmdStage, InputFile, OutputFile
+from pydpiper.execution.pipeline_executor import StageInfo, pipelineExecutor, runStage
+from pydpiper.execution.stragglers import Backup, Stragglers, backup_path
+
+
+# (the server launches no executors itself)
+BACKUP_STRAGGLERS = dict(default_job_mem=1.0, mem=8, ppn=1, num_exec=0, monitor_heartbeats=False, time=None,
+                         backup_stragglers=True)
+
+
+def blurs(n=5):
+    stages = [CmdStage(["mincblur", InputFile("in%d.mnc" % k), OutputFile("out%d.mnc" % k)]) for k in range(n)]
+    for k, s in enumerate(stages):
+        s.logFile = "blur%d.log" % k
+    return stages
+
+
+@pytest.fixture()
+def straggling(tmpdir, monkeypatch, options):
+    """A pipeline with four of five peers finished in 10 s on executor c1, and the fifth running there
+    for 100 s so far; returns the pipeline and the straggler's index."""
+    monkeypatch.chdir(tmpdir)
+    p = Pipeline(blurs(), options(**BACKUP_STRAGGLERS))
+    p.shutdown_ev = threading.Event()
+    p.enqueue_runnable_stages()
+    p.wait_for_hooks()
+    p.registerClient("c1", 8)
+    started = [p.getCommands("c1", 8, 1)[1][0].ix for _ in range(5)]
+    now = time.time()
+    for i in started:
+        p.start_times[i] = now - 10
+    straggler = started[-1]
+    p.start_times[straggler] = now - 100
+    p.reportStageResults("c1", [(i, 0, None) for i in started[:-1]])
+    return p, straggler
+
+
+def copy_for(p, client):
+    """Have an idle executor ask for work until it gets a copy of the straggler."""
+    # (the copy is handed out once its output directories have been created in the background)
+    assert p.getCommands(client, 8, 1) == ("wait", None)
+    p.collect_backup_work(block=True)
+    return p.getCommands(client, 8, 1)
+
+
+class TestStragglers():
+    def test_threshold_needs_peers(self):
+        s = Stragglers(percentile=50)
+        for t in [10, 30]:
+            s.finished("blur", t)
+        assert s.threshold("blur") is None
+        s.finished("blur", 20)
+        assert s.threshold("blur") == 20
+        assert s.threshold("resample") is None
+    def test_promote(self, tmpdir):
+        out = str(tmpdir.join("out.mnc"))
+        b = Backup(3, [out])
+        assert b.outputs == { out : backup_path(out, 3) }
+        b.create_dirs()
+        with open(b.outputs[out], 'w') as f:
+            f.write("copy")
+        b.promote()
+        assert tmpdir.join("out.mnc").read() == "copy"
+        assert not tmpdir.join(".backup-3").exists()
+    def test_promote_with_undeclared_outputs(self, tmpdir):
+        # (a nonlinear registration declares only its transform, which refers to a grid file beside it)
+        xfm = str(tmpdir.join("nlin.xfm"))
+        b = Backup(3, [xfm])
+        b.create_dirs()
+        with open(b.outputs[xfm], 'w') as f:
+            f.write("Displacement_Volume = nlin_grid_0.mnc;")
+        tmpdir.join(".backup-3", "nlin_grid_0.mnc").write("grid")
+        tmpdir.join("nlin_grid_0.mnc").write("stale grid")
+        b.promote()
+        assert tmpdir.join("nlin.xfm").read() == "Displacement_Volume = nlin_grid_0.mnc;"
+        assert tmpdir.join("nlin_grid_0.mnc").read() == "grid"
+        assert not tmpdir.join(".backup-3").exists()
+
+
+class TestPipelineStragglers():
+    def test_copy_given_to_idle_executor(self, straggling):
+        p, straggler = straggling
+        p.registerClient("c2", 8)
+        flag, [info] = copy_for(p, "c2")
+        assert flag == "run_stages" and info.ix == straggler
+        assert info.cmd == ["mincblur", "in%d.mnc" % straggler,
+                            os.path.join(".backup-%d" % straggler, "out%d.mnc" % straggler)]
+        # (only one copy at a time per executor)
+        assert p.getCommands("c2", 8, 1) == ("wait", None)
+    def test_no_copy_of_stage_within_its_peers(self, straggling):
+        p, straggler = straggling
+        p.start_times[straggler] = time.time() - 5
+        p.registerClient("c2", 8)
+        assert p.getCommands("c2", 8, 1) == ("wait", None)
+    def test_copy_wins(self, straggling):
+        p, straggler = straggling
+        p.registerClient("c2", 8)
+        _flag, [info] = copy_for(p, "c2")
+        with open(info.cmd[-1], 'w') as f:
+            f.write("copy")
+        assert p.reportStageResults("c2", [(straggler, 0, None)]) is None
+        assert p.stages[straggler].status != "finished"
+        # the original is cancelled, and fails as a result
+        assert p.reportStageResults("c1", []) == { "cancel" : [straggler] }
+        p.reportStageResults("c1", [(straggler, -15, None)])
+        # (it's finished once the copy's outputs have been moved into place, in the background)
+        assert p.stages[straggler].status != "finished" and straggler not in p.currently_running_stages
+        p.collect_backup_work(block=True)
+        assert p.stages[straggler].status == "finished"
+        with open("out%d.mnc" % straggler) as f:
+            assert f.read() == "copy"
+        assert p.stragglers.report() == "Ran backup copies of 1 straggling stages, of which 1 finished first"
+    def test_original_wins(self, straggling):
+        p, straggler = straggling
+        p.registerClient("c2", 8)
+        _flag, [info] = copy_for(p, "c2")
+        p.reportStageResults("c1", [(straggler, 0, None)])
+        assert p.stages[straggler].status == "finished"
+        assert p.reportStageResults("c2", []) == { "cancel" : [straggler] }
+        p.reportStageResults("c2", [(straggler, -15, None)])
+        p.collect_backup_work(block=True)
+        assert not os.path.exists(os.path.dirname(info.cmd[-1]))
+        assert p.stragglers.backups == {} and p.stragglers.won == 0
+    def test_original_finishes_before_copy_handed_out(self, straggling):
+        p, straggler = straggling
+        p.registerClient("c2", 8)
+        assert p.getCommands("c2", 8, 1) == ("wait", None)
+        p.reportStageResults("c1", [(straggler, 0, None)])
+        p.collect_backup_work(block=True)
+        assert p.stragglers.backups == {} and p.stragglers.launched == 0
+        assert not os.path.exists(".backup-%d" % straggler)
+    def test_not_with_local_scratch(self, tmpdir, monkeypatch, options):
+        monkeypatch.chdir(tmpdir)
+        p = Pipeline(blurs(), options(local_scratch=str(tmpdir), **BACKUP_STRAGGLERS))
+        assert p.stragglers is None
+
+
+class TestExecutorProcessGroups():
+    def in_own_session(self, tmpdir, pid_dir):
+        log = str(tmpdir.join("log"))
+        stage = StageInfo(mem=1, procs=1, ix=0, log_file=log,
+                          cmd=[sys.executable, "-c", "'import os; print(os.getsid(0) == os.getpid())'"])
+        runStage(clientURI="c1", stage=stage, cmd_wrapper="", pid_dir=pid_dir)
+        with open(log) as f:
+            return f.read().splitlines()[-1] == "True"
+    def test_detached_only_with_backups(self, tmpdir):
+        assert self.in_own_session(tmpdir, pid_dir=str(tmpdir))
+        assert not self.in_own_session(tmpdir, pid_dir=None)
+    def test_stages_stopped_on_shutdown(self, tmpdir, options):
+        e = pipelineExecutor(options=options(**BACKUP_STRAGGLERS).execution, uri_file="uri")
+        e.pid_dir = str(tmpdir)
+        stage = subprocess.Popen(["sh", "-c", "sleep 30 & echo $! > %s; wait" % tmpdir.join("child")],
+                                 start_new_session=True)
+        tmpdir.join("0").write(str(stage.pid))
+        while not tmpdir.join("child").exists() or not tmpdir.join("child").read().strip():
+            time.sleep(0.05)
+        child = int(tmpdir.join("child").read())
+        e.kill_stages()
+        assert stage.wait(timeout=5) == -15
+        # (the stage's own child is stopped too, rather than left running after the executor exits)
+        for _ in range(100):
+            if not os.path.exists("/proc/%d" % child):
+                break
+            with open("/proc/%d/stat" % child) as f:
+                if f.read().split(")")[-1].split()[0] == "Z":
+                    break
+            time.sleep(0.05)
+        else:
+            assert False, "the stage's child is still running"
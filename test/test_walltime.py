@@ -0,0 +1,95 @@
+import threading
+import time
+
+import pytest
+
+import pydpiper.execution.queueing as q
+from pydpiper.execution.pipeline import Pipeline, CmdStage, InputFile, OutputFile
+from pydpiper.execution.pipeline_executor import pipelineExecutor
+
+HOUR = 3600
+
+
+# (executors submitted to PBS with a four-hour walltime)
+WALLTIME = dict(default_job_mem=1.0, mem=8, ppn=1, time="04:00:00", queue_type="pbs", local=True)
+
+
+@pytest.fixture()
+def pipeline(tmpdir, monkeypatch, options):
+    """A three-hour registration (then a blur of its output) and some quick resamplings."""
+    monkeypatch.chdir(tmpdir)
+    def make(fuse_stages=False):
+        stages = [CmdStage(["antsRegistration", InputFile("a.mnc"), OutputFile("a.xfm")]),
+                  CmdStage(["mincblur", InputFile("a.xfm"), OutputFile("a_blur.mnc")])]
+        stages[0].estimated_runtime = 3 * HOUR
+        stages.extend(CmdStage(["mincresample", InputFile("in%d.mnc" % k), OutputFile("out%d.mnc" % k)])
+                      for k in range(3))
+        p = Pipeline(stages, options(fuse_stages=fuse_stages, **WALLTIME))
+        p.shutdown_ev = threading.Event()
+        p.enqueue_runnable_stages()
+        p.wait_for_hooks()
+        return p
+    return make
+
+
+def expiring(p, client, time_left, walltime=4 * HOUR):
+    """Register an executor with the given walltime, of which only `time_left` remains."""
+    p.registerClient(client, 8, time_left=walltime)
+    p.clients[client].deadline = time.time() + time_left
+
+
+class TestWalltimeDispatch():
+    def test_long_stage_not_given_to_expiring_executor(self, pipeline):
+        p = pipeline()
+        expiring(p, "c1", time_left=20 * 60)
+        flag, [info] = p.getCommands("c1", 8, 1)
+        assert info.ix in (2, 3, 4)
+        assert 0 in p.runnable
+    def test_expiring_executor_waits_if_nothing_short_enough(self, pipeline):
+        p = pipeline()
+        expiring(p, "c1", time_left=60)
+        assert p.getCommands("c1", 8, 1) == ("wait", None)
+    def test_fresh_executor_takes_long_stage(self, pipeline):
+        p = pipeline()
+        p.registerClient("c1", 8, time_left=4 * HOUR - 30)
+        flag, [info] = p.getCommands("c1", 8, 1)
+        assert info.ix == 0
+    def test_walltime_not_known(self, pipeline):
+        p = pipeline()
+        p.registerClient("c1", 8)
+        flag, [info] = p.getCommands("c1", 8, 1)
+        assert info.ix == 0
+    def test_fused_chain_cut_short(self, pipeline):
+        p = pipeline(fuse_stages=True)
+        p.stages[1].estimated_runtime = HOUR
+        expiring(p, "c1", time_left=4 * HOUR, walltime=8 * HOUR)
+        flag, [info] = p.getCommands("c1", 8, 1)
+        assert info.ix == 0 and info.fused == []
+        # (while there's time for both)
+        p = pipeline(fuse_stages=True)
+        expiring(p, "c2", time_left=4 * HOUR, walltime=8 * HOUR)
+        flag, [info] = p.getCommands("c2", 8, 1)
+        assert info.ix == 0 and [f.ix for f in info.fused] == [1]
+
+
+class TestExecutorWalltime():
+    def test_asks_batch_system(self, monkeypatch, options):
+        monkeypatch.setenv("PBS_JOBID", "1234.server")
+        monkeypatch.setattr(q, "remaining_walltime", lambda: HOUR)
+        e = pipelineExecutor(options=options(**WALLTIME).execution, uri_file="uri")
+        assert HOUR - 5 < e.walltime_news()["time_left"] <= HOUR
+    def test_falls_back_to_requested_time(self, monkeypatch, options):
+        monkeypatch.setenv("PBS_JOBID", "1234.server")
+        monkeypatch.setattr(q, "remaining_walltime", lambda: None)
+        e = pipelineExecutor(options=options(**WALLTIME).execution, uri_file="uri")
+        assert 4 * HOUR - 5 < e.walltime_news()["time_left"] <= 4 * HOUR
+    def test_unparsable_time(self, monkeypatch, options):
+        monkeypatch.setenv("PBS_JOBID", "1234.server")
+        monkeypatch.setattr(q, "remaining_walltime", lambda: None)
+        e = pipelineExecutor(options=options(**dict(WALLTIME, time="4h")).execution, uri_file="uri")
+        assert e.walltime_news() == {}
+    def test_not_reported_outside_batch_job(self, monkeypatch, options):
+        for v in ["PBS_JOBID", "SLURM_JOB_ID", "JOB_ID"]:
+            monkeypatch.delenv(v, raising=False)
+        e = pipelineExecutor(options=options(**WALLTIME).execution, uri_file="uri")
+        assert e.walltime_news() == {}